@@ -11,18 +11,27 @@
 # !/usr/bin/env python
 # coding: utf-8
 import argparse
-import configparser
 import json
+import signal
+import sys
+from timeit import default_timer as timer
 from logging import getLogger, basicConfig, INFO
 
 from flask import Flask, Response, render_template, request, jsonify
 
-from camera import VideoCamera
+import asyncserver
+import devices
+import mearmlib
+import metrics
+import quality
+import servobackend
+import settings
+import telemetry
+from framecache import FrameVariant, DEFAULT_VARIANT
 
 """ 加载配置 """
-config = configparser.ConfigParser()
-config.read('config.ini')
-flip_code = eval(config.get('camera', 'flipcode'))  # 图像翻转代码
+config = settings.current()
+flip_code = config.camera.flipcode  # 图像翻转代码
 
 app = Flask(__name__)
 
@@ -32,44 +41,246 @@ basicConfig(
     format="%(asctime)s %(levelname)s %(name)s %(funcName)s(): %(message)s")
 
 
-def gen(camera):
+""" 所有客户端共享的摄像头和机械臂, 在第一个客户端连接时打开, 之后一直保持 """
+device_manager = devices.get_manager()
+
+
+def get_camera():
+    """获取共享的摄像头实例, 首次调用时打开并启动后台采集线程
+
+    Returns:
+        VideoCamera实例
+    """
+    return device_manager.camera(algorithm, target_color, stream_only,
+                                 is_test, flip_code, pipeline)
+
+
+def gen(camera, variant=DEFAULT_VARIANT, controller=None, debug=False):
     """生成视频流帧
 
+    所有客户端共享同一个广播器, 客户端来不及发送的旧帧会被跳过。
+    同一变体的JPEG每帧只编码一次, 由帧缓存在客户端之间共享。
+    有画质控制器时按它的决策选择变体和跳帧, 并把编码时间、
+    发送时间(yield 到下一次恢复之间 WSGI 写出数据的时间)反馈给它。
+
     Args:
         camera: VideoCamera实例
+        variant: 输出帧变体
+        controller: quality.QualityController(不自动调整时为None)
+        debug: 是否输出概率图(订阅期间跟踪器才生成概率图)
 
     Yields:
-        JPEG格式的视频帧数据
+        JPEG格式的视频帧数据(multipart块)
     """
-    while True:
-        frame = camera.get_frame(stream_only, is_test, flip_code)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
+    if debug:
+        broadcaster, frame_cache = camera.debug_broadcaster, camera.debug_cache
+    else:
+        broadcaster, frame_cache = camera.broadcaster, camera.frame_cache
+    if controller is not None:
+        quality.register(controller)
+    try:
+        last_seq = 0
+        for seq, _ in broadcaster.frames():
+            dropped = seq - last_seq - 1 if last_seq else 0
+            last_seq = seq
+            if controller is not None:
+                if controller.should_skip():
+                    continue
+                variant = controller.variant
+            start = timer()
+            seq, chunk = frame_cache.get(variant)
+            if chunk is None:
+                continue
+            encoded = timer()
+            yield chunk
+            if controller is not None:
+                controller.observe(encoded - start, timer() - encoded, dropped)
+    finally:
+        if controller is not None:
+            quality.unregister(controller)
+
+
+def gen_telemetry(camera):
+    """生成遥测事件流
+
+    订阅期间跟踪器才生成遥测数据, 客户端来不及接收的旧数据会被跳过。
+
+    Args:
+        camera: VideoCamera实例
+
+    Yields:
+        Server-Sent Events 格式的事件
+    """
+    formatter = telemetry.EventFormatter(camera.tracking)
+    yield formatter.format()
+    for _, message in camera.telemetry_broadcaster.frames():
+        yield formatter.format(message)
+
+
+def get_variant(args):
+    """从请求参数中解析输出帧变体
+
+    支持 quality(10-100), scale(0.1-1.0)
+
+    Args:
+        args: 请求参数
+
+    Returns:
+        FrameVariant
+    """
+    quality = args.get('quality', DEFAULT_VARIANT.quality, type=int)
+    scale = args.get('scale', DEFAULT_VARIANT.scale, type=float)
+    return FrameVariant(
+        min(max(quality, 10), 100), round(min(max(scale, 0.1), 1.0), 2))
 
 
 @app.route('/')
 def index():
     """渲染主页
 
+    直通MJPG时服务器不翻转图像, 由页面按 flip_code 用CSS翻转。
+
     Returns:
         渲染后的HTML页面
     """
-    return render_template('index.html', flip_code=flip_code)
+    camera = get_camera()
+    return render_template('index.html', flip_code=flip_code,
+                           client_flip=camera.passthrough_active())
 
 
 @app.route('/video_feed')
 def video_feed():
     """视频流路由
 
+    可以通过 quality, scale 参数选择输出变体,
+    例如 /video_feed?quality=70&scale=0.5
+    启用自动调整时(adaptive=1, 默认按config.ini)该变体为画质上限。
+
+    Returns:
+        包含MJPEG视频流的Response对象
+    """
+    variant = get_variant(request.args)
+    controller = None
+    if request.args.get('adaptive', int(quality.adaptive()), type=int):
+        controller = quality.QualityController(variant, request.remote_addr)
+    return Response(
+        gen(get_camera(), variant, controller),
+        mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/debug_feed')
+def debug_feed():
+    """概率图(调试)视频流路由
+
+    只在有客户端时由跟踪器生成并编码为灰度JPEG,
+    没有客户端时不产生任何开销。参数与 /video_feed 相同(不自动调整)。
+
     Returns:
         包含MJPEG视频流的Response对象
     """
-    video_camera = VideoCamera(algorithm, target_color, stream_only, is_test)
     return Response(
-        gen(video_camera),
+        gen(get_camera(), get_variant(request.args), debug=True),
         mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
+@app.route('/telemetry')
+def telemetry_feed():
+    """遥测数据(Server-Sent Events)路由
+
+    每帧推送跟踪窗口、跟踪区域比例、移动比例、舵机角度、模式和
+    flip_code, 页面据此在画布上绘制跟踪框和文本。
+
+    Returns:
+        text/event-stream 响应
+    """
+    return Response(gen_telemetry(get_camera()),
+                    mimetype=telemetry.CONTENT_TYPE,
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/clients')
+def clients():
+    """返回每个视频流客户端的画质控制决策
+
+    Returns:
+        包含客户端列表的JSON响应
+    """
+    return jsonify(quality.clients())
+
+
+@app.route('/stats')
+def stats():
+    """返回广播, 帧缓存与流水线各阶段统计
+
+    Returns:
+        包含统计信息的JSON响应
+    """
+    camera = device_manager.opened_camera
+    if camera is None:
+        return jsonify({"devices": device_manager.stats()})
+    stats = camera.stats()
+    stats["devices"] = device_manager.stats()
+    return jsonify(stats)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 格式的指标
+
+    各处理阶段耗时的直方图, 以及客户端数、丢帧数等计数器
+
+    Returns:
+        text/plain 响应
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/config')
+def config_endpoint():
+    """返回当前生效的配置
+
+    Returns:
+        包含配置的JSON响应
+    """
+    return jsonify(settings.current().as_dict())
+
+
+@app.route('/config/reload', methods=['POST'])
+def config_reload():
+    """重新读取 config.ini 和 color.ini
+
+    新配置由采集线程在两帧之间应用, 不重启处理线程;
+    摄像头尚未启动时立即生效。
+
+    Returns:
+        包含生效项和需要重启的项的JSON响应, 配置错误时为400
+    """
+    try:
+        result = settings.reload()
+    except settings.SettingsError as e:
+        logger.error("invalid settings: {}".format(e))
+        return jsonify(error=str(e)), 400
+    if device_manager.opened_camera is None:
+        settings.apply_pending()
+    return jsonify(result)
+
+
+@app.route('/recorder/snapshot', methods=['POST'])
+def recorder_snapshot():
+    """导出飞行记录器中最近几秒的帧和跟踪状态
+
+    导出的文件可以用 `python3 recorder.py <文件>` 离线回放。
+
+    Returns:
+        包含导出文件路径和帧数的JSON响应, 未启用记录时为404
+    """
+    camera = device_manager.opened_camera
+    if camera is None or camera.recorder is None:
+        return jsonify(error="flight recorder is not running"), 404
+    path, frames = camera.recorder.snapshot()
+    return jsonify(path=path, frames=frames)
+
+
 @app.route('/tracking', methods=['POST'])
 def tracking():
     """处理跟踪命令
@@ -82,6 +293,7 @@ def tracking():
     - flip-y: Y轴翻转
     - flip-xy: XY轴翻转
     - flip-reset: 重置翻转
+    - reseed: 重新锁定目标颜色(跟踪多个颜色时为所有目标)
 
     Returns:
         包含命令执行结果的JSON响应
@@ -89,6 +301,7 @@ def tracking():
     global stream_only
     global is_test
     global flip_code
+    camera = device_manager.opened_camera
 
     mearm_pi_response = ""
     command = request.json['command']
@@ -105,6 +318,10 @@ def tracking():
         stream_only = False
         is_test = True
         mearm_pi_response = "true"
+    elif command == "reseed":
+        if camera is not None:
+            camera.tracking.reseed()
+        mearm_pi_response = "true"
 
     if command == "flip-x":
         flip_code = "0"  # X轴翻转
@@ -115,10 +332,14 @@ def tracking():
     elif command == "flip-reset":
         flip_code = "reset"  # 重置翻转
 
+    if camera is not None:
+        camera.set_mode(stream_only, is_test, flip_code)
+
     result = {
         "command": command,
         "result": mearm_pi_response,
-        "flip_code": flip_code
+        "flip_code": flip_code,
+        "client_flip": camera is not None and camera.passthrough_active()
     }
     logger.info(
         "sent:{} res:{} flip: {}".format(command, mearm_pi_response, flip_code))
@@ -126,10 +347,8 @@ def tracking():
 
 
 if __name__ == '__main__':
-    # 读取颜色配置文件
-    config = configparser.ConfigParser()
-    config.read('color.ini')
-    colors = config.sections()
+    # 颜色配置
+    colors = config.color_names
 
     # 命令行参数解析
     parser = argparse.ArgumentParser(
@@ -153,16 +372,52 @@ if __name__ == '__main__':
     parser.add_argument(
         '-c',
         '--color',
-        help='select tracking color in color.ini',
-        default='',
+        help='select tracking color in color.ini '
+        '(several colors are tracked at once, in priority order)',
+        nargs='*',
+        default=[],
         choices=colors)
+    parser.add_argument(
+        '-p',
+        '--pipeline',
+        help='frame processing mode (staged: capture/track/encode threads)',
+        default='serial',
+        choices=['serial', 'staged'])
+    parser.add_argument(
+        '-S',
+        '--server',
+        help='http server (asyncio: video streams on one event loop '
+        'instead of a thread per client)',
+        default='flask',
+        choices=['flask', 'asyncio'])
+    parser.add_argument(
+        '-b',
+        '--servo_backend',
+        help='servo backend (default: backend in config.ini)',
+        default=mearmlib.servo_backend,
+        choices=servobackend.BACKENDS)
     args = parser.parse_args()
 
     # 初始化全局变量
     algorithm = args.algorithm  # 跟踪算法
-    target_color = args.color  # 目标颜色
+    if len(args.color) > 1:
+        target_color = args.color  # 多个目标颜色(顺序即优先级)
+    else:
+        target_color = ''.join(args.color)  # 目标颜色
     stream_only = args.stream_only  # 是否仅视频流模式
     is_test = args.test  # 是否测试模式
+    pipeline = args.pipeline  # 帧处理方式
+    mearmlib.setup_backend(args.servo_backend)  # 舵机后端
+
+    # SIGTERM 与 Ctrl-C 相同, 退出时关闭摄像头和舵机
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    # 启动Flask应用
-    app.run(host='0.0.0.0', threaded=True)
+    # 启动服务器
+    try:
+        if args.server == 'asyncio':
+            asyncserver.AsyncServer(app, get_camera, get_variant).run(
+                host='0.0.0.0', port=5000)
+        else:
+            app.run(host='0.0.0.0', threaded=True)
+    finally:
+        device_manager.shutdown()
@@ -0,0 +1,368 @@
+# !/usr/bin/env python
+# coding: utf-8
+"""asyncio 服务模式
+
+Flask 开发服务器(threaded=True)的每个 /video_feed 客户端在连接期间
+占用一个线程。本模块用 asyncio 的流直接处理视频流连接, 所有客户端
+共享一个事件循环, 空闲或网络慢的客户端只占用一个套接字:
+
+* /video_feed, /debug_feed: 在事件循环中发送 multipart MJPEG。
+  每个连接等上一帧写完(drain)后直接取最新帧, 中间帧跳过。
+* /telemetry: 同样在事件循环中发送 Server-Sent Events。
+* 其他路由(/, /tracking, /stats, /metrics, /clients, /static/...):
+  交给 Flask 应用(WSGI)在线程池中处理, 路由和 JSON 格式与 Flask 模式相同。
+  响应后关闭连接。
+"""
+import asyncio
+import io
+import sys
+import threading
+from logging import getLogger
+from timeit import default_timer as timer
+from urllib.parse import parse_qsl, unquote
+
+from werkzeug.datastructures import MultiDict
+
+import quality
+import telemetry
+
+logger = getLogger(__name__)
+
+STREAM_HEADER = (b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'Connection: close\r\n\r\n')
+EVENTS_HEADER = (b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: ' + telemetry.CONTENT_TYPE.encode() + b'\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'Connection: close\r\n\r\n')
+MAX_HEADER_LINES = 100  # 请求头的最大行数
+MAX_BODY = 1 << 20  # 请求体的最大字节数
+
+
+class FrameSource(object):
+    """把 FrameBroadcaster 的新帧通知转到事件循环
+
+    一个后台线程等待广播器, 有新帧时通知事件循环,
+    所有连接在事件循环中等待同一个 future, 不占用线程。
+    """
+    def __init__(self, broadcaster, loop):
+        """初始化并启动等待线程
+
+        Args:
+            broadcaster: FrameBroadcaster
+            loop: 事件循环
+        """
+        self.broadcaster = broadcaster
+        self.loop = loop
+        self.seq = 0  # 最新帧序号
+        self._changed = loop.create_future()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """通知等待线程停止(最多在一次广播器超时后结束)"""
+        self.running = False
+
+    def join(self):
+        """等待线程结束"""
+        self.thread.join()
+
+    def _run(self):
+        """后台线程: 等待新帧并通知事件循环"""
+        seq = 0
+        while self.running:
+            new_seq, frame = self.broadcaster.wait(seq, timeout=1.0)
+            if frame is None:
+                continue
+            seq = new_seq
+            self.loop.call_soon_threadsafe(self._publish, seq)
+
+    def _publish(self, seq):
+        """(事件循环中)更新最新帧序号并唤醒等待的连接"""
+        self.seq = seq
+        changed, self._changed = self._changed, self.loop.create_future()
+        changed.set_result(seq)
+
+    async def wait(self, last_seq, timeout=5.0):
+        """等待比 last_seq 更新的帧
+
+        Args:
+            last_seq: 连接已发送的帧序号
+            timeout: 超时秒数
+
+        Returns:
+            int: 最新帧序号, 超时返回 last_seq
+        """
+        if self.seq != last_seq:
+            return self.seq
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._changed),
+                                          timeout)
+        except asyncio.TimeoutError:
+            return last_seq
+
+
+class AsyncServer(object):
+    """asyncio 视频流服务器"""
+    def __init__(self, app, get_camera, get_variant):
+        """初始化服务器
+
+        Args:
+            app: Flask 应用(处理视频流以外的路由)
+            get_camera: 获取共享摄像头实例的函数
+            get_variant: 从请求参数解析输出帧变体的函数
+        """
+        self.app = app
+        self.get_camera = get_camera
+        self.get_variant = get_variant
+        self.loop = None
+        self.host = None
+        self.port = None
+        self._sources = {}  # 广播器 -> FrameSource
+        self._tasks = set()  # 正在处理的连接
+
+    def run(self, host='0.0.0.0', port=5000):
+        """启动服务器, 直到 Ctrl-C
+
+        Args:
+            host: 监听地址
+            port: 监听端口
+        """
+        self.host, self.port = host, port
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self._connected, host, port))
+        logger.info("asyncio server listening on {}:{}".format(host, port))
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._shutdown(server)
+
+    def _shutdown(self, server):
+        """停止接受连接, 取消视频流等连接并停止等待线程"""
+        server.close()
+        """ 视频流和事件流不会自己结束, 先取消(关闭连接)再等待服务器关闭 """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(server.wait_closed())
+        sources, self._sources = list(self._sources.values()), {}
+        for source in sources:
+            source.stop()
+        for source in sources:
+            source.join()
+        self.loop.close()
+
+    def _connected(self, reader, writer):
+        """新连接: 创建处理任务并记录, 关闭服务器时取消"""
+        task = self.loop.create_task(self._handle(reader, writer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _source(self, broadcaster):
+        """获取广播器对应的 FrameSource(首次调用时创建)"""
+        source = self._sources.get(broadcaster)
+        if source is None:
+            source = self._sources[broadcaster] = FrameSource(
+                broadcaster, self.loop)
+        return source
+
+    async def _handle(self, reader, writer):
+        """处理一个连接"""
+        peer = writer.get_extra_info('peername') or ('', 0)
+        try:
+            request = await self._read_request(reader)
+            if request is None:
+                return
+            method, target, headers, body = request
+            path, _, query = target.partition('?')
+            if method == 'GET' and path in ('/video_feed', '/debug_feed'):
+                await self._stream(reader, writer, path == '/debug_feed',
+                                   MultiDict(parse_qsl(query)), peer[0])
+            elif method == 'GET' and path == '/telemetry':
+                await self._telemetry(reader, writer)
+            else:
+                response = await self.loop.run_in_executor(
+                    None, self._call_wsgi, method, path, query, headers,
+                    body, peer)
+                writer.write(response)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.CancelledError):
+            pass
+        except Exception:
+            logger.exception("failed to handle request")
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """读取请求行、请求头和请求体
+
+        Returns:
+            tuple: (方法, 目标, 请求头dict(小写键), 请求体), 格式错误时为None
+        """
+        line = await reader.readline()
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            return None
+        method, target, _ = parts
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            return None
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY:
+            return None
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    def _call_wsgi(self, method, path, query, headers, body, peer):
+        """(线程池中)调用 Flask 应用, 返回完整的HTTP响应"""
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, encoding='latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': peer[0],
+            'REMOTE_PORT': str(peer[1]),
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for name, value in headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = response_headers
+
+        result = self.app.wsgi_app(environ, start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        lines = ['HTTP/1.1 ' + response['status']]
+        lines += ['{}: {}'.format(name, value)
+                  for name, value in response['headers']
+                  if name.lower() not in ('content-length', 'connection')]
+        lines += ['Content-Length: {}'.format(len(content)),
+                  'Connection: close']
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + content
+
+    async def _stream(self, reader, writer, debug, args, address):
+        """发送 multipart MJPEG 视频流, 直到客户端断开
+
+        与 app.gen() 相同: 所有连接共享帧缓存, 启用自动调整时
+        按画质控制器的决策选择变体和跳帧。发送时间为 drain 的等待时间,
+        等待期间到达的帧被跳过。
+
+        Args:
+            reader: StreamReader(用于检测客户端断开)
+            writer: StreamWriter
+            debug: 是否为概率图(/debug_feed)
+            args: 请求参数
+            address: 客户端地址
+        """
+        camera = await self.loop.run_in_executor(None, self.get_camera)
+        if debug:
+            broadcaster, frame_cache = camera.debug_broadcaster, \
+                camera.debug_cache
+        else:
+            broadcaster, frame_cache = camera.broadcaster, camera.frame_cache
+        variant = self.get_variant(args)
+        controller = None
+        if not debug and args.get('adaptive', int(quality.adaptive()),
+                                  type=int):
+            controller = quality.QualityController(variant, address)
+            quality.register(controller)
+        source = self._source(broadcaster)
+        """ 写缓冲区不保留多余的帧, drain 等到当前帧交给内核为止 """
+        writer.transport.set_write_buffer_limits(high=0)
+        writer.write(STREAM_HEADER)
+        broadcaster.add_viewer()
+        try:
+            seq = 0
+            while not reader.at_eof() and not writer.transport.is_closing():
+                new_seq = await source.wait(seq)
+                if new_seq == seq:
+                    continue
+                dropped = new_seq - seq - 1 if seq else 0
+                if dropped:
+                    broadcaster.add_dropped(dropped)
+                seq = new_seq
+                if controller is not None:
+                    if controller.should_skip():
+                        continue
+                    variant = controller.variant
+                start = timer()
+                _, chunk = frame_cache.peek(variant)
+                if chunk is None:
+                    """ 尚未编码: 在线程池中编码(或等待其他客户端编码) """
+                    _, chunk = await self.loop.run_in_executor(
+                        None, frame_cache.get, variant)
+                    if chunk is None:
+                        continue
+                encoded = timer()
+                writer.write(chunk)
+                await writer.drain()
+                if controller is not None:
+                    controller.observe(encoded - start, timer() - encoded,
+                                       dropped)
+        finally:
+            broadcaster.remove_viewer()
+            if controller is not None:
+                quality.unregister(controller)
+
+    async def _telemetry(self, reader, writer):
+        """发送遥测事件流, 直到客户端断开(与 app.gen_telemetry() 相同)
+
+        Args:
+            reader: StreamReader(用于检测客户端断开)
+            writer: StreamWriter
+        """
+        camera = await self.loop.run_in_executor(None, self.get_camera)
+        broadcaster = camera.telemetry_broadcaster
+        formatter = telemetry.EventFormatter(camera.tracking)
+        source = self._source(broadcaster)
+        writer.transport.set_write_buffer_limits(high=0)
+        writer.write(EVENTS_HEADER + formatter.format())
+        broadcaster.add_viewer()
+        try:
+            seq = 0
+            while not reader.at_eof() and not writer.transport.is_closing():
+                new_seq = await source.wait(seq)
+                if new_seq == seq:
+                    continue
+                if seq and new_seq - seq > 1:
+                    broadcaster.add_dropped(new_seq - seq - 1)
+                seq, message = broadcaster.latest()
+                writer.write(formatter.format(message))
+                await writer.drain()
+        finally:
+            broadcaster.remove_viewer()
@@ -0,0 +1,349 @@
+# !/usr/bin/env python
+# coding: utf-8
+"""离线回放性能测试
+
+不需要摄像头和pigpiod: 从录制的视频文件或合成的移动色块生成帧,
+经过与 VideoCamera.get_frame 相同的处理流程
+(缩放/翻转 → Tracking.get_track_frame → MearmMove.motion → JPEG编码),
+舵机命令发送到模拟舵机后端。
+
+对每个跟踪算法、分辨率和 color.ini 中的颜色组合, 输出各阶段耗时
+(p50/p95/p99)、FPS、每帧内存分配、舵机命令数以及从读取帧到舵机
+命令生效的延迟, 结果为JSON格式。
+
+example:
+    python3 bench.py --frames 300 --output bench.json
+    python3 bench.py --source recorded.avi -a camshift -r 320x240 -c yellow
+"""
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from logging import getLogger, WARNING
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+
+import ikmap
+import mearm
+import mearmlib
+import servobackend
+import settings
+import tracking
+
+""" 加载配置 """
+config = settings.current()
+frame_prop = config.camera.frame_prop  # 帧属性
+flip_code = config.camera.flipcode  # 图像翻转代码
+
+STAGES = ("read", "resize_flip", "object_tracking", "motion", "annotate",
+          "encode", "total")
+
+
+class SyntheticSource(object):
+    """合成帧源: 在噪声背景上按李萨如曲线移动的彩色圆形色块
+
+    色块颜色取 color.ini 中该颜色HSV范围的中间值, 半径随时间变化,
+    以便同时触发底座/上下臂和前进/后退动作。
+    指定多个颜色时每个颜色一个色块, 运动相位互相错开。
+    """
+    def __init__(self, color, size=(640, 480), seed=0):
+        """初始化帧源
+
+        Args:
+            color: color.ini 中的颜色名称或颜色名称列表
+            size: 原始帧大小 (宽度, 高度)
+            seed: 背景噪声的随机种子
+        """
+        self.size = size
+        self.index = 0
+        rng = np.random.RandomState(seed)
+        self.background = rng.randint(
+            40, 90, (size[1], size[0], 3)).astype(np.uint8)
+        self.bgr = []
+        for name in color if isinstance(color, list) else [color]:
+            lower, upper = config.colors[name]
+            hsv = np.uint8([[[(l + u) // 2 for l, u in zip(lower, upper)]]])
+            bgr = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0]
+            self.bgr.append(tuple(int(c) for c in bgr))
+
+    def read(self):
+        """生成下一帧
+
+        Returns:
+            tuple: (读取状态, 视频帧)
+        """
+        width, height = self.size
+        frame = self.background.copy()
+        for i, bgr in enumerate(self.bgr):
+            t = self.index / 30.0 + i * 2.0
+            x = int(width / 2 + width / 3 * np.sin(t * 0.9))
+            y = int(height / 2 + height / 3 * np.sin(t * 1.3 + 0.5))
+            radius = int(min(width, height) * (0.08 + 0.04 * np.sin(t * 0.4)))
+            cv2.circle(frame, (x, y), radius, bgr, -1)
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+
+class VideoFileSource(object):
+    """录制视频帧源, 读到结尾时从头开始"""
+    def __init__(self, path):
+        self.path = path
+        self.video = cv2.VideoCapture(path)
+        if not self.video.isOpened():
+            raise IOError("cannot open video file: {}".format(path))
+        self.size = (int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                     int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def read(self):
+        """读取下一帧
+
+        Returns:
+            tuple: (读取状态, 视频帧)
+        """
+        ret, frame = self.video.read()
+        if not ret:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.video.read()
+        return ret, frame
+
+    def release(self):
+        self.video.release()
+
+
+def _timed(samples, func):
+    """包装方法, 把每次调用的耗时追加到 samples"""
+    def wrapper(*args, **kwargs):
+        start = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(timer() - start)
+    return wrapper
+
+
+def _percentiles(samples):
+    """计算耗时分位数(毫秒)"""
+    if not samples:
+        return {"p50": 0, "p95": 0, "p99": 0, "mean": 0}
+    ms = np.array(samples) * 1000
+    p50, p95, p99 = np.percentile(ms, (50, 95, 99))
+    return {
+        "p50": round(float(p50), 3),
+        "p95": round(float(p95), 3),
+        "p99": round(float(p99), 3),
+        "mean": round(float(ms.mean()), 3)
+    }
+
+
+def _open_source(args, color):
+    if args.source == "synthetic":
+        return SyntheticSource(color)
+    return VideoFileSource(args.source)
+
+
+def run_case(args, algorithm, resolution, color):
+    """运行一个 (算法, 分辨率, 颜色) 组合, 颜色为列表时同时跟踪多个颜色
+
+    Returns:
+        dict: 测试结果
+    """
+    backend = servobackend.SimulatedBackend(mearmlib.sim_slew_rate,
+                                            mearmlib.sim_latency)
+    mearm.set_backend(
+        servobackend.CoalescingBackend(backend, mearmlib.servo_max_rate))
+    """ 默认不用控制线程: 舵机命令数和延迟只统计每帧自身的命令 """
+    mearmlib.motion_control = args.motion_control
+    prop = (resolution[0], resolution[1], frame_prop[2])
+    source = _open_source(args, color)
+    ret, frame = source.read()
+    video_prop = (source.size[0], source.size[1], prop[2])
+    tracker = tracking.Tracking(ret, frame, video_prop, algorithm, color,
+                                False, False, prop)
+    """ 默认在帧上绘制: 绘制阶段统计静态层合成和逐帧文本的耗时 """
+    tracker.server_overlay = not args.client_overlay
+    tracker.tracking.draw = tracker.server_overlay
+
+    """ 包装跟踪与机械臂控制方法以分别计时 """
+    samples = {stage: [] for stage in STAGES}
+    tracker.tracking.object_tracking = _timed(
+        samples["object_tracking"], tracker.tracking.object_tracking)
+    tracker.myMeArmMove.motion = _timed(samples["motion"],
+                                        tracker.myMeArmMove.motion)
+
+    def process():
+        t0 = timer()
+        ret, frame = source.read()
+        t1 = timer()
+        frame = cv2.resize(frame, (prop[0], prop[1]))
+        if flip_code != "reset":
+            frame = cv2.flip(frame, int(flip_code))
+        t2 = timer()
+        frame = tracker.get_track_frame(ret, frame, False, False, t1)
+        t3 = timer()
+        ret, jpeg = cv2.imencode('.jpg', frame)
+        jpeg.tobytes()
+        t4 = timer()
+        return t0, t1, t2, t3, t4
+
+    for _ in range(args.warmup):
+        process()
+    for stage in samples.values():
+        del stage[:]
+    commands0 = backend.commands
+    glass_to_servo = []
+
+    start = timer()
+    for _ in range(args.frames):
+        commands = backend.commands
+        t0, t1, t2, t3, t4 = process()
+        if backend.commands != commands:
+            glass_to_servo.append(backend.last_command_time +
+                                  backend.latency - t0)
+        samples["read"].append(t1 - t0)
+        samples["resize_flip"].append(t2 - t1)
+        samples["annotate"].append(t3 - t2 - samples["object_tracking"][-1]
+                                   - samples["motion"][-1])
+        samples["encode"].append(t4 - t3)
+        samples["total"].append(t4 - t0)
+    elapsed = timer() - start
+    commands = backend.commands - commands0
+
+    """ 另外跑少量帧统计内存分配(tracemalloc会拖慢处理, 不计入耗时) """
+    peak_bytes = []
+    retained_bytes = []
+    tracemalloc.start()
+    for _ in range(args.alloc_frames):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        process()
+        current, peak = tracemalloc.get_traced_memory()
+        peak_bytes.append(peak - before)
+        retained_bytes.append(current - before)
+    tracemalloc.stop()
+    source.release()
+    """ 停止本组合的控制线程和夹持器线程 """
+    tracker.myMeArmMove.close()
+    mearm.backend.close()
+
+    return {
+        "algorithm": algorithm,
+        "resolution": list(resolution),
+        "color": color,
+        "frames": args.frames,
+        "fps": round(args.frames / elapsed, 2),
+        "stages_ms": {stage: _percentiles(samples[stage]) for stage in STAGES},
+        "servo_commands_per_frame": round(commands / args.frames, 3),
+        "glass_to_servo_ms": _percentiles(glass_to_servo),
+        "lost_lock": tracker.tracking.color_model.lost_count,
+        "alloc_per_frame": {
+            "peak_bytes": int(np.median(peak_bytes)) if peak_bytes else 0,
+            "retained_bytes": int(np.mean(retained_bytes))
+            if retained_bytes else 0
+        }
+    }
+
+
+def _resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='offline benchmark of the tracking pipeline')
+    parser.add_argument(
+        '-s',
+        '--source',
+        help='recorded video file, or "synthetic" for a moving colour blob',
+        default='synthetic')
+    parser.add_argument(
+        '-a',
+        '--algorithm',
+        help='tracking algorithms to benchmark',
+        nargs='+',
+        default=['camshift', 'meanshift'],
+        choices=['camshift', 'meanshift'])
+    parser.add_argument(
+        '-r',
+        '--resolution',
+        help='frame_prop resolutions to benchmark (WIDTHxHEIGHT)',
+        nargs='+',
+        type=_resolution,
+        default=[(160, 120), (320, 240), (640, 480)])
+    parser.add_argument(
+        '-c',
+        '--color',
+        help='colors in color.ini to benchmark',
+        nargs='+',
+        default=config.color_names,
+        choices=config.color_names)
+    parser.add_argument(
+        '-m',
+        '--multi',
+        help='also benchmark tracking all selected colors at once',
+        action='store_true')
+    parser.add_argument(
+        '--motion-control',
+        help='move the arm from the control thread (servo commands and '
+        'latency then include its asynchronous writes)',
+        action='store_true')
+    parser.add_argument(
+        '--client-overlay',
+        help='do not draw into the frames, as with server_overlay = False '
+        '(the annotate stage then only counts the FPS)',
+        action='store_true')
+    parser.add_argument(
+        '-n', '--frames', help='frames per case', type=int, default=300)
+    parser.add_argument(
+        '--warmup', help='warmup frames per case', type=int, default=30)
+    parser.add_argument(
+        '--alloc-frames',
+        help='frames per case traced for allocations',
+        type=int,
+        default=30)
+    parser.add_argument(
+        '-o', '--output', help='write JSON report to file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    """ 日志输出会显著影响耗时, 测试期间只输出警告 """
+    getLogger().setLevel(WARNING)
+
+    results = []
+    for algorithm in args.algorithm:
+        for resolution in args.resolution:
+            for color in args.color:
+                results.append(run_case(args, algorithm, resolution, color))
+            if args.multi and len(args.color) > 1:
+                results.append(
+                    run_case(args, algorithm, resolution, list(args.color)))
+
+    report = {
+        "meta": {
+            "source": args.source,
+            "frames": args.frames,
+            "motion_control": args.motion_control,
+            "server_overlay": not args.client_overlay,
+            "ik": bool(ikmap.ik),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine()
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
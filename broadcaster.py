@@ -0,0 +1,116 @@
+# !/usr/bin/env python
+# coding: utf-8
+import threading
+
+
+class FrameBroadcaster(object):
+    """最新帧广播类
+
+    由单一的采集/跟踪线程发布帧，所有 /video_feed 客户端共享同一帧。
+    客户端总是取最新帧，处理不过来的旧帧直接丢弃，不会阻塞发布线程。
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0  # 最新帧序号
+        self._frame = None  # 最新帧
+        self.viewers = 0  # 当前客户端数
+        self.published = 0  # 已发布帧数
+        self.dropped = 0  # 客户端跳过的帧数(累计)
+
+    def publish(self, frame):
+        """发布新帧并唤醒所有等待的客户端
+
+        Args:
+            frame: 新帧
+
+        Returns:
+            int: 新帧序号
+        """
+        with self._cond:
+            self._seq += 1
+            self._frame = frame
+            self.published += 1
+            self._cond.notify_all()
+            return self._seq
+
+    def latest(self):
+        """获取最新帧
+
+        Returns:
+            tuple: (帧序号, 帧)
+        """
+        with self._cond:
+            return self._seq, self._frame
+
+    def wait(self, last_seq, timeout=None):
+        """等待比 last_seq 更新的帧
+
+        Args:
+            last_seq: 客户端已取得的帧序号
+            timeout: 超时秒数
+
+        Returns:
+            tuple: (帧序号, 帧)，超时返回 (last_seq, None)
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq != last_seq,
+                                       timeout):
+                return last_seq, None
+            return self._seq, self._frame
+
+    def frames(self, timeout=5.0):
+        """客户端帧生成器
+
+        每次产出最新帧，跳过客户端来不及处理的中间帧。
+
+        Args:
+            timeout: 等待新帧的超时秒数
+
+        Yields:
+            tuple: (帧序号, 帧)
+        """
+        self.add_viewer()
+        try:
+            seq = 0
+            while True:
+                new_seq, frame = self.wait(seq, timeout)
+                if frame is None:
+                    continue
+                if seq and new_seq - seq > 1:
+                    self.add_dropped(new_seq - seq - 1)
+                seq = new_seq
+                yield seq, frame
+        finally:
+            self.remove_viewer()
+
+    def add_viewer(self):
+        """客户端连接时调用(不经过 frames() 的客户端)"""
+        with self._cond:
+            self.viewers += 1
+
+    def remove_viewer(self):
+        """客户端断开时调用"""
+        with self._cond:
+            self.viewers -= 1
+
+    def add_dropped(self, count):
+        """记录客户端跳过的帧数
+
+        Args:
+            count: 跳过的帧数
+        """
+        with self._cond:
+            self.dropped += count
+
+    def stats(self):
+        """获取广播统计
+
+        Returns:
+            dict: 客户端数、发布帧数、丢弃帧数
+        """
+        with self._cond:
+            return {
+                "viewers": self.viewers,
+                "published": self.published,
+                "dropped": self.dropped
+            }
@@ -3,24 +3,40 @@ https://github.com/ECI-Robotics/opencv_remote_streaming_processing/
 """
 # !/usr/bin/env python
 # coding: utf-8
-import configparser
+import json
+import threading
+from logging import getLogger
+from time import sleep
+from timeit import default_timer as timer
 
 import cv2
 
+import capture
+import mearm
+import metrics
+import recorder
+import settings
 import tracking
+from broadcaster import FrameBroadcaster
+from framecache import FrameCache
+from metrics import STAGE_SECONDS
+from pipeline import StagedPipeline
 
-""" 加载配置文件 """
-config = configparser.ConfigParser()
-config.read('config.ini')
-frame_prop = eval(config.get('camera', 'frame_prop'))  # 视频帧属性
+logger = getLogger(__name__)
+
+""" 加载配置 """
+config = settings.current()
+frame_prop = config.camera.frame_prop  # 视频帧属性
 
 
 class VideoCamera(object):
     """视频摄像头类
 
-    处理视频捕获和帧处理的主类
+    处理视频捕获和帧处理的主类。
+    由一个后台线程统一采集、跟踪并编码，结果通过广播器分发给所有客户端。
     """
-    def __init__(self, algorithm, target_color, stream_only, is_test):
+    def __init__(self, algorithm, target_color, stream_only, is_test,
+                 flip_code="reset", pipeline="serial", get_arm=None):
         """初始化视频摄像头
 
         Args:
@@ -28,48 +44,349 @@ class VideoCamera(object):
             target_color: 目标颜色
             stream_only: 是否仅视频流模式
             is_test: 是否测试模式
+            flip_code: 图像翻转代码
+            pipeline: 处理方式, "serial"(单线程依次处理)
+                      或 "staged"(采集/跟踪/编码分阶段并行)
+            get_arm: 获取机械臂控制实例的函数(共享实例), 默认新建
         """
-        """ 获取第一帧视频 """
-        ##self.video = cv2.VideoCapture(0)
-        self.video = cv2.VideoCapture(0, cv2.CAP_V4L)  # 使用V4L驱动打开摄像头
+        """ 按 frame_prop 向驱动请求采集格式, 获取第一帧视频 """
+        self.video, self.capture_prop = capture.open_capture()
         ret, frame = self.video.read()
         video_prop = self._get_video_prop()  # 获取视频属性
         self.tracking = tracking.Tracking(ret, frame, video_prop, algorithm,
-                                       target_color, stream_only, is_test)
+                                       target_color, stream_only, is_test,
+                                       get_arm=get_arm)
+        """ 飞行记录器: 一直保留最近几秒的帧和跟踪状态(未启用时为None) """
+        colors = target_color if isinstance(target_color,
+                                            (list, tuple)) else [target_color]
+        self.recorder = recorder.open_recorder(
+            frame_prop, "{} {}".format(algorithm, ",".join(colors)))
+        self.tracking.recorder = self.recorder
+        """ 当前模式, 由 set_mode 在运行时更新 """
+        self.stream_only = stream_only
+        self.is_test = is_test
+        self.flip_code = flip_code
+        """ 仅流模式下直通摄像头输出的MJPG数据(驱动以MJPG输出时) """
+        self.passthrough = capture.capture_passthrough and \
+            self.capture_prop["fourcc"] == "MJPG"
+        self.raw_mode = False  # 驱动当前是否返回未解码数据
+        """ 后台采集线程, 帧缓存与帧广播器 """
+        self.frame_cache = FrameCache()
+        self.broadcaster = FrameBroadcaster()
+        """ 概率图(/debug_feed)只在有客户端时生成和编码 """
+        self.debug_cache = FrameCache()
+        self.debug_broadcaster = FrameBroadcaster()
+        """ 遥测数据(/telemetry)只在有客户端时生成, 广播JSON文本 """
+        self.telemetry_broadcaster = FrameBroadcaster()
+        self.pipeline = StagedPipeline(self) if pipeline == "staged" else None
+        self.thread = None
+        self.running = False
+        metrics.register_collector(self.collect_metrics)
 
     def __del__(self):
         """释放视频资源"""
         self.video.release()
 
+    def close(self):
+        """停止采集线程并释放摄像头"""
+        self.stop()
+        metrics.unregister_collector(self.collect_metrics)
+        if self.recorder is not None:
+            self.recorder.close()
+        self.video.release()
+
     def _get_video_prop(self):
         """获取视频属性
 
         Returns:
-            tuple: (宽度, 高度, FPS)
+            tuple: (宽度, 高度, FPS, 格式, 驱动缓冲区数量)
         """
-        return self.video.get(cv2.CAP_PROP_FRAME_WIDTH), self.video.get(
-            cv2.CAP_PROP_FRAME_HEIGHT), self.video.get(cv2.CAP_PROP_FPS)
+        prop = self.capture_prop
+        return prop["width"], prop["height"], prop["fps"], prop["fourcc"], \
+            prop["buffer_size"]
 
-    def get_frame(self, stream_only, is_test, flip_code):
-        """获取处理后的视频帧
+    def set_mode(self, stream_only, is_test, flip_code):
+        """更新运行模式, 下一帧生效
 
         Args:
             stream_only: 是否仅视频流模式
             is_test: 是否测试模式
             flip_code: 图像翻转代码
+        """
+        self.stream_only = stream_only
+        self.is_test = is_test
+        self.flip_code = flip_code
+
+    def passthrough_active(self):
+        """当前是否直通MJPG数据(此时由浏览器翻转图像)
 
         Returns:
-            bytes: JPEG格式的图像数据
+            bool
         """
-        ret, frame = self.video.read()  # 读取视频帧
-        frame = cv2.resize(frame, (frame_prop[0], frame_prop[1]))  # 调整帧大小
+        return self.passthrough and self.stream_only
 
-        # 根据flip_code进行图像翻转
-        if flip_code != "reset":
-            frame = cv2.flip(frame, int(flip_code))
+    def debug_active(self):
+        """当前是否有 /debug_feed 客户端(此时才生成概率图)
 
-        # 获取跟踪处理后的帧
-        frame = self.tracking.get_track_frame(ret, frame, stream_only, is_test)
-        ret, jpeg = cv2.imencode('1.jpg', frame)  # 将帧编码为JPEG格式
+        Returns:
+            bool
+        """
+        return self.debug_broadcaster.viewers > 0
+
+    def publish_debug(self, prob):
+        """广播一帧概率图, 没有概率图时不做任何事
+
+        Args:
+            prob: 概率图(单通道)或None
+        """
+        if prob is not None:
+            self.debug_broadcaster.publish(self.debug_cache.put(prob))
+
+    def telemetry_active(self):
+        """当前是否有 /telemetry 客户端(此时才生成遥测数据)
+
+        Returns:
+            bool
+        """
+        return self.telemetry_broadcaster.viewers > 0
+
+    def publish_telemetry(self, seq, data):
+        """广播一帧的遥测数据, 没有数据时不做任何事
+
+        Args:
+            seq: 该帧在帧缓存中的序号
+            data: Tracking.telemetry() 的结果或None
+        """
+        if data is not None:
+            data["seq"] = seq
+            data["flip_code"] = self.flip_code
+            self.telemetry_broadcaster.publish(json.dumps(data))
+
+    def apply_settings(self):
+        """在两帧之间应用重新加载的配置
+
+        配置文件修改后(或 /config/reload 之后)由采集线程(分阶段处理时为
+        跟踪线程)在处理下一帧之前调用, 不重启采集和处理线程。
+        """
+        settings.check_files()
+        pending = settings.apply_pending()
+        if pending is not None:
+            config, changed = pending
+            self.tracking.apply_settings(config, changed)
+            logger.info("settings generation {} applied: {}".format(
+                config.generation, sorted(changed)))
+
+    def _set_raw_mode(self, raw):
+        """切换驱动是否返回未解码数据, 与当前状态相同时不做任何事"""
+        if raw != self.raw_mode:
+            capture.set_raw_mode(self.video, raw)
+            self.raw_mode = raw
 
-        return jpeg.tostring()
+    def read_jpeg(self):
+        """读取一帧未解码的MJPG数据
+
+        驱动不返回JPEG数据时关闭直通, 之后按普通方式处理。
+
+        Returns:
+            bytes: JPEG数据, 读取失败或不支持直通时为None
+        """
+        self._set_raw_mode(True)
+        with STAGE_SECONDS.time("capture"):
+            ret, buf = self.video.read()
+        if not ret:
+            return None
+        if not capture.is_jpeg(buf):
+            logger.warning("capture does not return raw MJPG, "
+                           "passthrough disabled")
+            self.passthrough = False
+            self._set_raw_mode(False)
+            return None
+        return buf.tobytes()
+
+    def publish_jpeg(self):
+        """直通一帧MJPG数据: 不解码、不跟踪、不重新编码
+
+        Returns:
+            bool: 是否已广播
+        """
+        jpeg = self.read_jpeg()
+        if jpeg is None:
+            return False
+        self.broadcaster.publish(self.frame_cache.put_jpeg(jpeg))
+        return True
+
+    def start(self):
+        """启动后台采集线程或流水线(已启动时不做任何事)"""
+        if self.running:
+            return
+        self.running = True
+        if self.pipeline is not None:
+            self.pipeline.start()
+        else:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """停止后台采集线程或流水线"""
+        self.running = False
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        """后台线程: 每帧只采集、跟踪一次, 放入帧缓存后广播帧序号
+
+        JPEG编码由帧缓存在第一个请求该变体的客户端中完成。
+        仅流模式且可以直通时直接广播摄像头输出的JPEG数据。
+        """
+        logger.info("capture thread started")
+        while self.running:
+            try:
+                self.apply_settings()
+                if self.passthrough_active() and self.publish_jpeg():
+                    continue
+                frame, prob, data = self.get_frame(
+                    self.stream_only, self.is_test, self.flip_code,
+                    self.debug_active(), self.telemetry_active())
+            except Exception:
+                logger.exception("failed to get frame")
+                sleep(0.1)
+                continue
+            seq = self.frame_cache.put(frame)
+            self.broadcaster.publish(seq)
+            self.publish_debug(prob)
+            self.publish_telemetry(seq, data)
+        logger.info("capture thread stopped")
+
+    def stats(self):
+        """获取广播与帧缓存统计
+
+        Returns:
+            dict: 统计信息
+        """
+        stats = {
+            "capture": self.capture_prop,
+            "broadcaster": self.broadcaster.stats(),
+            "frame_cache": self.frame_cache.stats(),
+            "debug_broadcaster": self.debug_broadcaster.stats(),
+            "debug_cache": self.debug_cache.stats(),
+            "telemetry_broadcaster": self.telemetry_broadcaster.stats()
+        }
+        if self.pipeline is not None:
+            stats["pipeline"] = self.pipeline.stats()
+        if self.recorder is not None:
+            stats["recorder"] = self.recorder.stats()
+        arm = self.tracking.arm
+        if arm is not None:
+            if arm.controller is not None:
+                stats["motion"] = arm.controller.stats()
+            stats["gripper"] = arm.gripper.stats()
+        return stats
+
+    def collect_metrics(self):
+        """/metrics 的收集函数: 广播, 帧缓存, 流水线, 舵机和夹持器的计数
+
+        Returns:
+            list: (名称, 类型, 说明, [(标签, 值), ...])
+        """
+        broadcaster = self.broadcaster.stats()
+        cache = self.frame_cache.stats()
+        samples = [
+            ("mearm_viewers", "gauge", "Connected /video_feed clients.",
+             [({}, broadcaster["viewers"])]),
+            ("mearm_debug_viewers", "gauge", "Connected /debug_feed clients.",
+             [({}, self.debug_broadcaster.viewers)]),
+            ("mearm_telemetry_viewers", "gauge",
+             "Connected /telemetry clients.",
+             [({}, self.telemetry_broadcaster.viewers)]),
+            ("mearm_frames_published_total", "counter",
+             "Frames published to clients.",
+             [({}, broadcaster["published"])]),
+            ("mearm_frames_dropped_total", "counter",
+             "Frames skipped by clients that fell behind.",
+             [({}, broadcaster["dropped"])]),
+            ("mearm_frame_cache_total", "counter",
+             "JPEG cache lookups by result.",
+             [({"result": "hit"}, cache["hits"]),
+              ({"result": "miss"}, cache["misses"])]),
+            ("mearm_passthrough_frames_total", "counter",
+             "MJPG frames forwarded without decoding.",
+             [({}, cache["passthrough"])]),
+        ]
+        if self.pipeline is not None:
+            stages = self.pipeline.stats()
+            samples.append(
+                ("mearm_pipeline_drops_total", "counter",
+                 "Items overwritten in a stage input buffer.",
+                 [({"stage": name}, stage["drops"])
+                  for name, stage in stages.items() if "drops" in stage]))
+        samples.append(
+            ("mearm_color_model_locked", "gauge",
+             "1 while the target colour model is locked.",
+             [({}, int(self.tracking.tracking.color_model.locked))]))
+        arm = self.tracking.arm
+        if arm is None:
+            """ 机械臂尚未初始化(仅流模式下一直没有跟踪) """
+            return samples
+        backend = arm.my_mearm.backend or mearm.get_backend()
+        if hasattr(backend, "stats"):
+            servo = backend.stats()
+            samples.append(
+                ("mearm_servo_commands_total", "counter",
+                 "Servo commands by outcome.",
+                 [({"outcome": outcome}, servo[outcome])
+                  for outcome in ("sent", "suppressed", "deferred")]))
+        if arm.controller is not None:
+            samples.append(
+                ("mearm_motion_overruns_total", "counter",
+                 "Motion control ticks that overran their period.",
+                 [({}, arm.controller.overruns)]))
+        samples.append(("mearm_grips_total", "counter", "Grip cycles.",
+                        [({}, arm.gripper.grips)]))
+        return samples
+
+    def capture(self, flip_code):
+        """读取一帧并缩放、翻转
+
+        Args:
+            flip_code: 图像翻转代码
+
+        Returns:
+            tuple: (读取状态, 视频帧, 采集时刻)
+        """
+        self._set_raw_mode(False)  # 离开直通后恢复解码
+        with STAGE_SECONDS.time("capture"):
+            ret, frame = self.video.read()  # 读取视频帧
+        frame_time = timer()
+        with STAGE_SECONDS.time("resize_flip"):
+            # 驱动没有按 frame_prop 输出时才调整帧大小
+            if frame.shape[1] != frame_prop[0] or \
+                    frame.shape[0] != frame_prop[1]:
+                frame = cv2.resize(frame, (frame_prop[0], frame_prop[1]))
+
+            # 根据flip_code进行图像翻转
+            if flip_code != "reset":
+                frame = cv2.flip(frame, int(flip_code))
+        return ret, frame, frame_time
+
+    def get_frame(self, stream_only, is_test, flip_code, debug=False,
+                  telemetry=False):
+        """获取处理后的视频帧
+
+        Args:
+            stream_only: 是否仅视频流模式
+            is_test: 是否测试模式
+            flip_code: 图像翻转代码
+            debug: 是否生成概率图
+            telemetry: 是否生成遥测数据
+
+        Returns:
+            tuple: (处理后的视频帧, 概率图, 遥测数据), 不生成的项为None
+        """
+        ret, frame, frame_time = self.capture(flip_code)
+
+        # 获取跟踪处理后的帧
+        return self.tracking.track_frame(ret, frame, stream_only, is_test,
+                                         debug, telemetry, frame_time)
@@ -16,11 +16,18 @@
 #
 ###############################################################################
 
-import configparser
+from timeit import default_timer as timer
 
 import cv2
 import numpy as np
 
+import colorlut
+from colormodel import ColorModel
+from metrics import STAGE_SECONDS
+from predictor import WindowPredictor
+from searchregion import SearchRegion
+import settings
+
 
 class CamShift(object):
     """CamShift目标跟踪类"""
@@ -39,73 +46,153 @@ class CamShift(object):
         self.margin_window = margin_window  # 边界窗口
         # 设置终止条件
         self.term_crit = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 1)
+        # 颜色查找表(启用时代替HSV转换和阈值处理)
+        self.color_lut = colorlut.get_lut() if colorlut.color_lut else None
+        # 目标颜色模型(锁定时计算一次直方图)
+        if self.color_lut is not None:
+            self.color_model = ColorModel(self.color_lut.hue_bins,
+                                          hue_range=self.color_lut.hue_bins)
+        else:
+            self.color_model = ColorModel()
+        # 搜索区域(只处理上一帧跟踪窗口周围的区域)
+        self.search_region = SearchRegion(video_prop)
+        # 跟踪窗口的位置预测(起始窗口和延迟补偿)
+        self.predictor = WindowPredictor(video_prop)
+        # 是否输出概率图(/debug_feed 有客户端时由 Tracking 设置)
+        self.debug = False
+        # 是否在帧上绘制跟踪框(由 Tracking 设置)
+        self.draw = True
+        self.track_box = None  # 跟踪框的四个顶点(整帧坐标)
         self.target_color = target_color
         if self.target_color:
-            config = configparser.ConfigParser()
-            config.read('color.ini')
             # 在HSV色彩空间中定义颜色范围
-            self.lower_color = [
-                int(c) for c in config[target_color]['lower'].split(',')
-            ]  # 颜色下限
-            self.upper_color = [
-                int(c) for c in config[target_color]['upper'].split(',')
-            ]  # 颜色上限
-
-    def object_tracking(self, ret, frame):
+            self.lower_color, self.upper_color = settings.current().colors[
+                target_color]  # 颜色下限, 颜色上限
+
+    def apply_settings(self, config, changed, margin_window, track_window):
+        """应用重新加载的配置(在两帧之间调用)
+
+        Args:
+            config: settings.Settings
+            changed: 改变的项
+            margin_window: 重新计算的边界窗口
+            track_window: 重新计算的初始跟踪窗口
+        """
+        self.margin_window = margin_window
+        if track_window != self.init_track_window:
+            if self.track_window == self.init_track_window:
+                self.track_window = track_window
+            self.init_track_window = track_window
+        if self.target_color and "color." + self.target_color in changed:
+            self.lower_color, self.upper_color = config.colors[
+                self.target_color]
+            self.color_model.reset()
+        self.color_model.apply_settings(config)
+        self.search_region.apply_settings(config)
+        self.predictor.apply_settings(config)
+
+    def boxes(self):
+        """获取当前帧的跟踪框(客户端在画布上绘制)
+
+        Returns:
+            list: [(整帧坐标的顶点, BGR颜色, 线宽)]
+        """
+        if self.track_box is None:
+            return []
+        return [(self.track_box, (255, 0, 0), 2)]
+
+    def object_tracking(self, ret, frame, now=None):
         """执行目标跟踪
 
         Args:
             ret: 帧读取状态
             frame: 输入帧
+            now: 采集该帧的时刻(秒), 用于位置预测, 默认为当前时刻
 
         Returns:
-            tuple: (概率图, 处理后的帧, 当前跟踪窗口, 上一帧跟踪窗口)
+            tuple: (概率图, 处理后的帧, 当前跟踪窗口, 上一帧跟踪窗口),
+                   不输出概率图时第一项为None
         """
         # 开始目标跟踪
         if ret:
-            # 将图像转换到HSV色彩空间
-            hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-            if self.target_color:
-                # 根据设定的颜色范围进行阈值处理
-                mask = cv2.inRange(hsv,
-                                 np.array(self.lower_color),
-                                 np.array(self.upper_color))
+            # 跟踪窗口无效时(目标丢失)回到初始窗口
+            if self.track_window[2] <= 0 or self.track_window[3] <= 0:
+                self.track_window = self.init_track_window
+
+            # 锁定目标时从预测的窗口开始搜索
+            if now is None:
+                now = timer()
+            start_window = self.track_window
+            if self.color_model.locked:
+                start_window = self.predictor.predict_window(now) or \
+                    start_window
+
+            # 只在搜索区域内进行HSV转换、阈值处理和反向投影
+            rx, ry, rw, rh = self.search_region.region(
+                start_window, self.color_model.locked)
+            x, y, w, h = start_window
+            roi_window = (x - rx, y - ry, w, h)  # 搜索区域坐标系下的跟踪窗口
+
+            roi = frame[ry:ry + rh, rx:rx + rw]
+            start = timer()
+            if self.color_lut is not None:
+                # 查表得到色相柱图像和颜色掩码(不做HSV转换)
+                self.color_lut.refresh()
+                hsv, mask = self.color_lut.hue_mask(roi, self.target_color)
             else:
-                # 使用默认的颜色范围
-                mask = cv2.inRange(hsv,
-                                 np.array((0., 60., 32.)),
-                                 np.array((180., 255., 255.)))
-
-            # 提取跟踪窗口区域
-            x, y, w, h = self.track_window
-            hsv_roi = hsv[y:y + h, x:x + w]
-            mask_roi = mask[y:y + h, x:x + w]
-            # 计算直方图
-            hist = cv2.calcHist([hsv_roi], [0], mask_roi, [16], [0, 180])
-            cv2.normalize(hist, hist, 0, 255, cv2.NORM_MINMAX)
-            self.hist = hist.reshape(-1)
-
-            # 计算反向投影
-            prob = cv2.calcBackProject([hsv], [0], self.hist, [0, 180], 1)
-            prob &= mask
+                # 将图像转换到HSV色彩空间
+                hsv = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
+                if self.target_color:
+                    # 根据设定的颜色范围进行阈值处理
+                    mask = cv2.inRange(hsv,
+                                     np.array(self.lower_color),
+                                     np.array(self.upper_color))
+                else:
+                    # 使用默认的颜色范围
+                    mask = cv2.inRange(hsv,
+                                     np.array((0., 60., 32.)),
+                                     np.array((180., 255., 255.)))
+            STAGE_SECONDS.observe("hsv_mask", timer() - start)
+
+            # 锁定目标时计算一次直方图, 之后复用
+            with STAGE_SECONDS.time("backproject"):
+                if self.color_model.seed_requested:
+                    self.color_model.seed(hsv, mask, roi_window)
+
+                # 计算反向投影
+                prob = self.color_model.backproject(hsv, mask)
 
             # 保存应用CamShift之前的位置
             track_window0 = self.track_window
 
             # 应用CamShift算法获取新的位置
-            ret, self.track_window = cv2.CamShift(prob, self.track_window,
-                                                self.term_crit)
-            # 在图像上绘制跟踪框
-            pts = cv2.boxPoints(ret)
-            pts = np.int0(pts)
-            frame = cv2.polylines(frame, [pts], True, 255, 2)
+            with STAGE_SECONDS.time("camshift"):
+                ret, roi_window = cv2.CamShift(prob, roi_window,
+                                               self.term_crit)
+            # 根据新的跟踪窗口更新颜色模型
+            self.color_model.update(hsv, mask, roi_window, prob)
+
+            # 转换回整帧坐标, 并判断下一帧是否需要整帧搜索
+            x, y, w, h = roi_window
+            self.track_window = (x + rx, y + ry, w, h)
+            self.search_region.observe((rx, ry, rw, rh), track_window0,
+                                       self.track_window)
+            if self.color_model.locked:
+                self.predictor.update(self.track_window, now)
+            else:
+                self.predictor.reset()
 
-            """ 在图像上绘制边界框 """
-            xmin, ymin, xmax, ymax = self.margin_window
-            frame = cv2.rectangle(frame, (round(xmin), round(ymin)),
-                                (round(xmax), round(ymax)), (0, 0, 255), 1)
+            # 在图像上绘制跟踪框
+            (cx, cy), size, angle = ret
+            pts = cv2.boxPoints(((cx + rx, cy + ry), size, angle))
+            self.track_box = np.intp(pts)
+            if self.draw:
+                frame = cv2.polylines(frame, [self.track_box], True, 255, 2)
 
-            """ 将概率图转换为BGR格式 """
-            prob = cv2.cvtColor(prob, cv2.COLOR_GRAY2BGR)
+            """ 有调试客户端时才把搜索区域的概率图放回整帧(灰度) """
+            frame_prob = None
+            if self.debug:
+                frame_prob = np.zeros(frame.shape[:2], np.uint8)
+                frame_prob[ry:ry + rh, rx:rx + rw] = prob
 
-            return prob, frame, self.track_window, track_window0
+            return frame_prob, frame, self.track_window, track_window0
@@ -0,0 +1,119 @@
+# !/usr/bin/env python
+# coding: utf-8
+from logging import getLogger
+
+import cv2
+
+import settings
+
+logger = getLogger(__name__)
+
+""" 加载配置 """
+config = settings.current()
+frame_prop = config.camera.frame_prop  # 视频帧属性
+capture_device = config.camera.device  # 摄像头设备号
+capture_fourcc = config.camera.fourcc  # 采集格式
+capture_buffer_size = config.camera.buffer_size  # 驱动缓冲区数量
+capture_passthrough = config.camera.passthrough  # MJPG直通
+
+
+def decode_fourcc(value):
+    """把 CAP_PROP_FOURCC 的数值转换为4个字符
+
+    Args:
+        value: CAP_PROP_FOURCC 的值
+
+    Returns:
+        str: 例如 "MJPG"
+    """
+    value = int(value)
+    return "".join(chr((value >> 8 * i) & 0xFF) for i in range(4))
+
+
+def get_capture_prop(video):
+    """获取摄像头实际使用的属性
+
+    Args:
+        video: cv2.VideoCapture
+
+    Returns:
+        dict: width, height, fps, fourcc, buffer_size
+    """
+    return {
+        "width": int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        "fps": video.get(cv2.CAP_PROP_FPS),
+        "fourcc": decode_fourcc(video.get(cv2.CAP_PROP_FOURCC)),
+        "buffer_size": int(video.get(cv2.CAP_PROP_BUFFERSIZE))
+    }
+
+
+def set_raw_mode(video, raw):
+    """切换驱动输出是否解码
+
+    关闭 CAP_PROP_CONVERT_RGB 后, MJPG格式的摄像头直接返回压缩数据
+    (1 x N 的 uint8 数组), 不再解码为BGR图像。
+
+    Args:
+        video: cv2.VideoCapture
+        raw: True 返回未解码数据, False 返回BGR图像
+
+    Returns:
+        bool: 驱动是否接受
+    """
+    return video.set(cv2.CAP_PROP_CONVERT_RGB, 0 if raw else 1)
+
+
+def is_jpeg(buf):
+    """判断 read() 的结果是否为未解码的JPEG数据
+
+    Args:
+        buf: VideoCapture.read() 返回的数组
+
+    Returns:
+        bool: 以JPEG的SOI标记(FF D8)开头的一行数据时为True
+    """
+    return buf is not None and buf.ndim == 2 and buf.shape[0] == 1 and \
+        buf.shape[1] > 2 and buf[0, 0] == 0xFF and buf[0, 1] == 0xD8
+
+
+def open_capture(device=capture_device, frame_prop=frame_prop,
+                 fourcc=capture_fourcc, buffer_size=capture_buffer_size):
+    """打开摄像头并请求采集格式
+
+    直接向驱动请求分辨率、帧率、格式和缓冲区数量, 而不是每帧缩放。
+    驱动不一定全部接受, 实际使用的属性会写入日志并返回。
+
+    Args:
+        device: 设备号
+        frame_prop: 帧属性 (宽度, 高度, FPS)
+        fourcc: 采集格式, 例如 "MJPG" 或 "YUYV", 为空时使用驱动默认值
+        buffer_size: 驱动缓冲区数量, 越小延迟越低, 为0时使用驱动默认值
+
+    Returns:
+        tuple: (cv2.VideoCapture, 实际属性dict)
+    """
+    video = cv2.VideoCapture(device, cv2.CAP_V4L)  # 使用V4L驱动打开摄像头
+    """ 格式要在分辨率之前设置, 否则部分驱动会忽略分辨率 """
+    if fourcc:
+        video.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    video.set(cv2.CAP_PROP_FRAME_WIDTH, frame_prop[0])
+    video.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_prop[1])
+    video.set(cv2.CAP_PROP_FPS, frame_prop[2])
+    if buffer_size:
+        video.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+
+    granted = get_capture_prop(video)
+    requested = {
+        "width": frame_prop[0],
+        "height": frame_prop[1],
+        "fps": frame_prop[2],
+        "fourcc": fourcc or granted["fourcc"],
+        "buffer_size": buffer_size or granted["buffer_size"]
+    }
+    logger.info("capture requested:{} granted:{}".format(requested, granted))
+    for key, value in requested.items():
+        if granted[key] != value:
+            logger.warning("capture {} not granted: requested {} got {}".format(
+                key, value, granted[key]))
+    return video, granted
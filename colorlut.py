@@ -0,0 +1,204 @@
+# !/usr/bin/env python
+# coding: utf-8
+import hashlib
+import os
+import threading
+from logging import getLogger
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+
+import settings
+
+logger = getLogger(__name__)
+
+""" 加载配置 """
+config = settings.current()
+color_lut = config.tracking.color_lut  # 是否使用颜色查找表
+color_lut_bits = config.tracking.color_lut_bits  # 每通道量化位数
+color_lut_cache = config.tracking.color_lut_cache  # 查找表缓存目录
+
+""" 未指定目标颜色时使用的HSV范围 """
+DEFAULT_COLOR = ''
+DEFAULT_BOUNDS = ((0, 60, 32), (180, 255, 255))
+
+LUT_VERSION = 1  # 查找表格式版本, 改变构建方法时递增
+
+
+class ColorLUT(object):
+    """量化BGR → 颜色掩码查找表
+
+    把BGR每个通道量化为 bits 位, 对每个量化颜色预先计算:
+
+    * 属于 color.ini 中哪些颜色的位掩码(第 i 位对应 colors[i])
+    * 色相柱(0 到 hue_bins-1), 用于反向投影
+
+    每帧只需计算一次索引, 之后每个颜色的掩码和色相柱都只是一次查表,
+    不再需要HSV转换。查找表按颜色范围缓存到磁盘,
+    重新加载的配置改变颜色范围后自动重建。
+    """
+    def __init__(self, bits=color_lut_bits, hue_bins=16,
+                 cache_dir=color_lut_cache):
+        """初始化并构建(或从缓存加载)查找表
+
+        Args:
+            bits: 每个通道的量化位数(5: 32x32x32, 6: 64x64x64)
+            hue_bins: 色相柱数量, 与颜色模型的直方图柱数一致
+            cache_dir: 缓存目录, 为空时不缓存
+        """
+        self.bits = bits
+        self.hue_bins = hue_bins
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._source = None  # 构建查找表时的颜色配置
+        self.colors = []  # 颜色名称, 下标即位掩码中的位置
+        self.bounds = {}  # 颜色名称 -> (下限, 上限)
+        """ 把通道值量化为 bits 位的表, 以及组合索引的系数 """
+        self._quantize = (np.arange(256) >> (8 - bits)).astype(np.uint8)
+        self._weights = np.array([[1 << (2 * bits), 1 << bits, 1]],
+                                 np.float32)
+        self.load()
+
+    def _read_colors(self, config):
+        """读取颜色配置, 返回 (名称, 下限, 上限) 列表和缓存键的内容"""
+        colors = [(DEFAULT_COLOR, ) + DEFAULT_BOUNDS]
+        for name in config.color_names:
+            colors.append((name, ) + config.colors[name])
+        return colors, repr(colors).encode()
+
+    def load(self):
+        """构建查找表, 有缓存时直接加载"""
+        start = timer()
+        config = settings.current()
+        colors, content = self._read_colors(config)
+        key = hashlib.sha1(content + "{} {} {}".format(
+            self.bits, self.hue_bins, LUT_VERSION).encode()).hexdigest()
+        cache_file = os.path.join(self.cache_dir, "colorlut_{}.npz".format(
+            key)) if self.cache_dir else None
+
+        if cache_file and os.path.exists(cache_file):
+            data = np.load(cache_file)
+            color_bits, hue = data['color_bits'], data['hue']
+            source = "cache"
+        else:
+            color_bits, hue = self._build(colors)
+            source = "built"
+            if cache_file:
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    np.savez(cache_file, color_bits=color_bits, hue=hue)
+                except OSError:
+                    logger.warning("cannot write {}".format(cache_file))
+
+        """ 每个颜色的掩码表(0/255), 每帧直接查表得到掩码 """
+        masks = {}
+        for i, (name, lower, upper) in enumerate(colors):
+            masks[name] = np.where(color_bits >> i & 1, 255, 0).astype(
+                np.uint8)
+        with self._lock:
+            self.colors = [c[0] for c in colors]
+            self.bounds = {c[0]: (c[1], c[2]) for c in colors}
+            self.color_bits = color_bits
+            self.hue = hue
+            self.masks = masks
+            self._source = config.colors
+        logger.info("color lut {} ({} bits, {} colors) in {} ms".format(
+            source, self.bits, len(colors), round((timer() - start) * 1000)))
+
+    def _build(self, colors):
+        """计算每个量化颜色的位掩码和色相柱"""
+        levels = 1 << self.bits
+        step = 256 // levels
+        centres = (np.arange(levels) * step + step // 2).astype(np.uint8)
+        b, g, r = np.meshgrid(centres, centres, centres, indexing='ij')
+        bgr = np.stack([b.ravel(), g.ravel(), r.ravel()], axis=-1)
+        hsv = cv2.cvtColor(bgr.reshape(-1, 1, 3), cv2.COLOR_BGR2HSV)
+        hsv = hsv.reshape(-1, 3)
+
+        dtype = np.uint8 if len(colors) <= 8 else np.uint32
+        color_bits = np.zeros(len(hsv), dtype)
+        for i, (name, lower, upper) in enumerate(colors):
+            inside = np.all((hsv >= lower) & (hsv <= upper), axis=1)
+            color_bits |= (inside.astype(dtype) << i).astype(dtype)
+        hue = (hsv[:, 0].astype(np.int32) * self.hue_bins // 180).astype(
+            np.uint8)
+        return color_bits, hue
+
+    def refresh(self):
+        """重新加载的配置改变颜色范围后重建查找表
+
+        Returns:
+            bool: 是否重建
+        """
+        colors = settings.current().colors
+        if colors is self._source or colors == self._source:
+            self._source = colors
+            return False
+        logger.info("colors changed, rebuilding color lut")
+        self.load()
+        return True
+
+    def index(self, frame):
+        """计算每个像素的查找表索引
+
+        Args:
+            frame: BGR图像
+
+        Returns:
+            索引图像
+        """
+        quantized = cv2.LUT(frame, self._quantize)
+        if self.bits <= 5:
+            """ 索引不超过 2^15, 可以直接用 uint16 计算 """
+            return cv2.transform(quantized.astype(np.uint16), self._weights)
+        index = cv2.transform(quantized.astype(np.float32), self._weights)
+        return index.astype(np.int32)
+
+    def hue_mask(self, frame, color=DEFAULT_COLOR, index=None):
+        """查表得到色相柱图像和颜色掩码, 代替HSV转换与 inRange
+
+        Args:
+            frame: BGR图像
+            color: 颜色名称
+            index: 已计算的索引(多个颜色共享时传入)
+
+        Returns:
+            tuple: (色相柱图像, 颜色掩码)
+        """
+        if index is None:
+            index = self.index(frame)
+        with self._lock:
+            hue, mask = self.hue, self.masks[color]
+        return hue.take(index), mask.take(index)
+
+    def color_bits_of(self, frame, index=None):
+        """查表得到每个像素属于哪些颜色的位掩码
+
+        Args:
+            frame: BGR图像
+            index: 已计算的索引
+
+        Returns:
+            位掩码图像, 第 i 位对应 colors[i]
+        """
+        if index is None:
+            index = self.index(frame)
+        return self.color_bits.take(index)
+
+
+_shared_lut = None
+_shared_lut_lock = threading.Lock()
+
+
+def get_lut():
+    """获取共享的查找表, 第一次调用时构建
+
+    Returns:
+        ColorLUT
+    """
+    global _shared_lut
+    with _shared_lut_lock:
+        if _shared_lut is None:
+            _shared_lut = ColorLUT()
+    return _shared_lut
@@ -0,0 +1,159 @@
+# !/usr/bin/env python
+# coding: utf-8
+from logging import getLogger
+
+import cv2
+
+import settings
+
+logger = getLogger(__name__)
+
+""" 加载配置 """
+config = settings.current()
+hist_alpha = config.tracking.hist_alpha  # 直方图融合比例
+hist_min_confidence = config.tracking.hist_min_confidence  # 更新所需置信度
+hist_seed_fill = config.tracking.hist_seed_fill  # 锁定所需填充率
+
+
+class ColorModel(object):
+    """目标颜色模型
+
+    锁定目标时从跟踪窗口计算一次色相直方图, 之后保留并复用,
+    每帧只做反向投影。只有在置信度足够高时才按 alpha 比例融合新的直方图,
+    避免跟踪窗口偏移时模型漂移到背景上。
+
+    输入可以是HSV图像(色相范围0-180), 也可以是颜色查找表给出的
+    色相柱图像(色相范围0-bins)。
+    """
+    def __init__(self, bins=16, alpha=hist_alpha,
+                 min_confidence=hist_min_confidence, seed_fill=hist_seed_fill,
+                 hue_range=180):
+        """初始化颜色模型
+
+        Args:
+            bins: 色相直方图的柱数
+            alpha: 每帧融合新直方图的比例(0 表示锁定后不再更新)
+            min_confidence: 更新直方图所需的最低置信度(0-1)
+            seed_fill: 锁定目标所需的跟踪窗口内颜色掩码填充率(0-1)
+            hue_range: 输入图像第0通道的色相范围上限
+        """
+        self.bins = bins
+        self.hue_range = hue_range
+        self.alpha = alpha
+        self.min_confidence = min_confidence
+        self.seed_fill = seed_fill
+        self.hist = None  # 色相直方图, 锁定前为None
+        self.seed_requested = True  # 下一帧重新锁定
+        self.confidence = 0  # 最近一帧的置信度
+        self.locked = False  # 当前是否锁定
+        self.lost_count = 0  # 失去锁定的次数
+
+    def reseed(self):
+        """请求在下一帧从当前跟踪窗口重新计算直方图"""
+        self.seed_requested = True
+
+    def reset(self):
+        """丢弃直方图(目标颜色范围改变时), 下一帧重新锁定"""
+        self.hist = None
+        self.locked = False
+        self.seed_requested = True
+
+    def apply_settings(self, config):
+        """应用重新加载的配置
+
+        Args:
+            config: settings.Settings
+        """
+        self.alpha = config.tracking.hist_alpha
+        self.min_confidence = config.tracking.hist_min_confidence
+        self.seed_fill = config.tracking.hist_seed_fill
+
+    def _calc_hist(self, hsv, mask, window):
+        """计算跟踪窗口内的归一化色相直方图"""
+        x, y, w, h = window
+        hsv_roi = hsv[y:y + h, x:x + w]
+        mask_roi = mask[y:y + h, x:x + w]
+        hist = cv2.calcHist([hsv_roi], [0], mask_roi, [self.bins],
+                            [0, self.hue_range])
+        cv2.normalize(hist, hist, 0, 255, cv2.NORM_MINMAX)
+        return hist.reshape(-1)
+
+    def seed(self, hsv, mask, window):
+        """锁定目标: 跟踪窗口内颜色足够多时计算直方图
+
+        Args:
+            hsv: HSV图像或色相柱图像
+            mask: 颜色掩码
+            window: 跟踪窗口 (x, y, w, h)
+
+        Returns:
+            bool: 是否已锁定
+        """
+        x, y, w, h = window
+        mask_roi = mask[y:y + h, x:x + w]
+        if mask_roi.size == 0 or \
+                cv2.countNonZero(mask_roi) < self.seed_fill * mask_roi.size:
+            return False
+        self.hist = self._calc_hist(hsv, mask, window)
+        self.seed_requested = False
+        self.locked = True
+        logger.info("color model seeded at {}".format(window))
+        return True
+
+    def backproject(self, hsv, mask):
+        """计算反向投影
+
+        锁定前直接使用颜色掩码作为概率图。
+
+        Args:
+            hsv: HSV图像或色相柱图像
+            mask: 颜色掩码
+
+        Returns:
+            概率图
+        """
+        if self.hist is None:
+            return mask.copy()
+        prob = cv2.calcBackProject([hsv], [0], self.hist,
+                                   [0, self.hue_range], 1)
+        prob &= mask
+        return prob
+
+    def update(self, hsv, mask, window, prob):
+        """根据新的跟踪窗口更新置信度, 置信度足够时融合直方图
+
+        置信度为跟踪窗口内非零概率的平均值(0-1),
+        非零像素少于窗口面积的 5% 时视为0(目标丢失)。
+
+        Args:
+            hsv: HSV图像或色相柱图像
+            mask: 颜色掩码
+            window: 新的跟踪窗口 (x, y, w, h)
+            prob: 概率图
+
+        Returns:
+            float: 置信度
+        """
+        x, y, w, h = window
+        prob_roi = prob[y:y + h, x:x + w]
+        if self.hist is None or prob_roi.size == 0:
+            self.confidence = 0
+            return self.confidence
+        count = cv2.countNonZero(prob_roi)
+        if count < 0.05 * prob_roi.size:
+            self.confidence = 0
+        else:
+            self.confidence = cv2.sumElems(prob_roi)[0] / (255 * count)
+        if self.confidence < self.min_confidence:
+            if self.locked:
+                self.locked = False
+                self.lost_count += 1
+                logger.debug("color model lost lock at {} confidence:{}".format(
+                    window, round(self.confidence, 3)))
+            return self.confidence
+        self.locked = True
+        if self.alpha > 0:
+            hist = self._calc_hist(hsv, mask, window)
+            cv2.addWeighted(self.hist, 1 - self.alpha, hist, self.alpha, 0,
+                            dst=self.hist)
+        return self.confidence
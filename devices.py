@@ -0,0 +1,142 @@
+# !/usr/bin/env python
+# coding: utf-8
+"""摄像头和机械臂的共享实例
+
+导入时不打开任何设备: 摄像头在第一个客户端请求时打开, 机械臂
+(舵机后端连接, 控制线程, 夹持器线程, 回中位)在第一次需要时初始化。
+之后在客户端连接之间一直保持打开, 刷新页面或重新连接视频流时
+直接订阅正在运行的采集线程, 跟踪状态和舵机位置不变。
+
+进程退出时(atexit, Ctrl-C 或 SIGTERM)按顺序关闭:
+采集/跟踪线程 → 摄像头 → 控制线程和夹持器 → 舵机后端(发送推迟的命令后断开)。
+"""
+import atexit
+import threading
+from logging import getLogger
+from timeit import default_timer as timer
+
+import mearm
+import mearmlib
+from camera import VideoCamera
+
+logger = getLogger(__name__)
+
+
+class DeviceManager(object):
+    """按需打开并保持摄像头和机械臂"""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._camera = None  # VideoCamera, 打开前为None
+        self._arm = None  # mearmlib.MearmMove, 初始化前为None
+        self._atexit = False  # 是否已注册退出时关闭
+        self.closed = False
+        self.open_time = {}  # 设备名称 -> 打开耗时(秒)
+        self.requests = 0  # 获取摄像头的次数(重新连接也计入)
+
+    def _opened(self, name, start):
+        """记录打开耗时, 第一次打开设备时注册退出时关闭"""
+        self.open_time[name] = timer() - start
+        logger.info("{} opened in {} ms".format(
+            name, round(self.open_time[name] * 1000)))
+        if not self._atexit:
+            atexit.register(self.shutdown)
+            self._atexit = True
+
+    def arm(self, is_test=False, frame_prop=None):
+        """获取机械臂控制实例, 第一次调用时初始化
+
+        Args:
+            is_test: 是否测试模式
+            frame_prop: 帧属性 (宽度, 高度, FPS), 使用逆运动学查找表时需要
+
+        Returns:
+            mearmlib.MearmMove
+        """
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("devices are shut down")
+            if self._arm is None:
+                start = timer()
+                self._arm = mearmlib.MearmMove(is_test, frame_prop)
+                self._opened("arm", start)
+            return self._arm
+
+    def camera(self, algorithm, target_color, stream_only, is_test,
+               flip_code="reset", pipeline="serial"):
+        """获取摄像头实例, 第一次调用时打开并启动采集线程
+
+        参数只在第一次调用时使用, 之后的模式由 VideoCamera.set_mode 改变。
+
+        Args:
+            algorithm: 跟踪算法名称
+            target_color: 目标颜色
+            stream_only: 是否仅视频流模式
+            is_test: 是否测试模式
+            flip_code: 图像翻转代码
+            pipeline: 处理方式, "serial" 或 "staged"
+
+        Returns:
+            VideoCamera
+        """
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("devices are shut down")
+            self.requests += 1
+            if self._camera is None:
+                start = timer()
+                self._camera = VideoCamera(algorithm, target_color,
+                                           stream_only, is_test, flip_code,
+                                           pipeline, get_arm=self.arm)
+                self._camera.start()
+                self._opened("camera", start)
+            return self._camera
+
+    @property
+    def opened_camera(self):
+        """已打开的摄像头实例, 未打开时为None(不会打开摄像头)"""
+        return self._camera
+
+    def shutdown(self):
+        """关闭所有设备(可以重复调用)"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            camera, self._camera = self._camera, None
+        if camera is not None:
+            logger.info("closing camera")
+            camera.close()
+        with self._lock:
+            arm, self._arm = self._arm, None
+        if arm is not None:
+            logger.info("stopping arm control")
+            arm.close()
+        if mearm.backend is not None:
+            logger.info("closing servo backend")
+            mearm.backend.close()
+
+    def stats(self):
+        """获取设备状态
+
+        Returns:
+            dict: 是否打开, 打开耗时和获取次数
+        """
+        return {
+            "camera_open": self._camera is not None,
+            "arm_open": self._arm is not None,
+            "open_ms": {name: round(seconds * 1000, 1)
+                        for name, seconds in self.open_time.items()},
+            "requests": self.requests
+        }
+
+
+_manager = DeviceManager()
+
+
+def get_manager():
+    """获取共享的设备管理器
+
+    Returns:
+        DeviceManager
+    """
+    return _manager
@@ -0,0 +1,175 @@
+# !/usr/bin/env python
+# coding: utf-8
+import threading
+from collections import namedtuple
+
+import cv2
+
+from metrics import STAGE_SECONDS
+
+""" 输出帧的变体: JPEG质量, 缩放比例 """
+FrameVariant = namedtuple('FrameVariant', ['quality', 'scale'])
+DEFAULT_VARIANT = FrameVariant(95, 1.0)  # 95 为 OpenCV 默认JPEG质量
+
+FRAME_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+FRAME_TRAILER = b'\r\n\r\n'
+
+
+class _CacheEntry(object):
+    """缓存条目: 编码完成前其他客户端在 ready 上等待"""
+    __slots__ = ('chunk', 'ready')
+
+    def __init__(self):
+        self.chunk = None
+        self.ready = threading.Event()
+
+
+class FrameCache(object):
+    """JPEG帧缓存
+
+    以 (帧序号, 变体) 为键, 每个变体每帧只编码一次。
+    所有订阅同一变体的客户端共享同一个 bytes 对象(已包含 multipart 头)。
+    新帧到达时淘汰旧帧的所有条目。
+    直通的JPEG数据不区分变体, 所有客户端共享同一个块。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = 0  # 当前帧序号
+        self._frame = None  # 当前帧
+        self._jpeg_chunk = None  # 直通帧的 multipart 块
+        self._entries = {}  # (帧序号, 变体) -> _CacheEntry
+        self.hits = 0  # 命中次数
+        self.misses = 0  # 未命中(编码)次数
+        self.evicted = 0  # 淘汰条目数
+        self.passthrough = 0  # 直通帧数
+
+    def put(self, frame):
+        """放入新帧并淘汰旧条目
+
+        Args:
+            frame: 跟踪后的帧(BGR), 或概率图(单通道, 编码为灰度JPEG)
+
+        Returns:
+            int: 新帧序号
+        """
+        with self._lock:
+            self._seq += 1
+            self._frame = frame
+            self._jpeg_chunk = None
+            self.evicted += len(self._entries)
+            self._entries = {}
+            return self._seq
+
+    def put_jpeg(self, jpeg):
+        """放入摄像头输出的JPEG数据(直通, 不解码也不重新编码)
+
+        Args:
+            jpeg: JPEG数据
+
+        Returns:
+            int: 新帧序号
+        """
+        chunk = FRAME_HEADER + jpeg + FRAME_TRAILER
+        with self._lock:
+            self._seq += 1
+            self._frame = None
+            self._jpeg_chunk = chunk
+            self.evicted += len(self._entries)
+            self._entries = {}
+            self.passthrough += 1
+            return self._seq
+
+    def get(self, variant=DEFAULT_VARIANT):
+        """获取当前帧指定变体的 multipart 块
+
+        Args:
+            variant: FrameVariant
+
+        Returns:
+            tuple: (帧序号, multipart块bytes)，尚无帧或编码失败时块为None
+        """
+        with self._lock:
+            seq = self._seq
+            if self._jpeg_chunk is not None:
+                return seq, self._jpeg_chunk
+            if self._frame is None:
+                return seq, None
+            key = (seq, variant)
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _CacheEntry()
+                self._entries[key] = entry
+                self.misses += 1
+                owner = True
+            else:
+                self.hits += 1
+                owner = False
+            frame = self._frame
+
+        if owner:
+            try:
+                entry.chunk = FRAME_HEADER + encode(frame,
+                                                    variant) + FRAME_TRAILER
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+        return seq, entry.chunk
+
+    def peek(self, variant=DEFAULT_VARIANT):
+        """不等待地获取当前帧指定变体的 multipart 块
+
+        只返回直通帧或已编码完成的条目, 不编码也不阻塞,
+        供事件循环中的客户端使用(取不到时再在线程中调用 get)。
+
+        Args:
+            variant: FrameVariant
+
+        Returns:
+            tuple: (帧序号, multipart块bytes)，尚未编码时块为None
+        """
+        with self._lock:
+            seq = self._seq
+            if self._jpeg_chunk is not None:
+                return seq, self._jpeg_chunk
+            entry = self._entries.get((seq, variant))
+            if entry is None or not entry.ready.is_set():
+                return seq, None
+            self.hits += 1
+            return seq, entry.chunk
+
+    def stats(self):
+        """获取缓存统计
+
+        Returns:
+            dict: 命中、未命中、淘汰次数, 当前条目数及直通帧数
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "entries": len(self._entries),
+                "passthrough": self.passthrough
+            }
+
+
+def encode(frame, variant):
+    """按变体缩放并编码JPEG
+
+    单通道的帧(概率图)编码为灰度JPEG, 数据量约为彩色的三分之一。
+
+    Args:
+        frame: 跟踪后的帧或概率图
+        variant: FrameVariant
+
+    Returns:
+        bytes: JPEG数据
+    """
+    with STAGE_SECONDS.time("encode"):
+        if variant.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=variant.scale,
+                               fy=variant.scale, interpolation=cv2.INTER_AREA)
+        ret, jpeg = cv2.imencode(
+            '.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), variant.quality])
+        return jpeg.tobytes()
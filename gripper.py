@@ -0,0 +1,152 @@
+# !/usr/bin/env python
+# coding: utf-8
+import queue
+import threading
+from logging import getLogger
+from timeit import default_timer as timer
+
+logger = getLogger(__name__)
+
+""" 夹持器状态 """
+IDLE = 'idle'
+CLOSING = 'closing'
+CLOSED = 'closed'
+OPENING = 'opening'
+
+""" 命令 """
+GRIP = 'grip'
+STOP = 'stop'
+
+
+class GripWorker(object):
+    """夹持器控制线程
+
+    只有一个常驻线程, 从命令队列接收夹持请求, 按状态机
+    idle → closing → closed → opening → idle 动作, 状态切换由
+    队列等待的超时驱动, 不在线程中 sleep。
+    视觉部分调用 request() 只是放入队列, 不会阻塞也不会创建线程;
+    动作中或间隔内的请求不放入队列。
+    """
+    def __init__(self, arm, interval=2.0, close_angle=60, open_angle=30,
+                 close_time=0.2, hold_time=0.0, open_time=0.2, clock=timer):
+        """初始化(不启动线程)
+
+        Args:
+            arm: mearm.MeArm
+            interval: 两次夹持之间的最短间隔(秒)
+            close_angle: 闭合角度
+            open_angle: 张开角度
+            close_time: 闭合动作时间(秒)
+            hold_time: 保持闭合的时间(秒)
+            open_time: 张开动作时间(秒)
+            clock: 时钟函数
+        """
+        self.arm = arm
+        self.interval = interval
+        self.close_angle = close_angle
+        self.open_angle = open_angle
+        self.close_time = close_time
+        self.hold_time = hold_time
+        self.open_time = open_time
+        self.clock = clock
+        self.queue = queue.Queue(maxsize=8)
+        self.state = IDLE
+        self.deadline = None  # 当前状态结束的时刻
+        self.last_grip = clock()  # 上一次开始夹持的时刻(启动后也要等待)
+        self.is_test = False  # 当前动作是否为测试模式(不动舵机)
+        self.thread = None
+        self.grips = 0  # 夹持次数
+        self.dropped = 0  # 队列已满而丢弃的请求数
+        self.ignored = 0  # 动作中或间隔内而忽略的请求数
+
+    def request(self, is_test=False):
+        """请求夹持一次(不阻塞)
+
+        动作中或距上次夹持不足 interval 秒时请求被忽略(不放入队列)。
+
+        Args:
+            is_test: 是否测试模式
+        """
+        if self.state != IDLE or \
+                self.clock() - self.last_grip < self.interval:
+            self.ignored += 1
+            return
+        try:
+            self.queue.put_nowait((GRIP, is_test))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """启动线程(已启动时不做任何事)"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """停止线程"""
+        if self.thread is None:
+            return
+        self.queue.put((STOP, False))
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        """线程主循环: 等待命令, 或等到当前状态结束"""
+        while True:
+            timeout = None
+            if self.state != IDLE:
+                timeout = max(self.deadline - self.clock(), 0)
+            try:
+                command, is_test = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                command = None
+            if command == STOP:
+                break
+            now = self.clock()
+            if command == GRIP:
+                self._grip(now, is_test)
+            if self.state != IDLE and now >= self.deadline:
+                self._advance(now)
+
+    def _grip(self, now, is_test):
+        """空闲且距上次夹持超过 interval 秒时开始闭合"""
+        if self.state != IDLE:
+            return
+        if now - self.last_grip < self.interval:
+            return
+        self.last_grip = now
+        self.grips += 1
+        self.is_test = is_test
+        logger.info("!! grip close !!")
+        self._move(self.close_angle)
+        self._enter(CLOSING, now + self.close_time)
+
+    def _advance(self, now):
+        """当前状态结束, 进入下一个状态"""
+        if self.state == CLOSING:
+            self._enter(CLOSED, now + self.hold_time)
+        elif self.state == CLOSED:
+            logger.info("!! grip open !!")
+            self._move(self.open_angle)
+            self._enter(OPENING, now + self.open_time)
+        elif self.state == OPENING:
+            self._enter(IDLE, None)
+
+    def _enter(self, state, deadline):
+        logger.debug("grip {} -> {}".format(self.state, state))
+        self.state = state
+        self.deadline = deadline
+
+    def _move(self, angle):
+        if not self.is_test:
+            self.arm.move_to_grip(angle)
+
+    def stats(self):
+        """获取夹持器统计
+
+        Returns:
+            dict: 状态, 夹持次数, 丢弃和忽略的请求数
+        """
+        return {"state": self.state, "grips": self.grips,
+                "dropped": self.dropped, "ignored": self.ignored}
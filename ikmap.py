@@ -0,0 +1,191 @@
+# !/usr/bin/env python
+# coding: utf-8
+import hashlib
+import math
+import os
+from logging import getLogger
+from timeit import default_timer as timer
+
+import numpy as np
+
+import mearm
+import settings
+
+logger = getLogger(__name__)
+
+""" 加载配置 """
+config = settings.current()
+ik = config.mearm.ik  # 是否使用逆运动学查找表
+camera_fov = config.mearm.camera_fov  # 摄像头视场角(度)
+ik_gain = config.mearm.ik_gain  # 每次命令移动的比例
+ik_deadband = config.mearm.ik_deadband  # 中心死区(帧大小比例)
+ik_reach_gain = config.mearm.ik_reach_gain  # 距离增益(度/倍)
+ik_step = config.mearm.ik_step  # 查找表的像素间隔
+ik_cache = config.mearm.ik_cache  # 查找表缓存目录
+back_arm_ratio = config.tracking.back_arm_ratio  # 后退臂比例
+forward_arm_ratio = config.tracking.forward_arm_ratio  # 前进臂比例
+
+""" 改变后需要重建查找表的项 """
+IK_KEYS = {'mearm.camera_fov', 'mearm.ik_gain', 'mearm.ik_deadband',
+           'mearm.ik_reach_gain', 'mearm.ik_step', 'tracking.back_arm_ratio',
+           'tracking.forward_arm_ratio'}
+
+IK_VERSION = 2  # 查找表格式版本, 改变计算方法时递增
+RATIO_BINS = 33  # 跟踪区域比例的柱数(log2 比例在 -2 到 2 之间均分)
+RATIO_RANGE = 2.0
+JOINTS = ('lower', 'upper', 'base')
+
+
+def joint_limits(arm=None):
+    """各关节在 Servo.move_to_angle 安全限制内的角度范围
+
+    Args:
+        arm: mearm.MeArm, 默认按 MeArm 的舵机配置(不连接舵机)
+
+    Returns:
+        tuple: (下臂, 上臂, 底座) 的 (最小角度, 最大角度)
+    """
+    arm = arm or mearm.MeArm()
+    return tuple((getattr(arm, name).minAngle + mearm.safe_angle,
+                  getattr(arm, name).maxAngle - mearm.safe_angle)
+                 for name in JOINTS)
+
+
+class IKTable(object):
+    """图像位置 → 关节角度查找表
+
+    摄像头装在机械臂上, 目标在图像中的位置和大小对应各关节需要转动的角度:
+
+    * 底座: 目标中心的水平视角
+    * 上臂/下臂: 目标中心的垂直视角(与原来的控制相同, 上臂和下臂反向转动)
+    * 下臂: 跟踪区域比例(目标的远近), 只在后退/前进范围内移动
+
+    按 (x, y, 跟踪区域比例) 预先计算为密集的表(乘以 gain,
+    不超过各舵机的角度范围), 每帧只需一次查表: 加在拍摄该帧时的
+    关节位置上并限制在舵机的安全范围内, 得到一次 move_to_position
+    命令的绝对角度, 几帧内就能对准目标。查找表按参数缓存到磁盘。
+    """
+    def __init__(self, frame_size, fov=camera_fov, gain=ik_gain,
+                 deadband=ik_deadband, reach_gain=ik_reach_gain, step=ik_step,
+                 cache_dir=ik_cache, back_ratio=back_arm_ratio,
+                 forward_ratio=forward_arm_ratio, limits=None):
+        """初始化并构建(或从缓存加载)查找表
+
+        Args:
+            frame_size: 帧大小 (宽度, 高度)
+            fov: 摄像头视场角 (水平, 垂直), 单位度
+            gain: 每次命令移动的比例(0-1), 小于1可以抑制延迟引起的振荡
+            deadband: 中心死区, 目标中心偏离帧中心小于帧大小的该比例时不动
+            reach_gain: 跟踪区域比例每变化一倍时下臂转动的角度
+            step: 查找表的像素间隔
+            cache_dir: 缓存目录, 为空时不缓存
+            back_ratio: 后退的跟踪区域比例范围
+            forward_ratio: 前进的跟踪区域比例范围
+            limits: (下臂, 上臂, 底座) 的角度范围, 默认为 joint_limits()
+        """
+        self.frame_width, self.frame_height = frame_size[:2]
+        self.fov = fov
+        self.gain = gain
+        self.deadband = deadband
+        self.reach_gain = reach_gain
+        self.step = step
+        self.cache_dir = cache_dir
+        self.back_ratio = back_ratio
+        self.forward_ratio = forward_ratio
+        self.limits = tuple(tuple(limit)
+                            for limit in (limits or joint_limits()))
+        self.load()
+
+    def load(self):
+        """构建查找表, 有缓存时直接加载"""
+        start = timer()
+        params = "{} {} {} {} {} {} {} {} {} {} {}".format(
+            self.frame_width, self.frame_height, self.fov, self.gain,
+            self.deadband, self.reach_gain, self.step, self.back_ratio,
+            self.forward_ratio, self.limits, IK_VERSION)
+        key = hashlib.sha1(params.encode()).hexdigest()
+        cache_file = os.path.join(self.cache_dir, "ikmap_{}.npy".format(
+            key)) if self.cache_dir else None
+
+        if cache_file and os.path.exists(cache_file):
+            self.table = np.load(cache_file)
+            source = "cache"
+        else:
+            self.table = self._build()
+            source = "built"
+            if cache_file:
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    np.save(cache_file, self.table)
+                except OSError:
+                    logger.warning("cannot write {}".format(cache_file))
+        logger.info("ik table {} {} in {} ms".format(
+            source, self.table.shape[:3], round((timer() - start) * 1000)))
+
+    def _build(self):
+        """计算每个 (x, y, 比例) 的 (下臂, 上臂, 底座) 角度"""
+        width, height = self.frame_width, self.frame_height
+        """ 由视场角得到焦距(像素) """
+        fx = width / 2 / math.tan(math.radians(self.fov[0]) / 2)
+        fy = height / 2 / math.tan(math.radians(self.fov[1]) / 2)
+        xs = np.arange(0, width + self.step, self.step, dtype=np.float32)
+        ys = np.arange(0, height + self.step, self.step, dtype=np.float32)
+
+        pan = np.degrees(np.arctan((xs - width / 2) / fx))
+        pan[np.abs(xs - width / 2) < width * self.deadband] = 0
+        tilt = -np.degrees(np.arctan((ys - height / 2) / fy))  # 上方为正
+        tilt[np.abs(ys - height / 2) < height * self.deadband] = 0
+
+        log_ratio = np.linspace(-RATIO_RANGE, RATIO_RANGE, RATIO_BINS)
+        ratio = np.power(2, log_ratio)
+        """ 与原来的控制相同, 只在后退或前进范围内移动下臂,
+            范围之外(距离合适或跟踪可能失败)不动 """
+        reach = np.where(self._reach_ratio(ratio),
+                         self.reach_gain * log_ratio, 0)
+
+        table = np.zeros((len(xs), len(ys), RATIO_BINS, 3), np.float32)
+        table[..., 0] = -tilt[None, :, None] + reach[None, None, :]  # 下臂
+        table[..., 1] = tilt[None, :, None]  # 上臂
+        table[..., 2] = pan[:, None, None]  # 底座
+        table *= self.gain
+        """ 一次命令不超过各舵机的角度范围 """
+        for i, (low, high) in enumerate(self.limits):
+            np.clip(table[..., i], low - high, high - low,
+                    out=table[..., i])
+        return table
+
+    def _reach_ratio(self, ratio):
+        """跟踪区域比例是否在后退或前进范围内"""
+        return ((self.back_ratio[0] < ratio) & (ratio < self.back_ratio[1])) | \
+            ((self.forward_ratio[0] < ratio) & (ratio < self.forward_ratio[1]))
+
+    def lookup(self, track_window, track_area_ratio, position):
+        """查表得到各关节的目标角度
+
+        Args:
+            track_window: 跟踪窗口 (x, y, w, h)
+            track_area_ratio: 跟踪区域比例(目标区域与跟踪窗口的边长比)
+            position: 拍摄该帧时的 (下臂, 上臂, 底座) 角度
+
+        Returns:
+            tuple: (下臂, 上臂, 底座) 绝对角度(在舵机的安全范围内),
+                   不需要移动时为None
+        """
+        x, y, w, h = track_window
+        ix = min(max(int(round((x + w / 2) / self.step)), 0),
+                 self.table.shape[0] - 1)
+        iy = min(max(int(round((y + h / 2) / self.step)), 0),
+                 self.table.shape[1] - 1)
+        """ 范围之外按比例1(不移动下臂)查表, 不受分柱的量化影响 """
+        log_ratio = 0
+        if track_area_ratio > 0 and self._reach_ratio(track_area_ratio):
+            log_ratio = math.log2(track_area_ratio)
+        ir = int(round((log_ratio + RATIO_RANGE) / (2 * RATIO_RANGE) *
+                       (RATIO_BINS - 1)))
+        ir = min(max(ir, 0), RATIO_BINS - 1)
+        offset = self.table[ix, iy, ir]
+        if not offset.any():
+            return None
+        return tuple(min(max(float(angle + delta), low), high)
+                     for angle, delta, (low, high) in zip(
+                         position, offset, self.limits))
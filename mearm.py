@@ -6,22 +6,51 @@ https://groups.google.com/group/mearm/attach/18a4eb363ddaa/MeArmPiTechnicalOverv
 # coding: utf-8
 
 import math
-from logging import getLogger, basicConfig, DEBUG
+from contextlib import contextmanager
+from logging import getLogger
 
-import pigpio
+import servobackend
 
 logger = getLogger(__name__)
-basicConfig(
-    level=DEBUG, format="%(asctime)s %(levelname)s %(name)s :%(message)s")
 
-pi = pigpio.pi()
+backend = None  # 默认舵机后端, 第一次使用时创建
+
+
+def set_backend(new_backend):
+    """设置默认舵机后端
+
+    Args:
+        new_backend: servobackend 中的后端实例
+    """
+    global backend
+    backend = new_backend
+
+
+def get_backend():
+    """获取默认舵机后端, 未设置时使用 pigpio 后端(经过命令合并层)
+
+    Returns:
+        舵机后端
+    """
+    global backend
+    if backend is None:
+        backend = servobackend.CoalescingBackend(
+            servobackend.PigpioBackend())
+    return backend
+
+
+@contextmanager
+def _no_transaction():
+    """后端不支持合并时使用的空上下文"""
+    yield
+
 
 safe_angle = 25  # 安全角度限制
 
 
 class Servo:
     """舵机控制类"""
-    def __init__(self, config):
+    def __init__(self, config, backend=None):
         """初始化舵机参数
 
         Args:
@@ -31,7 +60,9 @@ class Servo:
                 max: 最大脉冲宽度
                 minAngle: 最小角度
                 maxAngle: 最大角度
+            backend: 舵机后端, 默认使用 get_backend()
         """
+        self.backend = backend  # 舵机后端
         self.currentAngle = None  # 当前角度
         self.pin = config['pin']  # GPIO引脚
         self.min = config['min']  # 最小脉冲宽度
@@ -75,12 +106,17 @@ class Servo:
             self.maxAngle - self.minAngle)) * (self.max - self.min)))
         logger.debug("更新舵机 当前角度:{} 引脚:{} 脉冲宽度:{}".format(
             self.currentAngle, self.pin, pulseWidth))
-        pi.set_servo_pulsewidth(self.pin, pulseWidth)
+        (self.backend or get_backend()).set_pulsewidth(self.pin, pulseWidth)
 
 
 class MeArm:
     """机械臂控制类"""
-    def __init__(self):
+    def __init__(self, backend=None):
+        """初始化各关节舵机
+
+        Args:
+            backend: 舵机后端, 默认使用 get_backend()
+        """
         # 参考: https://github.com/mimeindustries/mearm-js/blob/master/lib/MeArmPi.js
         # 从前面看 右边的舵机 - 控制下臂
         self.lower = Servo({
@@ -89,7 +125,7 @@ class MeArm:
             'max': 2400,
             'minAngle': 0,
             'maxAngle': 135
-        })
+        }, backend)
         # 从后面看 左边的舵机 - 控制上臂
         self.upper = Servo({
             'pin': 22,
@@ -97,7 +133,7 @@ class MeArm:
             'max': 2000,
             'minAngle': 0,
             'maxAngle': 135
-        })
+        }, backend)
         # 底座舵机 - 控制左右旋转
         self.base = Servo({
             'pin': 4,
@@ -105,7 +141,7 @@ class MeArm:
             'max': 2400,
             'minAngle': -90,
             'maxAngle': 90
-        })
+        }, backend)
         # 夹持器舵机
         self.grip = Servo({
             'pin': 10,
@@ -113,7 +149,20 @@ class MeArm:
             'max': 2400,
             'minAngle': 0,
             'maxAngle': 90
-        })
+        }, backend)
+
+        self.backend = backend
+
+    def transaction(self):
+        """把多个关节的写入合并为一次发送(后端支持时)
+
+        Returns:
+            上下文管理器
+        """
+        transaction = getattr(self.backend or get_backend(), 'transaction',
+                              None)
+        return transaction() if transaction is not None \
+            else _no_transaction()
 
     def move_to_base(self, angle):
         """移动底座到指定角度"""
@@ -128,10 +177,11 @@ class MeArm:
             base: 底座角度
             grip: 夹持器角度
         """
-        self.lower.move_to(lower)
-        self.upper.move_to(upper)
-        self.base.move_to(base)
-        self.grip.move_to(grip)
+        with self.transaction():
+            self.lower.move_to(lower)
+            self.upper.move_to(upper)
+            self.base.move_to(base)
+            self.grip.move_to(grip)
 
     def move_by_position(self, lower, upper, base):
         """按相对角度移动关节
@@ -141,9 +191,10 @@ class MeArm:
             upper: 上臂相对角度
             base: 底座相对角度
         """
-        self.lower.move_by(lower)
-        self.upper.move_by(upper)
-        self.base.move_by(base)
+        with self.transaction():
+            self.lower.move_by(lower)
+            self.upper.move_by(upper)
+            self.base.move_by(base)
 
     def move_by_base(self, angle):
         """底座按相对角度移动"""
@@ -163,7 +214,8 @@ class MeArm:
 
     def move_to_centres(self):
         """移动所有关节到中心位置"""
-        self.base.move_to_centre()
-        self.lower.move_to_centre()
-        self.upper.move_to_centre()
-        self.grip.move_to_centre()
+        with self.transaction():
+            self.base.move_to_centre()
+            self.lower.move_to_centre()
+            self.upper.move_to_centre()
+            self.grip.move_to_centre()
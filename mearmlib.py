@@ -1,42 +1,108 @@
 # !/usr/bin/env python
 # coding: utf-8
-import configparser
-import threading
-from logging import getLogger, basicConfig, INFO
-from time import time, sleep
+from logging import getLogger
+from timeit import default_timer as timer
+
+import gripper
+import ikmap
+import mearm
+import motioncontrol
+import servobackend
+import settings
 
 logger = getLogger(__name__)
-basicConfig(
-    level=INFO,
-    format="%(asctime)s %(levelname)s %(name)s %(funcName)s(): %(message)s")
 
-import mearm
+""" 加载配置 """
+config = settings.current()
+# 舵机后端设置(需要重启才生效)
+servo_backend = config.mearm.backend  # 舵机后端
+trace_file = config.mearm.trace_file  # 记录文件
+trace_forward = config.mearm.trace_forward  # 记录后端转发目标
+sim_slew_rate = config.mearm.sim_slew_rate  # 模拟舵机转速
+sim_latency = config.mearm.sim_latency  # 模拟命令延迟
+servo_max_rate = config.mearm.max_rate  # 每个舵机的最大命令频率
+motion_control = config.mearm.motion_control  # 是否使用控制线程
+
+
+def setup_backend(name=servo_backend):
+    """按配置创建舵机后端并设为默认后端
 
-""" 加载配置文件 """
-config = configparser.ConfigParser()
-config.read('config.ini')
-# 从配置文件读取机械臂各个关节的运动范围限制
-base_by = eval(config.get('mearm', 'base_by'))  # 底座旋转范围
-upper_by = eval(config.get('mearm', 'upper_by'))  # 上臂运动范围
-lower_by = eval(config.get('mearm', 'lower_by'))  # 下臂运动范围
-min_area = eval(config.get('tracking', 'min_area'))  # 最小跟踪区域
-back_arm_ratio = eval(config.get('tracking', 'back_arm_ratio'))  # 后退臂比例
-forward_arm_ratio = eval(config.get('tracking', 'forward_arm_ratio'))  # 前进臂比例
+    后端外面包一层 CoalescingBackend, 省略无变化的写入并限制命令频率。
+
+    Args:
+        name: 后端名称, 默认使用config.ini的设置
+    """
+    logger.info("servo backend: {}".format(name))
+    mearm.set_backend(
+        servobackend.CoalescingBackend(
+            servobackend.create_backend(name, trace_file, sim_slew_rate,
+                                        sim_latency, trace_forward),
+            servo_max_rate))
 
 
 class MearmMove(object):
     """机械臂运动控制类"""
-    def __init__(self, is_test):
+    def __init__(self, is_test, frame_prop=None):
+        """初始化机械臂
+
+        Args:
+            is_test: 是否测试模式
+            frame_prop: 帧属性 (宽度, 高度, FPS), 使用逆运动学查找表时需要
+        """
         self.is_test = is_test
-        self.time_now = time()  # 当前时间
-        self.time_old = time()  # 上一次时间
-        self.time_delta = 0  # 时间差
+        # 关节运动范围, 最小跟踪区域和前进/后退比例(重新加载时替换)
+        self.config = settings.current()
+        self.frame_prop = frame_prop
+        if mearm.backend is None:
+            setup_backend()
         self.my_mearm = mearm.MeArm()  # 初始化机械臂对象
         """ 首次更新当前角度 """
         self.my_mearm.move_to_centres()
-        # 创建夹持器控制线程
-        self.grip_t = threading.Thread(target=self._grip_mearm)
-        self.grip_t.start()
+        """ 控制线程: 视觉部分只更新设定值 """
+        self.controller = None
+        if motion_control:
+            self.controller = motioncontrol.MotionController(
+                self.my_mearm, max_velocity=self.config.mearm.max_velocity,
+                max_accel=self.config.mearm.max_accel)
+            self.controller.start()
+        """ 逆运动学查找表: 由目标在图像中的位置直接计算关节角度 """
+        self.ik = None
+        if ikmap.ik and frame_prop is not None:
+            self.ik = self._build_ik(self.config)
+        # 夹持器控制线程(常驻, 通过命令队列请求夹持)
+        self.gripper = gripper.GripWorker(self.my_mearm)
+        self.gripper.start()
+        # 最近一帧发出的命令 (种类, 下臂, 上臂, 底座), 没有命令时为None
+        self.last_command = None
+
+    def apply_settings(self, config, changed):
+        """应用重新加载的配置(在两帧之间调用)
+
+        Args:
+            config: settings.Settings
+            changed: 改变的项
+        """
+        self.config = config
+        if self.controller is not None:
+            self.controller.max_velocity = config.mearm.max_velocity
+            self.controller.max_accel = config.mearm.max_accel
+        if self.ik is not None and changed & ikmap.IK_KEYS:
+            self.ik = self._build_ik(config)
+
+    def _build_ik(self, config):
+        """按配置构建(或从缓存加载)逆运动学查找表"""
+        return ikmap.IKTable(
+            self.frame_prop, config.mearm.camera_fov, config.mearm.ik_gain,
+            config.mearm.ik_deadband, config.mearm.ik_reach_gain,
+            config.mearm.ik_step, ikmap.ik_cache,
+            config.tracking.back_arm_ratio, config.tracking.forward_arm_ratio,
+            ikmap.joint_limits(self.my_mearm))
+
+    def close(self):
+        """停止控制线程和夹持器线程(舵机保持当前位置)"""
+        if self.controller is not None:
+            self.controller.stop()
+        self.gripper.stop()
 
     def _calc_angle(self, mearm, move_ratio, track_area_ratio):
         """计算各关节运动角度
@@ -50,6 +116,9 @@ class MearmMove(object):
             计算后的角度值
         """
         angle = 0
+        base_by = self.config.mearm.base_by
+        upper_by = self.config.mearm.upper_by
+        lower_by = self.config.mearm.lower_by
         if mearm == "base":  # 底座旋转角度计算
             angle = round(self.my_mearm.base.maxAngle * move_ratio[0])
             if abs(angle) > base_by[1]:
@@ -79,6 +148,9 @@ class MearmMove(object):
         Returns:
             计算后的下臂角度
         """
+        back_arm_ratio = self.config.tracking.back_arm_ratio
+        forward_arm_ratio = self.config.tracking.forward_arm_ratio
+        lower_by = self.config.mearm.lower_by
         if back_arm_ratio[0] < track_area_ratio < back_arm_ratio[1]:
             return lower_by[0] * -1  # 后退
         elif forward_arm_ratio[0] < track_area_ratio < forward_arm_ratio[1]:
@@ -86,29 +158,6 @@ class MearmMove(object):
         else:
             logger.debug("当前位置合适{}".format(track_area_ratio))
 
-    def _grip_mearm(self):
-        """控制夹持器开合
-        当时间差超过2秒时执行夹持动作
-        """
-        self.time_now = time()
-        """ 更新时间差
-            当时间差超过2秒时开始夹持动作
-        """
-        self.time_delta = self.time_delta + (self.time_now - self.time_old)
-        if self.time_delta > 2:
-            logger.info(
-                "!! grip close !! time_delta:{}".format(self.time_delta))
-            if not self.is_test:
-                self.my_mearm.move_to_grip(60)
-            sleep(0.2)
-            logger.info(
-                "!! grip open !! time_delta:{}".format(self.time_delta))
-            if not self.is_test:
-                self.my_mearm.move_to_grip(30)
-            sleep(0.2)
-            self.time_delta = 0
-        self.time_old = self.time_now
-
     def _move_angles(self, *args):
         """移动机械臂到指定角度
 
@@ -119,11 +168,46 @@ class MearmMove(object):
         """
         logger.info("机械臂移动位置: 下臂 {} 上臂 {} 底座 {}".format(
             args[0], args[1], args[2]))
-        if not self.is_test:
+        self.last_command = ("move_by", args[0], args[1], args[2])
+        if self.is_test:
+            return
+        if self.controller is not None:
+            self.controller.move_by(args[0], args[1], args[2])
+        else:
             self.my_mearm.move_by_position(args[0], args[1], args[2])
 
+    def _move_to_target(self, track_window, track_area_ratio, frame_time):
+        """查逆运动学表, 用一次绝对位置命令移向目标
+
+        表中的角度加在拍摄该帧时的位置上, 并限制在舵机的安全范围内。
+
+        Args:
+            track_window: 跟踪窗口 (x, y, w, h)
+            track_area_ratio: 跟踪区域比例
+            frame_time: 拍摄该帧的时刻(秒)
+        """
+        if self.controller is not None:
+            position = self.controller.positions_at(frame_time)
+        else:
+            position = (self.my_mearm.lower.currentAngle,
+                        self.my_mearm.upper.currentAngle,
+                        self.my_mearm.base.currentAngle)
+        target = self.ik.lookup(track_window, track_area_ratio, position)
+        if target is None:
+            return
+        logger.info("机械臂目标位置: 下臂 {:.1f} 上臂 {:.1f} 底座 {:.1f}".format(
+            *target))
+        self.last_command = ("move_to", ) + target
+        if self.is_test:
+            return
+        if self.controller is not None:
+            self.controller.set_target(*target)
+        else:
+            self.my_mearm.move_to_position(target[0], target[1], target[2],
+                                           self.my_mearm.grip.currentAngle)
+
     def motion(self, track_window, track_area_ratio, move_ratio, margin_window,
-               is_test):
+               is_test, frame_time=None):
         """机械臂运动主控制函数
 
         Args:
@@ -132,8 +216,10 @@ class MearmMove(object):
             move_ratio: 移动比例
             margin_window: 边界窗口 (xmin, ymin, xmax, ymax)
             is_test: 是否测试模式
+            frame_time: 拍摄该帧的时刻(秒), 默认为当前时刻
         """
         self.is_test = is_test
+        self.last_command = None
         """ 获取窗口位置
             x, y, w, h: 当前跟踪窗口的位置
             xmin, ymin, xmax, ymax: 边界窗口的位置
@@ -141,6 +227,7 @@ class MearmMove(object):
         """
         x, y, w, h = track_window
         xmin, ymin, xmax, ymax = margin_window
+        min_area = self.config.tracking.min_area
         logger.debug(
             "track_window x, y, w, h:{}, margin_window m_x, m_y, m_w, m_h:{}".
             format(track_window, margin_window))
@@ -157,9 +244,12 @@ class MearmMove(object):
             return
         """ 当锁定目标时执行夹持动作 """
         if move_ratio == (0, 0):
-            if not self.grip_t.is_alive():
-                self.grip_t = threading.Thread(target=self._grip_mearm)
-                self.grip_t.start()
+            self.last_command = ("grip", 0, 0, 0)
+            self.gripper.request(self.is_test)
+            return
+        if self.ik is not None:
+            self._move_to_target(track_window, track_area_ratio,
+                                 timer() if frame_time is None else frame_time)
             return
         """ 初始化角度 """
         base_angle = 0
@@ -0,0 +1,169 @@
+# !/usr/bin/env python
+# coding: utf-8
+"""运行时指标
+
+热路径只做一次计时和一次直方图计数, 开销在微秒级, 可以一直启用。
+/metrics 以 Prometheus 文本格式输出:
+
+* mearm_stage_seconds: 各处理阶段耗时的直方图(按 stage 标签区分)
+* 各模块注册的收集函数给出的计数器和仪表(客户端数, 丢帧数等),
+  只在抓取时调用
+"""
+import bisect
+import threading
+from timeit import default_timer as timer
+
+""" 直方图的桶上限(秒) """
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2,
+                   0.5, 1.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    """按一个标签区分的累计直方图"""
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        """初始化直方图
+
+        Args:
+            name: 指标名称
+            help: 说明
+            label: 标签名称
+            buckets: 桶上限(升序)
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # 标签值 -> [各桶计数..., 总和, 总数]
+
+    def observe(self, value, seconds):
+        """记录一次观测
+
+        Args:
+            value: 标签值
+            seconds: 观测值(秒)
+        """
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def time(self, value):
+        """计时上下文
+
+        Example:
+            with STAGE_SECONDS.time("encode"):
+                ...
+
+        Args:
+            value: 标签值
+
+        Returns:
+            _Timer
+        """
+        return _Timer(self, value)
+
+    def render(self):
+        """输出 Prometheus 文本格式的行"""
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            series = {value: list(s) for value, s in self._series.items()}
+        for value in sorted(series):
+            counts = series[value]
+            label = '{}="{}"'.format(self.label, value)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, label, _format_bound(bound), cumulative))
+            lines.append("{}_sum{{{}}} {}".format(self.name, label,
+                                                   counts[-2]))
+            lines.append("{}_count{{{}}} {}".format(self.name, label,
+                                                     counts[-1]))
+        return lines
+
+
+class _Timer(object):
+    """Histogram.time() 返回的计时上下文"""
+    __slots__ = ('histogram', 'value', 'start')
+
+    def __init__(self, histogram, value):
+        self.histogram = histogram
+        self.value = value
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(self.value, timer() - self.start)
+        return False
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float('inf') else repr(bound)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v)
+                          for k, v in sorted(labels.items())) + "}"
+
+
+""" 各处理阶段的耗时 """
+STAGE_SECONDS = Histogram('mearm_stage_seconds',
+                          'Time spent in each processing stage.', 'stage')
+
+_collectors = []
+_collectors_lock = threading.Lock()
+
+
+def register_collector(collector):
+    """注册收集函数, 抓取时调用
+
+    收集函数返回 (名称, 类型, 说明, [(标签dict, 值), ...]) 的列表,
+    类型为 "counter" 或 "gauge"。
+
+    Args:
+        collector: 收集函数
+    """
+    with _collectors_lock:
+        _collectors.append(collector)
+
+
+def unregister_collector(collector):
+    """取消注册收集函数
+
+    Args:
+        collector: 收集函数
+    """
+    with _collectors_lock:
+        if collector in _collectors:
+            _collectors.remove(collector)
+
+
+def render():
+    """输出所有指标
+
+    Returns:
+        str: Prometheus 文本格式
+    """
+    lines = STAGE_SECONDS.render()
+    with _collectors_lock:
+        collectors = list(_collectors)
+    for collector in collectors:
+        for name, kind, help, samples in collector():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                lines.append("{}{} {}".format(name, _format_labels(labels),
+                                              value))
+    return "\n".join(lines) + "\n"
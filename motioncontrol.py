@@ -0,0 +1,240 @@
+# !/usr/bin/env python
+# coding: utf-8
+import math
+import threading
+from collections import deque
+from logging import getLogger
+from time import sleep
+from timeit import default_timer as timer
+
+import mearm
+import settings
+
+logger = getLogger(__name__)
+
+""" 加载配置 """
+config = settings.current()
+control_rate = config.mearm.control_rate  # 控制频率
+max_velocity = config.mearm.max_velocity  # 最大角速度
+max_accel = config.mearm.max_accel  # 最大角加速度
+
+JOINTS = ('lower', 'upper', 'base')
+
+
+class Joint(object):
+    """单个关节的插补状态(角度制)"""
+    def __init__(self, servo):
+        """初始化关节
+
+        Args:
+            servo: mearm.Servo
+        """
+        self.servo = servo
+        """ 设定值限制在 Servo.move_to_angle 的安全范围内 """
+        self.min_angle = servo.minAngle + mearm.safe_angle
+        self.max_angle = servo.maxAngle - mearm.safe_angle
+        self.position = self.clamp(servo.currentAngle
+                                   if servo.currentAngle is not None else
+                                   (servo.minAngle + servo.maxAngle) / 2)
+        self.setpoint = self.position
+        self.velocity = 0.0
+
+    def clamp(self, angle):
+        """把角度限制在安全范围内"""
+        return min(max(angle, self.min_angle), self.max_angle)
+
+    def step(self, dt, max_velocity, max_accel):
+        """向设定值移动一个控制周期
+
+        速度不超过 max_velocity, 也不超过能在剩余距离内以
+        max_accel 减速停下的速度; 速度变化不超过 max_accel * dt。
+
+        Args:
+            dt: 控制周期(秒)
+            max_velocity: 最大角速度(度/秒)
+            max_accel: 最大角加速度(度/秒^2)
+
+        Returns:
+            bool: 是否仍在移动
+        """
+        error = self.setpoint - self.position
+        if abs(error) < 1e-3 and abs(self.velocity) < max_accel * dt:
+            self.position = self.setpoint
+            self.velocity = 0.0
+            return False
+        target = math.copysign(
+            min(max_velocity, math.sqrt(2 * max_accel * abs(error))), error)
+        dv = max_accel * dt
+        self.velocity = min(max(target, self.velocity - dv),
+                            self.velocity + dv)
+        position = self.position + self.velocity * dt
+        """ 不越过设定值 """
+        if (self.setpoint - position) * error <= 0:
+            position = self.setpoint
+            self.velocity = 0.0
+        self.position = position
+        return True
+
+
+class MotionController(object):
+    """固定频率的机械臂运动控制线程
+
+    视觉部分只更新各关节的设定值, 控制线程按 rate 频率在速度和
+    加速度限制下插补, 把中间位置写入舵机。机械臂运动的平滑程度和
+    速度与跟踪的帧率无关。
+    """
+    def __init__(self, arm, rate=control_rate, max_velocity=max_velocity,
+                 max_accel=max_accel, clock=timer):
+        """初始化控制器(不启动线程)
+
+        Args:
+            arm: mearm.MeArm
+            rate: 控制频率(Hz)
+            max_velocity: 最大角速度(度/秒)
+            max_accel: 最大角加速度(度/秒^2)
+            clock: 时钟函数
+        """
+        self.arm = arm
+        self.period = 1.0 / rate
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        self.clock = clock
+        self.joints = {name: Joint(getattr(arm, name)) for name in JOINTS}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._history = deque(maxlen=int(rate))  # 最近一秒的 (时刻, 各关节位置)
+        self.thread = None
+        self.running = False
+        self.ticks = 0  # 写入舵机的周期数
+        self.overruns = 0  # 超过控制周期的次数
+
+    def set_target(self, lower=None, upper=None, base=None):
+        """设置各关节的绝对设定值(None 表示不变)
+
+        Args:
+            lower: 下臂角度
+            upper: 上臂角度
+            base: 底座角度
+        """
+        with self._lock:
+            for name, angle in zip(JOINTS, (lower, upper, base)):
+                if angle is not None:
+                    joint = self.joints[name]
+                    joint.setpoint = joint.clamp(angle)
+        self._wakeup.set()
+
+    def move_by(self, lower, upper, base):
+        """以各关节当前位置为基准设置相对设定值
+
+        以当前位置而不是上一个设定值为基准, 连续多帧的相同命令
+        不会累积, 避免帧率突增时越过目标。
+
+        Args:
+            lower: 下臂相对角度
+            upper: 上臂相对角度
+            base: 底座相对角度
+        """
+        with self._lock:
+            for name, angle in zip(JOINTS, (lower, upper, base)):
+                if angle:
+                    joint = self.joints[name]
+                    joint.setpoint = joint.clamp(joint.position + angle)
+        self._wakeup.set()
+
+    def positions_at(self, t):
+        """查询 t 时刻各关节的位置
+
+        摄像头装在机械臂上, 按图像计算的转动角度要加在拍摄该帧时的
+        位置上, 否则机械臂移动中的延迟会使同一偏差被重复计算。
+
+        Args:
+            t: 时刻(秒)
+
+        Returns:
+            tuple: (下臂, 上臂, 底座) 角度
+        """
+        with self._lock:
+            for time, positions in reversed(self._history):
+                if time <= t:
+                    return positions
+            return tuple(self.joints[name].position for name in JOINTS)
+
+    def tick(self, dt):
+        """执行一个控制周期, 有关节移动时一次写入所有关节
+
+        Args:
+            dt: 控制周期(秒)
+
+        Returns:
+            bool: 是否仍有关节在移动
+        """
+        with self._lock:
+            moving = [joint.step(dt, self.max_velocity, self.max_accel)
+                      for joint in self.joints.values()]
+            positions = [(joint.servo, joint.position)
+                         for joint in self.joints.values()]
+            if any(moving):
+                self._history.append(
+                    (self.clock(),
+                     tuple(self.joints[name].position for name in JOINTS)))
+        if any(moving):
+            with self.arm.transaction():
+                for servo, position in positions:
+                    servo.move_to(position)
+            self.ticks += 1
+        return any(moving)
+
+    def start(self):
+        """启动控制线程(已启动时不做任何事)"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """停止控制线程"""
+        self.running = False
+        self._wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        """控制线程主循环: 移动时按固定周期运行, 静止时等待新的设定值"""
+        logger.info("motion control started at {} Hz".format(
+            round(1 / self.period)))
+        deadline = self.clock()
+        while self.running:
+            if not self.tick(self.period):
+                self._wakeup.wait()
+                self._wakeup.clear()
+                deadline = self.clock()
+                continue
+            deadline += self.period
+            delay = deadline - self.clock()
+            if delay > 0:
+                sleep(delay)
+            else:
+                """ 超时后不追赶, 从当前时刻重新计时 """
+                self.overruns += 1
+                deadline = self.clock()
+        logger.info("motion control stopped")
+
+    def stats(self):
+        """获取控制器统计
+
+        Returns:
+            dict: 周期数, 超时次数, 各关节的位置/设定值/速度
+        """
+        with self._lock:
+            joints = {
+                name: {
+                    "position": round(joint.position, 2),
+                    "setpoint": round(joint.setpoint, 2),
+                    "velocity": round(joint.velocity, 2)
+                }
+                for name, joint in self.joints.items()
+            }
+        return {"ticks": self.ticks, "overruns": self.overruns,
+                "joints": joints}
@@ -0,0 +1,313 @@
+# !/usr/bin/env python
+# coding: utf-8
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+
+import colorlut
+from colormodel import ColorModel
+from metrics import STAGE_SECONDS
+from predictor import WindowPredictor
+from searchregion import SearchRegion
+import settings
+
+
+class Target(object):
+    """单个跟踪目标的状态
+
+    每个颜色一个, 只保存跟踪窗口、颜色模型和搜索区域,
+    HSV转换(或查找表索引)由 MultiTracker 在所有目标之间共享。
+    """
+    def __init__(self, color, priority, lower, upper, track_window,
+                 frame_size, color_lut=None):
+        """初始化目标
+
+        Args:
+            color: 颜色名称
+            priority: 优先级(数字越小越优先)
+            lower: HSV下限
+            upper: HSV上限
+            track_window: 初始跟踪窗口
+            frame_size: 帧大小 (宽度, 高度)
+            color_lut: 颜色查找表(不使用时为None)
+        """
+        self.color = color
+        self.priority = priority
+        self.set_bounds(lower, upper)
+        self.init_track_window = track_window
+        self.track_window = track_window
+        self.track_window0 = track_window
+        self.box = None  # CamShift 的旋转矩形(整帧坐标)
+        if color_lut is not None:
+            self.color_model = ColorModel(color_lut.hue_bins,
+                                          hue_range=color_lut.hue_bins)
+        else:
+            self.color_model = ColorModel()
+        self.search_region = SearchRegion(frame_size)
+        self.predictor = WindowPredictor(frame_size)
+        self.start_window = track_window  # 本帧的起始窗口
+
+    def set_bounds(self, lower, upper):
+        """设置HSV范围和绘制用的颜色
+
+        Args:
+            lower: HSV下限
+            upper: HSV上限
+        """
+        self.lower = np.array(lower)
+        self.upper = np.array(upper)
+        """ 绘制用的颜色: HSV范围中间值 """
+        hsv = np.uint8([[[(l + u) // 2 for l, u in zip(lower, upper)]]])
+        self.draw_color = tuple(
+            int(c) for c in cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0])
+
+    def apply_settings(self, config, changed, track_window):
+        """应用重新加载的配置
+
+        Args:
+            config: settings.Settings
+            changed: 改变的项
+            track_window: 重新计算的初始跟踪窗口
+        """
+        if track_window != self.init_track_window:
+            if self.track_window == self.init_track_window:
+                self.track_window = track_window
+            self.init_track_window = track_window
+        if "color." + self.color in changed:
+            self.set_bounds(*config.colors[self.color])
+            self.color_model.reset()
+        self.color_model.apply_settings(config)
+        self.search_region.apply_settings(config)
+        self.predictor.apply_settings(config)
+
+    def region(self, now):
+        """计算本帧的起始窗口和搜索区域
+
+        跟踪窗口无效时先回到初始窗口, 锁定目标时从预测的窗口开始搜索。
+
+        Args:
+            now: 本帧时刻(秒)
+        """
+        if self.track_window[2] <= 0 or self.track_window[3] <= 0:
+            self.track_window = self.init_track_window
+        self.start_window = self.track_window
+        if self.color_model.locked:
+            self.start_window = self.predictor.predict_window(now) or \
+                self.start_window
+        return self.search_region.region(self.start_window,
+                                         self.color_model.locked)
+
+    def track(self, hsv, mask, region, term_crit, camshift=True, now=None):
+        """在搜索区域内执行一次 CamShift/meanShift
+
+        Args:
+            hsv: 搜索区域的HSV图像(或色相柱图像)
+            mask: 搜索区域的颜色掩码
+            region: 搜索区域 (x, y, w, h)
+            term_crit: 终止条件
+            camshift: True 使用 CamShift, False 使用 meanShift
+            now: 本帧时刻(秒), 用于更新位置预测, 默认为当前时刻
+
+        Returns:
+            搜索区域的概率图
+        """
+        if now is None:
+            now = timer()
+        rx, ry, rw, rh = region
+        x, y, w, h = self.start_window
+        roi_window = (x - rx, y - ry, w, h)
+        with STAGE_SECONDS.time("backproject"):
+            if self.color_model.seed_requested:
+                self.color_model.seed(hsv, mask, roi_window)
+            prob = self.color_model.backproject(hsv, mask)
+
+        self.track_window0 = self.track_window
+        start = timer()
+        if camshift:
+            box, roi_window = cv2.CamShift(prob, roi_window, term_crit)
+            (cx, cy), size, angle = box
+            self.box = ((cx + rx, cy + ry), size, angle)
+            STAGE_SECONDS.observe("camshift", timer() - start)
+        else:
+            ret, roi_window = cv2.meanShift(prob, roi_window, term_crit)
+            STAGE_SECONDS.observe("meanshift", timer() - start)
+        self.color_model.update(hsv, mask, roi_window, prob)
+
+        x, y, w, h = roi_window
+        self.track_window = (x + rx, y + ry, w, h)
+        self.search_region.observe(region, self.track_window0,
+                                   self.track_window)
+        if self.color_model.locked:
+            self.predictor.update(self.track_window, now)
+        else:
+            self.predictor.reset()
+        return prob
+
+
+class MultiTracker(object):
+    """多颜色/多目标跟踪类
+
+    所有目标共享一次HSV转换(或一次查找表索引计算), 转换范围为
+    所有目标搜索区域的外接矩形; 每个目标只做自己搜索区域内的
+    阈值处理、反向投影和 CamShift, 因此耗时随目标数亚线性增长。
+    与 CamShift/MeanShift 类接口相同, 返回的跟踪窗口为优先级最高的
+    已锁定目标。
+    """
+    def __init__(self, video_prop, margin_window, track_window, target_colors,
+                 algorithm="camshift"):
+        """初始化多目标跟踪器
+
+        Args:
+            video_prop: 视频属性
+            margin_window: 边界窗口
+            track_window: 初始跟踪窗口(所有目标共用)
+            target_colors: 颜色名称列表, 顺序即优先级
+            algorithm: "camshift" 或 "meanshift"
+        """
+        self.margin_window = margin_window
+        self.term_crit = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 1)
+        self.camshift = algorithm != "meanshift"
+        self.color_lut = colorlut.get_lut() if colorlut.color_lut else None
+        colors = settings.current().colors
+        self.targets = []
+        for priority, color in enumerate(target_colors):
+            lower, upper = colors[color]
+            self.targets.append(
+                Target(color, priority, lower, upper, track_window,
+                       video_prop, self.color_lut))
+        self.selected = self.targets[0]  # 当前选中的目标
+        self.debug = False  # 是否输出概率图
+        self.draw = True  # 是否在帧上绘制跟踪框
+        self.track_window = track_window
+
+    def apply_settings(self, config, changed, margin_window, track_window):
+        """应用重新加载的配置(在两帧之间调用)
+
+        Args:
+            config: settings.Settings
+            changed: 改变的项
+            margin_window: 重新计算的边界窗口
+            track_window: 重新计算的初始跟踪窗口
+        """
+        self.margin_window = margin_window
+        for target in self.targets:
+            target.apply_settings(config, changed, track_window)
+
+    def reseed(self):
+        """所有目标在下一帧从各自的跟踪窗口重新计算颜色模型"""
+        for target in self.targets:
+            target.color_model.reseed()
+
+    @property
+    def color_model(self):
+        """当前选中目标的颜色模型"""
+        return self.selected.color_model
+
+    @property
+    def predictor(self):
+        """当前选中目标的位置预测"""
+        return self.selected.predictor
+
+    def windows(self):
+        """获取每个目标的跟踪窗口
+
+        Returns:
+            dict: 颜色名称 -> (跟踪窗口, 是否锁定)
+        """
+        return {
+            target.color: (target.track_window, target.color_model.locked)
+            for target in self.targets
+        }
+
+    def boxes(self):
+        """获取每个目标的跟踪框(客户端在画布上绘制), 选中的目标加粗
+
+        Returns:
+            list: [(整帧坐标的顶点, BGR颜色, 线宽)]
+        """
+        boxes = []
+        for target in self.targets:
+            thickness = 2 if target is self.selected else 1
+            if self.camshift and target.box is not None:
+                pts = np.intp(cv2.boxPoints(target.box))
+            else:
+                x, y, w, h = target.track_window
+                pts = np.intp([(x, y), (x + w, y), (x + w, y + h),
+                               (x, y + h)])
+            boxes.append((pts, target.draw_color, thickness))
+        return boxes
+
+    def select_target(self):
+        """按优先级选择目标: 优先级最高的已锁定目标, 都未锁定时选第一个
+
+        Returns:
+            Target
+        """
+        for target in self.targets:
+            if target.color_model.locked:
+                return target
+        return self.targets[0]
+
+    def object_tracking(self, ret, frame, now=None):
+        """执行多目标跟踪
+
+        Args:
+            ret: 帧读取状态
+            frame: 输入帧
+            now: 采集该帧的时刻(秒), 用于位置预测, 默认为当前时刻
+
+        Returns:
+            tuple: (概率图, 处理后的帧, 选中目标的跟踪窗口,
+                    选中目标的上一帧跟踪窗口)
+        """
+        if ret:
+            if now is None:
+                now = timer()
+            regions = [target.region(now) for target in self.targets]
+            """ 所有搜索区域的外接矩形只转换一次 """
+            ux = min(r[0] for r in regions)
+            uy = min(r[1] for r in regions)
+            ux2 = max(r[0] + r[2] for r in regions)
+            uy2 = max(r[1] + r[3] for r in regions)
+            roi = frame[uy:uy2, ux:ux2]
+            start = timer()
+            if self.color_lut is not None:
+                self.color_lut.refresh()
+                index = self.color_lut.index(roi)
+            else:
+                hsv = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
+            STAGE_SECONDS.observe("hsv_mask", timer() - start)
+
+            frame_prob = None
+            if self.debug:
+                frame_prob = np.zeros(frame.shape[:2], np.uint8)
+            for target, region in zip(self.targets, regions):
+                rx, ry, rw, rh = region
+                sx, sy = rx - ux, ry - uy  # 在外接矩形中的位置
+                start = timer()
+                if self.color_lut is not None:
+                    target_hsv, mask = self.color_lut.hue_mask(
+                        None, target.color, index[sy:sy + rh, sx:sx + rw])
+                else:
+                    target_hsv = hsv[sy:sy + rh, sx:sx + rw]
+                    mask = cv2.inRange(target_hsv, target.lower, target.upper)
+                STAGE_SECONDS.observe("hsv_mask", timer() - start)
+                prob = target.track(target_hsv, mask, region, self.term_crit,
+                                    self.camshift, now)
+                """ 概率图合成为一张, 便于调试 """
+                if frame_prob is not None:
+                    prob_roi = frame_prob[ry:ry + rh, rx:rx + rw]
+                    cv2.max(prob_roi, prob, dst=prob_roi)
+
+            self.selected = self.select_target()
+            self.track_window = self.selected.track_window
+
+            """ 绘制每个目标的跟踪框, 选中的目标加粗 """
+            if self.draw:
+                for pts, color, thickness in self.boxes():
+                    frame = cv2.polylines(frame, [pts], True, color,
+                                          thickness)
+
+            return frame_prob, frame, self.selected.track_window, \
+                self.selected.track_window0
@@ -0,0 +1,73 @@
+# !/usr/bin/env python
+# coding: utf-8
+import cv2
+import numpy as np
+
+
+class StaticOverlay(object):
+    """预先绘制的静态叠加层
+
+    边界窗口、初始窗口、参数文本等只在模式或配置改变时变化,
+    绘制一次后每帧只做合成:
+
+    * 完全覆盖的像素(线条, 填充)按掩码一次复制
+    * 抗锯齿的边缘(文本)只在其外接矩形内按透明度混合
+
+    分别在黑色和白色背景上绘制, 两者之差即为每个像素的透明度,
+    结果与直接在帧上绘制相同, 颜色没有限制。
+    键或帧大小改变时自动重新绘制。
+    """
+    def __init__(self):
+        self._key = None  # 当前静态层的键
+        self._shape = None  # 静态层对应的帧大小
+        self._color = None  # 黑色背景上的静态层(预乘透明度的颜色)
+        self._mask = None  # 完全覆盖的像素掩码
+        self._blend = []  # 抗锯齿区域 (y0, y1, x0, x1, 颜色, 255*(1-透明度))
+        self.renders = 0  # 绘制次数
+
+    def apply(self, frame, key, draw, *args):
+        """把静态层合成到帧上(就地修改)
+
+        Args:
+            frame: 视频帧
+            key: 静态层内容的键(模式, 配置等), 与上次不同时重新绘制
+            draw: 绘制函数, 第一个参数为背景图像, 只在重新绘制时调用
+            *args: 传给绘制函数的其他参数
+
+        Returns:
+            合成后的视频帧
+        """
+        if key != self._key or frame.shape != self._shape:
+            self._render(frame, draw, args)
+            self._key = key
+        frame = cv2.copyTo(self._color, self._mask, frame)
+        for y0, y1, x0, x1, color, inverse in self._blend:
+            roi = frame[y0:y1, x0:x1]
+            cv2.multiply(roi, inverse, dst=roi, scale=1 / 255)
+            cv2.add(roi, color, dst=roi)
+        return frame
+
+    def _render(self, frame, draw, args):
+        """绘制静态层并计算掩码和抗锯齿区域"""
+        black = np.zeros_like(frame)
+        white = np.full_like(frame, 255)
+        draw(black, *args)
+        draw(white, *args)
+        inverse = cv2.subtract(white, black)  # 255 为透明, 0 为完全覆盖
+        opaque = np.all(inverse == 0, axis=2)
+        partial = np.any(inverse != 0, axis=2) & np.any(inverse != 255,
+                                                         axis=2)
+
+        """ 相邻的文字合并为一个矩形 """
+        partial = cv2.dilate(partial.astype(np.uint8), np.ones((3, 9),
+                                                               np.uint8))
+        count, _, boxes, _ = cv2.connectedComponentsWithStats(partial)
+        self._blend = []
+        for x, y, w, h, _ in boxes[1:count]:
+            self._blend.append(
+                (y, y + h, x, x + w, black[y:y + h, x:x + w].copy(),
+                 inverse[y:y + h, x:x + w].copy()))
+        self._color = black
+        self._mask = opaque.astype(np.uint8)
+        self._shape = frame.shape
+        self.renders += 1
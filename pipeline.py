@@ -0,0 +1,225 @@
+# !/usr/bin/env python
+# coding: utf-8
+import threading
+from collections import deque
+from logging import getLogger
+from time import sleep
+from timeit import default_timer as timer
+
+from framecache import DEFAULT_VARIANT
+
+logger = getLogger(__name__)
+
+
+class RingBuffer(object):
+    """固定容量的环形缓冲区
+
+    写满时丢弃最旧的数据(latest-wins), 写入方永远不会阻塞。
+    """
+    def __init__(self, size=2):
+        """初始化缓冲区
+
+        Args:
+            size: 缓冲区容量
+        """
+        self._cond = threading.Condition()
+        self._items = deque(maxlen=size)
+        self.size = size
+        self.drops = 0  # 被覆盖丢弃的数量
+
+    def put(self, item):
+        """写入数据, 写满时覆盖最旧的数据
+
+        Args:
+            item: 数据
+        """
+        with self._cond:
+            if len(self._items) == self.size:
+                self.drops += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """取出最旧的数据
+
+        Args:
+            timeout: 超时秒数
+
+        Returns:
+            数据, 超时返回None
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items, timeout):
+                return None
+            return self._items.popleft()
+
+    def depth(self):
+        """当前缓冲的数据量"""
+        with self._cond:
+            return len(self._items)
+
+
+class Stage(object):
+    """流水线阶段
+
+    在独立线程中从输入缓冲区取数据, 处理后写入输出缓冲区。
+    没有输入缓冲区的阶段(采集阶段)每次循环直接调用处理函数。
+    """
+    def __init__(self, name, func, inbox=None, outbox=None):
+        """初始化阶段
+
+        Args:
+            name: 阶段名称
+            func: 处理函数, 返回None时不写入输出缓冲区
+            inbox: 输入缓冲区
+            outbox: 输出缓冲区
+        """
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0  # 处理数量
+        self.busy_time = 0  # 累计处理时间(秒)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """启动阶段线程"""
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """停止阶段线程"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        """阶段主循环"""
+        while self.running:
+            item = None
+            if self.inbox is not None:
+                item = self.inbox.get(timeout=0.5)
+                if item is None:
+                    continue
+            start = timer()
+            try:
+                result = self.func(item) if self.inbox is not None \
+                    else self.func()
+            except Exception:
+                logger.exception("stage {} failed".format(self.name))
+                sleep(0.1)
+                continue
+            self.busy_time += timer() - start
+            self.processed += 1
+            if result is not None and self.outbox is not None:
+                self.outbox.put(result)
+
+    def stats(self):
+        """获取阶段统计
+
+        Returns:
+            dict: 处理数量, 平均处理时间, 输入缓冲区深度与丢弃数量
+        """
+        stats = {
+            "processed": self.processed,
+            "avg_ms": round(self.busy_time * 1000 / self.processed, 2)
+            if self.processed else 0
+        }
+        if self.inbox is not None:
+            stats["queue_depth"] = self.inbox.depth()
+            stats["queue_size"] = self.inbox.size
+            stats["drops"] = self.inbox.drops
+        return stats
+
+
+class StagedPipeline(object):
+    """采集 → 跟踪 → 绘制/编码 三阶段流水线
+
+    各阶段运行在独立线程中, 通过小容量环形缓冲区连接,
+    使摄像头I/O和释放GIL的OpenCV调用可以并行执行,
+    帧率取决于最慢的阶段而不是各阶段耗时之和。
+    """
+    def __init__(self, camera, buffer_size=2):
+        """初始化流水线
+
+        Args:
+            camera: VideoCamera实例
+            buffer_size: 阶段之间环形缓冲区的容量
+        """
+        self.camera = camera
+        self.stages = [
+            Stage("capture", self._capture, outbox=RingBuffer(buffer_size)),
+        ]
+        self.stages.append(
+            Stage("track", self._track, self.stages[-1].outbox,
+                  RingBuffer(buffer_size)))
+        self.stages.append(
+            Stage("annotate_encode", self._annotate_encode,
+                  self.stages[-1].outbox))
+
+    def start(self):
+        """启动所有阶段"""
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        """停止所有阶段"""
+        for stage in self.stages:
+            stage.stop()
+
+    def _capture(self):
+        """采集阶段: 读取、缩放、翻转, 并记录采集时刻和当时的运行模式
+
+        仅流模式且可以直通时直接广播JPEG数据, 不进入后续阶段。
+        """
+        camera = self.camera
+        if camera.passthrough_active() and camera.publish_jpeg():
+            return None
+        stream_only, is_test = camera.stream_only, camera.is_test
+        ret, frame, frame_time = camera.capture(camera.flip_code)
+        return ret, frame, frame_time, stream_only, is_test
+
+    def _track(self, item):
+        """跟踪阶段: 目标跟踪与机械臂控制
+
+        重新加载的配置在跟踪之前应用。有调试客户端时生成概率图, 有遥测客户端时在跟踪后立即生成遥测数据。
+        """
+        ret, frame, frame_time, stream_only, is_test = item
+        camera = self.camera
+        camera.apply_settings()
+        frame, prob, track_window, track_area_ratio = \
+            camera.tracking.track(ret, frame, stream_only, is_test,
+                                  camera.debug_active(), frame_time)
+        data = None
+        if camera.telemetry_active():
+            data = camera.tracking.telemetry(track_window, track_area_ratio,
+                                             is_test)
+        return frame, prob, track_window, track_area_ratio, is_test, data
+
+    def _annotate_encode(self, item):
+        """绘制/编码阶段: 绘制参数文本, 放入帧缓存并广播
+
+        有客户端时预先编码默认变体, 使客户端线程不再承担编码。
+        """
+        frame, prob, track_window, track_area_ratio, is_test, data = item
+        camera = self.camera
+        frame = camera.tracking.annotate(frame, track_window,
+                                         track_area_ratio, is_test)
+        seq = camera.frame_cache.put(frame)
+        if camera.broadcaster.viewers:
+            camera.frame_cache.get(DEFAULT_VARIANT)
+        camera.broadcaster.publish(seq)
+        camera.publish_debug(prob)
+        camera.publish_telemetry(seq, data)
+
+    def stats(self):
+        """获取各阶段统计
+
+        Returns:
+            dict: 阶段名称 -> 统计信息
+        """
+        return {stage.name: stage.stats() for stage in self.stages}
@@ -0,0 +1,111 @@
+# !/usr/bin/env python
+# coding: utf-8
+import settings
+
+""" 加载配置 """
+config = settings.current()
+predict = config.tracking.predict  # 是否启用位置预测
+predict_alpha = config.tracking.predict_alpha  # 位置修正系数
+predict_beta = config.tracking.predict_beta  # 速度修正系数
+predict_latency = config.tracking.predict_latency  # 预测提前量(秒)
+
+
+class WindowPredictor(object):
+    """跟踪窗口的等速 alpha-beta 滤波器
+
+    对 CamShift/meanShift 输出的窗口中心估计位置和速度(像素/秒), 用于:
+
+    * 预测下一帧的窗口, 作为 CamShift 的起始窗口, 减少迭代次数
+    * 预测 latency 秒之后的窗口, 补偿从采集到舵机动作的延迟
+    """
+    def __init__(self, frame_size, enabled=predict, alpha=predict_alpha,
+                 beta=predict_beta, max_gap=0.5):
+        """初始化滤波器
+
+        Args:
+            frame_size: 帧大小 (宽度, 高度)
+            enabled: 是否启用(不启用时预测值即最后一次观测值)
+            alpha: 位置修正系数(0-1)
+            beta: 速度修正系数(0-1)
+            max_gap: 两次观测间隔超过该秒数时重新开始
+        """
+        self.frame_width, self.frame_height = frame_size[:2]
+        self.enabled = enabled
+        self.alpha = alpha
+        self.beta = beta
+        self.max_gap = max_gap
+        self.reset()
+
+    def apply_settings(self, config):
+        """应用重新加载的配置
+
+        Args:
+            config: settings.Settings
+        """
+        self.enabled = config.tracking.predict
+        self.alpha = config.tracking.predict_alpha
+        self.beta = config.tracking.predict_beta
+
+    def reset(self):
+        """丢弃状态(目标丢失时)"""
+        self.position = None  # 窗口中心 (x, y)
+        self.velocity = (0.0, 0.0)  # 窗口中心速度(像素/秒)
+        self.size = None  # 窗口大小 (w, h)
+        self.time = None  # 最后一次观测的时刻
+
+    def update(self, window, t):
+        """输入一次观测
+
+        Args:
+            window: 跟踪窗口 (x, y, w, h)
+            t: 观测时刻(秒)
+        """
+        x, y, w, h = window
+        cx, cy = x + w / 2, y + h / 2
+        self.size = (w, h)
+        if not self.enabled or self.position is None or \
+                not 0 < t - self.time < self.max_gap:
+            self.position = (cx, cy)
+            self.velocity = (0.0, 0.0)
+            self.time = t
+            return
+        dt = t - self.time
+        px = self.position[0] + self.velocity[0] * dt
+        py = self.position[1] + self.velocity[1] * dt
+        rx, ry = cx - px, cy - py  # 残差
+        self.position = (px + self.alpha * rx, py + self.alpha * ry)
+        self.velocity = (self.velocity[0] + self.beta * rx / dt,
+                         self.velocity[1] + self.beta * ry / dt)
+        self.time = t
+
+    def predict_window(self, t):
+        """预测 t 时刻的跟踪窗口(限制在帧内)
+
+        Args:
+            t: 时刻(秒)
+
+        Returns:
+            tuple: (x, y, w, h), 没有观测时为None
+        """
+        if self.position is None:
+            return None
+        dt = max(t - self.time, 0) if self.enabled else 0
+        w, h = self.size
+        cx = self.position[0] + self.velocity[0] * dt
+        cy = self.position[1] + self.velocity[1] * dt
+        x = min(max(int(round(cx - w / 2)), 0), max(self.frame_width - w, 0))
+        y = min(max(int(round(cy - h / 2)), 0), max(self.frame_height - h, 0))
+        return x, y, w, h
+
+    def predict_ahead(self, latency=predict_latency):
+        """预测最后一次观测 latency 秒之后的跟踪窗口
+
+        Args:
+            latency: 提前量(秒), 即采集到舵机动作的延迟
+
+        Returns:
+            tuple: (x, y, w, h), 没有观测时为None
+        """
+        if self.time is None:
+            return None
+        return self.predict_window(self.time + latency)
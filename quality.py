@@ -0,0 +1,213 @@
+# !/usr/bin/env python
+# coding: utf-8
+import itertools
+import threading
+
+import settings
+from framecache import FrameVariant
+
+""" 画质阶梯: (JPEG质量, 缩放比例), 负载过高时逐级下降 """
+LADDER = ((95, 1.0), (85, 1.0), (75, 1.0), (70, 0.75), (60, 0.75), (50, 0.5),
+          (40, 0.5))
+
+
+class QualityController(object):
+    """单个客户端的画质控制
+
+    在 gen() 的发送循环中观测每帧的编码时间、发送时间(WSGI写出数据块,
+    网络慢时会阻塞)和广播器跳过的帧数, 按阶梯调整JPEG质量和缩放比例,
+    画质降到最低后再跳帧。负载持续较低时逐级恢复。
+    只在客户端线程中运行, 不影响采集、跟踪和舵机控制。
+    未指定的目标值每次读取当前配置, 重新加载后对已连接的客户端也生效。
+    """
+    def __init__(self, ceiling, address=None, target_send=None,
+                 target_encode=None, max_skip=None,
+                 smoothing=0.2, hold=5, recover=30):
+        """初始化控制器
+
+        Args:
+            ceiling: 客户端请求的 FrameVariant, 画质不超过它
+            address: 客户端地址(只用于显示)
+            target_send: 每帧发送时间目标(秒), None 为配置的值
+            target_encode: 每帧编码时间目标(秒), None 为配置的值
+            max_skip: 最多在两帧之间跳过几帧, None 为配置的值
+            smoothing: 指数平滑系数
+            hold: 调整后至少观测几帧再下降
+            recover: 负载低于目标一半持续几帧后恢复一级
+        """
+        self.id = next(_ids)
+        self.address = address
+        self.ladder = [(ceiling.quality, ceiling.scale)] + [
+            step for step in LADDER
+            if step[0] < ceiling.quality and step[1] <= ceiling.scale]
+        self._target_send = target_send
+        self._target_encode = target_encode
+        self._max_skip = max_skip
+        self.smoothing = smoothing
+        self.hold = hold
+        self.recover = recover
+        self.level = 0  # 当前阶梯
+        self.skip = 0  # 两帧之间跳过的帧数
+        self.send_time = 0.0  # 平滑后的发送时间(秒)
+        self.encode_time = 0.0  # 平滑后的编码时间(秒)
+        self.frames = 0  # 已发送帧数
+        self.dropped = 0  # 广播器跳过的帧数
+        self.skipped = 0  # 主动跳过的帧数
+        self._since_change = 0
+        self._good = 0
+        self._counter = 0
+
+    @property
+    def target_send(self):
+        """每帧发送时间目标(秒)"""
+        if self._target_send is None:
+            return settings.current().stream.target_send
+        return self._target_send
+
+    @property
+    def target_encode(self):
+        """每帧编码时间目标(秒)"""
+        if self._target_encode is None:
+            return settings.current().stream.target_encode
+        return self._target_encode
+
+    @property
+    def max_skip(self):
+        """最多在两帧之间跳过几帧"""
+        if self._max_skip is None:
+            return settings.current().stream.max_skip
+        return self._max_skip
+
+    @property
+    def variant(self):
+        """当前输出变体"""
+        quality, scale = self.ladder[self.level]
+        return FrameVariant(quality, scale)
+
+    def should_skip(self):
+        """本帧是否跳过
+
+        Returns:
+            bool
+        """
+        if not self.skip:
+            return False
+        self._counter = (self._counter + 1) % (self.skip + 1)
+        if self._counter:
+            self.skipped += 1
+            return True
+        return False
+
+    def observe(self, encode_time, send_time, dropped=0):
+        """输入一帧的观测值并调整
+
+        Args:
+            encode_time: 取得(必要时编码)该帧的时间(秒)
+            send_time: 发送该帧的时间(秒)
+            dropped: 上一帧之后广播器跳过的帧数
+        """
+        a = self.smoothing
+        self.encode_time += a * (encode_time - self.encode_time)
+        self.send_time += a * (send_time - self.send_time)
+        self.frames += 1
+        self.dropped += dropped
+        self._since_change += 1
+
+        overloaded = self.send_time > self.target_send or \
+            self.encode_time > self.target_encode or dropped
+        if overloaded:
+            self._good = 0
+            if self._since_change >= self.hold:
+                self._step_down()
+        elif self.send_time < self.target_send / 2 and \
+                self.encode_time < self.target_encode / 2:
+            self._good += 1
+            if self._good >= self.recover:
+                self._step_up()
+        else:
+            self._good = 0
+
+    def _step_down(self):
+        if self.level < len(self.ladder) - 1:
+            self.level += 1
+        elif self.skip < self.max_skip:
+            self.skip += 1
+        else:
+            return
+        self._since_change = 0
+
+    def _step_up(self):
+        self._good = 0
+        if self.skip:
+            self.skip -= 1
+        elif self.level:
+            self.level -= 1
+        else:
+            return
+        self._since_change = 0
+
+    def stats(self):
+        """获取当前决策和观测值
+
+        Returns:
+            dict
+        """
+        variant = self.variant
+        return {
+            "id": self.id,
+            "address": self.address,
+            "quality": variant.quality,
+            "scale": variant.scale,
+            "skip": self.skip,
+            "level": self.level,
+            "send_ms": round(self.send_time * 1000, 2),
+            "encode_ms": round(self.encode_time * 1000, 2),
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "skipped": self.skipped
+        }
+
+
+def adaptive():
+    """新客户端默认是否自动调整画质(当前配置)
+
+    Returns:
+        bool
+    """
+    return settings.current().stream.adaptive
+
+
+_ids = itertools.count(1)
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def register(controller):
+    """登记客户端的控制器
+
+    Args:
+        controller: QualityController
+    """
+    with _controllers_lock:
+        _controllers[controller.id] = controller
+
+
+def unregister(controller):
+    """客户端断开时取消登记
+
+    Args:
+        controller: QualityController
+    """
+    with _controllers_lock:
+        _controllers.pop(controller.id, None)
+
+
+def clients():
+    """获取所有客户端的当前决策
+
+    Returns:
+        list: 每个客户端的 stats()
+    """
+    with _controllers_lock:
+        controllers = list(_controllers.values())
+    return [controller.stats() for controller in controllers]
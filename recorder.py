@@ -0,0 +1,483 @@
+# !/usr/bin/env python
+# coding: utf-8
+"""飞行记录器
+
+跟踪期间一直把最近 seconds 秒的帧(缩放/翻转之后, 跟踪之前)和每帧的
+跟踪状态写入固定大小的内存映射环形文件:
+
+    文件头(HEADER_SIZE 字节) + capacity 个槽
+    槽 = 元数据(META, 占 META_SPACE 字节) + 原始BGR帧(宽 * 高 * 3 字节)
+
+每帧只把帧数据复制一次到映射的页中, 不编码、不打开文件、不分配内存;
+元数据最后写入帧序号, 序号为0的槽表示正在写入(读取时跳过)。
+环形文件放在 tmpfs(/dev/shm)上时不写SD卡。进程异常退出后文件保留,
+下次启动时改名为 .prev。
+
+snapshot() 按帧序号顺序把当前的有效槽导出为同样格式的文件,
+read_recording() 读取环形文件或导出的文件, 本模块作为脚本运行时
+把导出的帧离线回放给跟踪器并与记录的结果比较:
+
+example:
+    python3 recorder.py flight_20260101_120000.rec
+    python3 recorder.py flight_20260101_120000.rec -a meanshift --realtime
+"""
+import argparse
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import Counter, namedtuple
+from logging import getLogger, WARNING
+from timeit import default_timer as timer
+
+import numpy as np
+
+import settings
+
+logger = getLogger(__name__)
+
+""" 加载配置 """
+config = settings.current()
+recorder_enabled = config.recorder.enabled  # 是否启用飞行记录器
+recorder_file = config.recorder.file  # 环形文件路径
+recorder_seconds = config.recorder.seconds  # 保留的秒数
+snapshot_dir = config.recorder.snapshot_dir  # 导出文件的目录
+
+MAGIC = b'MEARMREC'
+VERSION = 1
+""" 文件头: 标识, 版本, 通道数, 宽度, 高度, 槽数, 槽大小, FPS, 跟踪参数 """
+HEADER = struct.Struct('<8sHHIIIIf64s')
+HEADER_SIZE = 128
+""" 元数据: 帧序号, 时刻, 系统时间, 标志, 命令, 跟踪窗口, 跟踪区域比例,
+    移动比例, 命令角度(下臂, 上臂, 底座), 舵机角度(下臂, 上臂, 底座, 夹持器),
+    跟踪耗时, 机械臂控制耗时 """
+META = struct.Struct('<QddBB2x4if2f3f4f2f')
+META_SPACE = 128
+SEQ = struct.Struct('<Q')
+
+DEFAULT_FPS = 30  # 摄像头没有报告帧率时按此计算槽数
+
+FLAG_TEST = 1  # 测试模式
+FLAG_LOCKED = 2  # 颜色模型已锁定
+""" 命令种类, 下标即记录的值 """
+COMMANDS = ('', 'move_by', 'move_to', 'grip')
+
+Record = namedtuple('Record', [
+    'seq', 'time', 'wall', 'is_test', 'locked', 'command', 'track_window',
+    'track_area_ratio', 'move_ratio', 'command_angles', 'servo', 'track_ms',
+    'motion_ms'
+])
+
+
+def _slot_size(width, height, channels):
+    """槽大小, 按64字节对齐"""
+    size = META_SPACE + width * height * channels
+    return (size + 63) // 64 * 64
+
+
+def _angle(value):
+    return float('nan') if value is None else value
+
+
+class FlightRecorder(object):
+    """内存映射环形文件的写入端
+
+    只由跟踪线程调用 begin()/commit(), snapshot() 可以在其他线程调用。
+    """
+    def __init__(self, path, frame_size, fps, seconds=recorder_seconds,
+                 params=''):
+        """创建环形文件并映射到内存
+
+        Args:
+            path: 环形文件路径
+            frame_size: 帧大小 (宽度, 高度)
+            fps: 帧率, 与 seconds 一起决定槽数
+            seconds: 保留的秒数
+            params: 跟踪参数(算法和颜色), 回放时作为默认值
+        """
+        self.path = path
+        self.width, self.height = frame_size[:2]
+        self.channels = 3
+        if fps <= 0:
+            logger.warning("flight recorder: invalid fps {}, assuming {}".
+                           format(fps, DEFAULT_FPS))
+            fps = DEFAULT_FPS
+        self.fps = fps
+        self.capacity = max(int(math.ceil(seconds * fps)), 1)
+        self.slot_size = _slot_size(self.width, self.height, self.channels)
+        self.params = params
+        self.seq = 0  # 最后写入的帧序号
+        self.skipped = 0  # 帧大小不符而没有记录的帧数
+        size = HEADER_SIZE + self.capacity * self.slot_size
+
+        """ 保留上次运行(可能异常退出)的记录 """
+        if os.path.exists(path):
+            os.replace(path, path + '.prev')
+        with open(path, 'w+b') as f:
+            f.truncate(size)
+            self._mm = mmap.mmap(f.fileno(), size)
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, self.channels,
+                         self.width, self.height, self.capacity,
+                         self.slot_size, fps, params.encode()[:64])
+        """ 每个槽的帧数据直接是映射内存上的数组 """
+        slots = np.ndarray((self.capacity, self.slot_size), np.uint8,
+                           self._mm, HEADER_SIZE)
+        self._frames = [
+            slot[META_SPACE:META_SPACE + self.width * self.height *
+                 self.channels].reshape(self.height, self.width,
+                                        self.channels)
+            for slot in slots
+        ]
+        logger.info("flight recorder {}: {} frames, {} MB".format(
+            path, self.capacity, round(size / (1 << 20), 1)))
+
+    def _offset(self, index):
+        return HEADER_SIZE + index * self.slot_size
+
+    def begin(self, frame):
+        """把帧复制到下一个槽(在跟踪之前调用, 跟踪器可能在帧上绘制)
+
+        Args:
+            frame: BGR视频帧
+
+        Returns:
+            int: 槽编号, 帧大小不符或已关闭时为None
+        """
+        if self._mm is None or frame.shape != (self.height, self.width,
+                                               self.channels):
+            self.skipped += 1
+            return None
+        index = self.seq % self.capacity
+        SEQ.pack_into(self._mm, self._offset(index), 0)
+        np.copyto(self._frames[index], frame)
+        return index
+
+    def commit(self, index, frame_time, is_test, locked, track_window,
+               track_area_ratio, move_ratio, command, servo, track_time,
+               motion_time):
+        """写入元数据, 最后写入帧序号使槽生效
+
+        Args:
+            index: begin() 返回的槽编号
+            frame_time: 该帧的时刻(秒)
+            is_test: 是否测试模式
+            locked: 颜色模型是否锁定
+            track_window: 跟踪窗口 (x, y, w, h)
+            track_area_ratio: 跟踪区域比例
+            move_ratio: 移动比例
+            command: MearmMove.last_command, 没有命令时为None
+            servo: 舵机角度 (下臂, 上臂, 底座, 夹持器)
+            track_time: 跟踪耗时(秒)
+            motion_time: 机械臂控制耗时(秒)
+        """
+        if index is None or self._mm is None:
+            return
+        kind, angles = 0, (0, 0, 0)
+        if command is not None:
+            kind, angles = COMMANDS.index(command[0]), command[1:]
+        self.seq += 1
+        offset = self._offset(index)
+        META.pack_into(
+            self._mm, offset, 0, frame_time, time.time(),
+            (FLAG_TEST if is_test else 0) | (FLAG_LOCKED if locked else 0),
+            kind, *[int(v) for v in track_window], track_area_ratio,
+            move_ratio[0], move_ratio[1], *angles,
+            *[_angle(a) for a in servo], track_time, motion_time)
+        SEQ.pack_into(self._mm, offset, self.seq)
+
+    def snapshot(self, path=None):
+        """按帧序号顺序导出当前的有效槽
+
+        复制期间被覆盖的槽不导出。
+
+        Args:
+            path: 导出文件路径, 默认为 snapshot_dir 下按时间命名的文件
+
+        Returns:
+            tuple: (导出文件路径, 帧数)
+        """
+        if path is None:
+            path = os.path.join(snapshot_dir, time.strftime(
+                "flight_%Y%m%d_%H%M%S.rec"))
+        mm = self._mm
+        order = sorted(
+            (SEQ.unpack_from(mm, self._offset(i))[0], i)
+            for i in range(self.capacity))
+        slots = []
+        for seq, index in order:
+            if not seq:
+                continue
+            start = self._offset(index)
+            data = mm[start:start + self.slot_size]
+            if SEQ.unpack_from(mm, start)[0] == seq:
+                slots.append(data)
+        with open(path, 'wb') as f:
+            header = bytearray(HEADER_SIZE)
+            HEADER.pack_into(header, 0, MAGIC, VERSION, self.channels,
+                             self.width, self.height, len(slots),
+                             self.slot_size, self.fps,
+                             self.params.encode()[:64])
+            f.write(header)
+            for data in slots:
+                f.write(data)
+        logger.info("flight recorder snapshot {}: {} frames".format(
+            path, len(slots)))
+        return path, len(slots)
+
+    def stats(self):
+        """获取记录统计
+
+        Returns:
+            dict
+        """
+        return {
+            "path": self.path,
+            "capacity": self.capacity,
+            "recorded": self.seq,
+            "skipped": self.skipped
+        }
+
+    def close(self):
+        """解除映射(文件保留)"""
+        if self._mm is None:
+            return
+        self._frames = []
+        self._mm.flush()
+        self._mm.close()
+        self._mm = None
+
+
+def open_recorder(frame_prop, params=''):
+    """按配置创建飞行记录器
+
+    Args:
+        frame_prop: 帧属性 (宽度, 高度, FPS)
+        params: 跟踪参数(算法和颜色)
+
+    Returns:
+        FlightRecorder, 未启用或无法创建文件时为None
+    """
+    if not recorder_enabled:
+        return None
+    try:
+        return FlightRecorder(recorder_file, frame_prop[:2], frame_prop[2],
+                              recorder_seconds, params)
+    except (OSError, ValueError) as e:
+        logger.warning("flight recorder disabled: {}".format(e))
+        return None
+
+
+def read_header(mm):
+    """读取文件头
+
+    Returns:
+        dict: channels, width, height, capacity, slot_size, fps, params
+    """
+    magic, version, channels, width, height, capacity, slot_size, fps, \
+        params = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a flight recording")
+    return {
+        "channels": channels,
+        "width": width,
+        "height": height,
+        "capacity": capacity,
+        "slot_size": slot_size,
+        "fps": round(fps, 2),
+        "params": params.rstrip(b'\0').decode()
+    }
+
+
+def read_recording(path):
+    """按帧序号顺序读取环形文件或导出的文件
+
+    帧为映射内存上的只读数组(修改时先复制), 数组引用映射,
+    保留数组或提前结束循环时映射在数组释放后才解除。
+
+    Args:
+        path: 文件路径
+
+    Yields:
+        tuple: (文件头dict, Record, 帧)
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    """ 不显式关闭映射: 调用者仍持有帧时关闭会使访问帧的进程崩溃 """
+    header = read_header(mm)
+    capacity, slot_size = header["capacity"], header["slot_size"]
+    shape = (header["height"], header["width"], header["channels"])
+    order = sorted(
+        (SEQ.unpack_from(mm, HEADER_SIZE + i * slot_size)[0], i)
+        for i in range(capacity))
+    for seq, index in order:
+        if not seq:
+            continue
+        offset = HEADER_SIZE + index * slot_size
+        values = META.unpack_from(mm, offset)
+        record = Record(
+            seq=values[0], time=values[1], wall=values[2],
+            is_test=bool(values[3] & FLAG_TEST),
+            locked=bool(values[3] & FLAG_LOCKED),
+            command=COMMANDS[values[4]],
+            track_window=values[5:9], track_area_ratio=values[9],
+            move_ratio=values[10:12], command_angles=values[12:15],
+            servo=values[15:19], track_ms=values[19] * 1000,
+            motion_ms=values[20] * 1000)
+        yield header, record, np.ndarray(shape, np.uint8, mm,
+                                         offset + META_SPACE)
+
+
+def _percentiles(values):
+    """分位数"""
+    if not values:
+        return {"p50": 0, "p95": 0, "max": 0, "mean": 0}
+    values = np.array(values)
+    p50, p95 = np.percentile(values, (50, 95))
+    return {
+        "p50": round(float(p50), 2),
+        "p95": round(float(p95), 2),
+        "max": round(float(values.max()), 2),
+        "mean": round(float(values.mean()), 2)
+    }
+
+
+def replay(path, algorithm=None, color=None, realtime=False, verbose=False):
+    """把记录的帧回放给跟踪器(测试模式, 模拟舵机), 与记录的结果比较
+
+    回放从空的跟踪状态开始, 锁定目标之前的几帧可能与记录不同。
+
+    Args:
+        path: 导出的文件
+        algorithm: 跟踪算法, 默认为记录时的算法
+        color: 目标颜色(多个颜色为列表), 默认为记录时的颜色
+        realtime: 是否按记录的时间间隔回放(位置预测与记录时一致)
+        verbose: 是否输出每帧的比较
+
+    Returns:
+        dict: 回放结果
+    """
+    import mearm
+    import mearmlib
+    import servobackend
+    import tracking
+
+    mearm.set_backend(servobackend.CoalescingBackend(
+        servobackend.SimulatedBackend(mearmlib.sim_slew_rate,
+                                      mearmlib.sim_latency),
+        mearmlib.servo_max_rate))
+    tracker = None
+    header = None
+    errors = []
+    recorded_commands = Counter()
+    replayed_commands = Counter()
+    frames = []
+    last_time = None
+    try:
+        for header, record, frame in read_recording(path):
+            if tracker is None:
+                recorded_algorithm, _, recorded_color = \
+                    header["params"].partition(' ')
+                algorithm = algorithm or recorded_algorithm or 'camshift'
+                if color is None:
+                    color = recorded_color.split(',') \
+                        if ',' in recorded_color else recorded_color
+                prop = (header["width"], header["height"], header["fps"])
+                tracker = tracking.Tracking(True, frame.copy(), prop,
+                                            algorithm, color, False, True,
+                                            prop)
+            if realtime and last_time is not None:
+                time.sleep(max(min(record.time - last_time, 1.0), 0))
+            last_time = record.time
+            _, _, track_window, _ = tracker.track(True, frame.copy(), False,
+                                                  True, frame_time=record.time)
+            command = tracker.myMeArmMove.last_command
+            kind = command[0] if command is not None else ''
+            recorded_commands[record.command] += 1
+            replayed_commands[kind] += 1
+            x, y, w, h = record.track_window
+            rx, ry, rw, rh = track_window
+            error = math.hypot(rx + rw / 2 - x - w / 2,
+                               ry + rh / 2 - y - h / 2)
+            errors.append(error)
+            if verbose:
+                frames.append({
+                    "seq": record.seq,
+                    "recorded": list(record.track_window),
+                    "replayed": [int(v) for v in track_window],
+                    "error_px": round(error, 2),
+                    "recorded_command": record.command,
+                    "replayed_command": kind
+                })
+    finally:
+        """ 停止回放用的控制线程和夹持器线程 """
+        if tracker is not None and tracker.arm is not None:
+            tracker.myMeArmMove.close()
+        mearm.backend.close()
+    if header is None:
+        raise ValueError("no frames in {}".format(path))
+    result = {
+        "source": path,
+        "header": header,
+        "algorithm": algorithm,
+        "color": color,
+        "frames": len(errors),
+        "centre_error_px": _percentiles(errors),
+        "matched": round(sum(1 for e in errors if e < 1) / len(errors), 3),
+        "commands": {
+            "recorded": dict(recorded_commands),
+            "replayed": dict(replayed_commands)
+        }
+    }
+    if verbose:
+        result["per_frame"] = frames
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='replay a flight recording through the tracker')
+    parser.add_argument('recording', help='snapshot (or ring) file')
+    parser.add_argument(
+        '-a',
+        '--algorithm',
+        help='tracking algorithm (default: recorded)',
+        choices=['camshift', 'meanshift'])
+    parser.add_argument(
+        '-c',
+        '--color',
+        help='colors in color.ini (default: recorded)',
+        nargs='+',
+        choices=config.color_names)
+    parser.add_argument(
+        '--realtime',
+        help='replay with the recorded frame intervals',
+        action='store_true')
+    parser.add_argument(
+        '-v', '--verbose', help='include per frame results',
+        action='store_true')
+    parser.add_argument(
+        '-o', '--output', help='write JSON report to file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    getLogger().setLevel(WARNING)
+
+    color = None
+    if args.color:
+        color = args.color if len(args.color) > 1 else args.color[0]
+    start = timer()
+    result = replay(args.recording, args.algorithm, color, args.realtime,
+                    args.verbose)
+    result["elapsed_s"] = round(timer() - start, 2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# !/usr/bin/env python
+# coding: utf-8
+import settings
+
+""" 加载配置 """
+config = settings.current()
+search_region = config.tracking.search_region  # 是否启用搜索区域
+search_expand = config.tracking.search_expand  # 搜索区域扩展比例
+search_motion_gain = config.tracking.search_motion_gain  # 运动扩展系数
+
+
+class SearchRegion(object):
+    """跟踪搜索区域
+
+    HSV转换、颜色掩码和反向投影只在上一帧跟踪窗口周围的区域内进行。
+    区域在窗口四周扩展 expand 倍窗口大小, 再加上最近运动速度的 motion_gain 倍。
+    失去目标或跟踪窗口碰到区域边缘时, 下一帧回退到整帧搜索。
+    """
+    def __init__(self, frame_size, enabled=search_region,
+                 expand=search_expand, motion_gain=search_motion_gain):
+        """初始化搜索区域
+
+        Args:
+            frame_size: 帧大小 (宽度, 高度)
+            enabled: 是否启用(不启用时总是整帧搜索)
+            expand: 窗口四周的最小扩展比例
+            motion_gain: 速度(像素/帧)的扩展系数
+        """
+        self.frame_width, self.frame_height = frame_size[:2]
+        self.enabled = enabled
+        self.expand = expand
+        self.motion_gain = motion_gain
+        self.velocity = (0.0, 0.0)  # 平滑后的窗口速度(像素/帧)
+        self.full_frame = True  # 下一帧是否整帧搜索
+        self.full_frame_count = 0  # 整帧搜索次数
+
+    def apply_settings(self, config):
+        """应用重新加载的配置
+
+        Args:
+            config: settings.Settings
+        """
+        self.enabled = config.tracking.search_region
+        self.expand = config.tracking.search_expand
+        self.motion_gain = config.tracking.search_motion_gain
+        self.full_frame = True
+
+    def region(self, track_window, locked):
+        """计算本帧的搜索区域
+
+        Args:
+            track_window: 上一帧跟踪窗口 (x, y, w, h)
+            locked: 颜色模型是否锁定目标
+
+        Returns:
+            tuple: 搜索区域 (x, y, w, h)
+        """
+        if not self.enabled or self.full_frame or not locked:
+            self.full_frame_count += 1
+            return 0, 0, self.frame_width, self.frame_height
+        x, y, w, h = track_window
+        xpad = int(w * self.expand + abs(self.velocity[0]) * self.motion_gain)
+        ypad = int(h * self.expand + abs(self.velocity[1]) * self.motion_gain)
+        xmin = max(x - xpad, 0)
+        ymin = max(y - ypad, 0)
+        xmax = min(x + w + xpad, self.frame_width)
+        ymax = min(y + h + ypad, self.frame_height)
+        return xmin, ymin, xmax - xmin, ymax - ymin
+
+    def observe(self, region, track_window0, track_window):
+        """根据跟踪结果更新速度, 并判断下一帧是否需要整帧搜索
+
+        Args:
+            region: 本帧的搜索区域 (x, y, w, h)
+            track_window0: 上一帧跟踪窗口
+            track_window: 本帧跟踪窗口
+        """
+        x, y, w, h = track_window
+        x0, y0, w0, h0 = track_window0
+        vx, vy = self.velocity
+        self.velocity = (0.5 * vx + 0.5 * (x + w / 2 - x0 - w0 / 2),
+                         0.5 * vy + 0.5 * (y + h / 2 - y0 - h0 / 2))
+        rx, ry, rw, rh = region
+        """ 只有不是帧边缘的区域边缘才算碰到 """
+        self.full_frame = w <= 0 or h <= 0 or \
+            (rx > 0 and x <= rx) or (ry > 0 and y <= ry) or \
+            (rx + rw < self.frame_width and x + w >= rx + rw) or \
+            (ry + rh < self.frame_height and y + h >= ry + rh)
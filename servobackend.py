@@ -0,0 +1,451 @@
+# !/usr/bin/env python
+# coding: utf-8
+"""舵机后端
+
+mearm.Servo 通过后端发送脉冲宽度, 后端有三种实现:
+
+* PigpioBackend: 通过 pigpiod 控制真实舵机, 第一次写入时才连接
+* SimulatedBackend: 进程内模拟, 模拟命令延迟和舵机转速
+* RecorderBackend: 把带时间戳的脉冲宽度写入紧凑的二进制文件,
+  可以同时转发给另一个后端
+
+CoalescingBackend 包装以上任一后端, 省略脉冲宽度没有变化的写入,
+把同一控制周期的多个关节合并为一次批量写入, 并限制每个舵机的命令频率。
+"""
+import atexit
+import struct
+import threading
+from contextlib import contextmanager
+from logging import getLogger
+from timeit import default_timer as timer
+
+from metrics import STAGE_SECONDS
+
+logger = getLogger(__name__)
+
+BACKENDS = ('pigpio', 'simulated', 'recorder')
+
+""" 记录文件格式: 时间戳(float64 秒), 引脚(uint8), 脉冲宽度(uint16 微秒) """
+TRACE_RECORD = struct.Struct('<dBH')
+
+
+class PigpioBackend(object):
+    """pigpio后端"""
+    def __init__(self, host='localhost', port=8888):
+        """初始化后端(不连接pigpiod)
+
+        Args:
+            host: pigpiod 主机
+            port: pigpiod 端口
+        """
+        self.host = host
+        self.port = port
+        self.pi = None
+
+    def _connect(self):
+        """连接pigpiod
+
+        pigpio 只在真正需要硬件时导入, 没有安装 pigpio 的开发环境
+        也可以使用其他后端。
+        """
+        import pigpio
+        self.pi = pigpio.pi(self.host, self.port)
+        if not self.pi.connected:
+            logger.warning("cannot connect to pigpiod {}:{}".format(
+                self.host, self.port))
+
+    def set_pulsewidth(self, pin, pulse_width):
+        """设置舵机脉冲宽度
+
+        Args:
+            pin: GPIO引脚
+            pulse_width: 脉冲宽度(微秒)
+        """
+        if self.pi is None:
+            self._connect()
+        self.pi.set_servo_pulsewidth(pin, pulse_width)
+
+    def set_pulsewidths(self, pulses):
+        """一次设置多个舵机的脉冲宽度
+
+        pigpio 没有同时设置多个舵机的命令(波形会占用DMA通道,
+        不能与 set_servo_pulsewidth 的舵机脉冲共用), 因此依次发送,
+        中间不插入其他命令。
+
+        Args:
+            pulses: dict, 引脚 -> 脉冲宽度(微秒)
+        """
+        if self.pi is None:
+            self._connect()
+        for pin, pulse_width in pulses.items():
+            self.pi.set_servo_pulsewidth(pin, pulse_width)
+
+    def close(self):
+        """断开pigpiod连接"""
+        if self.pi is not None:
+            self.pi.stop()
+            self.pi = None
+
+
+class SimulatedBackend(object):
+    """进程内模拟的MeArm
+
+    每条命令在 latency 秒后生效, 之后舵机以 slew_rate(微秒/秒)
+    向目标脉冲宽度匀速移动。可以查询任意时刻每个舵机的位置和到位时间。
+    """
+    def __init__(self, slew_rate=6000, latency=0.002, clock=timer):
+        """初始化模拟器
+
+        Args:
+            slew_rate: 舵机转速(脉冲宽度 微秒/秒), 6000 约等于 0.1秒/60度
+            latency: 命令延迟(秒)
+            clock: 时钟函数
+        """
+        self.slew_rate = slew_rate
+        self.latency = latency
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._servos = {}  # 引脚 -> (起始位置, 目标位置, 开始移动时间)
+        self.commands = 0  # 命令总数
+        self.commands_per_pin = {}  # 每个引脚的命令数
+        self.last_command_time = None  # 最后一条命令的时间
+
+    def set_pulsewidth(self, pin, pulse_width):
+        """发送命令, latency 秒后开始移动
+
+        Args:
+            pin: GPIO引脚
+            pulse_width: 脉冲宽度(微秒)
+        """
+        self.set_pulsewidths({pin: pulse_width})
+
+    def set_pulsewidths(self, pulses):
+        """一次发送多个舵机的命令, 同时生效
+
+        Args:
+            pulses: dict, 引脚 -> 脉冲宽度(微秒)
+        """
+        now = self.clock()
+        with self._lock:
+            start = now + self.latency
+            for pin, pulse_width in pulses.items():
+                if pin in self._servos:
+                    position = self._position(pin, start)
+                else:
+                    position = pulse_width  # 上电后直接处于第一条命令的位置
+                self._servos[pin] = (position, pulse_width, start)
+                self.commands += 1
+                self.commands_per_pin[pin] = \
+                    self.commands_per_pin.get(pin, 0) + 1
+            self.last_command_time = now
+
+    def _position(self, pin, t):
+        origin, target, start = self._servos[pin]
+        if t <= start:
+            return origin
+        step = self.slew_rate * (t - start)
+        if abs(target - origin) <= step:
+            return target
+        return origin + step if target > origin else origin - step
+
+    def position(self, pin, t=None):
+        """查询舵机在 t 时刻的脉冲宽度
+
+        Args:
+            pin: GPIO引脚
+            t: 时刻, 默认为当前时刻
+
+        Returns:
+            float: 脉冲宽度, 未收到过命令时为None
+        """
+        with self._lock:
+            if pin not in self._servos:
+                return None
+            return self._position(pin, self.clock() if t is None else t)
+
+    def settle_time(self, pin):
+        """舵机到达目标位置的时刻
+
+        Args:
+            pin: GPIO引脚
+
+        Returns:
+            float: 到位时刻, 未收到过命令时为None
+        """
+        with self._lock:
+            if pin not in self._servos:
+                return None
+            origin, target, start = self._servos[pin]
+            return start + abs(target - origin) / self.slew_rate
+
+    def close(self):
+        pass
+
+
+class RecorderBackend(object):
+    """记录后端
+
+    每条命令记录为 TRACE_RECORD 格式的 11 字节, 可以用 read_trace 读取。
+    """
+    def __init__(self, path, backend=None, clock=timer):
+        """初始化记录后端
+
+        Args:
+            path: 记录文件路径
+            backend: 同时转发命令的后端(可选)
+            clock: 时钟函数
+        """
+        self.path = path
+        self.backend = backend
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self.commands = 0
+        atexit.register(self.close)
+
+    def set_pulsewidth(self, pin, pulse_width):
+        """记录命令并转发
+
+        Args:
+            pin: GPIO引脚
+            pulse_width: 脉冲宽度(微秒)
+        """
+        self.set_pulsewidths({pin: pulse_width})
+
+    def set_pulsewidths(self, pulses):
+        """记录多个命令(同一时间戳)并一次转发
+
+        Args:
+            pulses: dict, 引脚 -> 脉冲宽度(微秒)
+        """
+        with self._lock:
+            if self._file is not None:
+                now = self.clock()
+                self._file.write(b"".join(
+                    TRACE_RECORD.pack(now, pin, int(pulse_width))
+                    for pin, pulse_width in pulses.items()))
+            self.commands += len(pulses)
+        if self.backend is not None:
+            self.backend.set_pulsewidths(pulses)
+
+    def close(self):
+        """关闭记录文件"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self.backend is not None:
+            self.backend.close()
+
+
+class CoalescingBackend(object):
+    """合并与限流的命令层
+
+    * 记录每个引脚最后发送的脉冲宽度, 没有变化的写入直接省略
+    * transaction() 内的写入在结束时合并为一次 set_pulsewidths
+      (只合并打开 transaction 的线程的写入, 其他线程的写入照常发送)
+    * 每个引脚的命令频率按令牌桶限制为平均 max_rate 次/秒
+      (允许 burst 条的突发, 以吸收调度抖动), 超出的命令只保留最新值,
+      有令牌后由定时器发送
+    """
+    def __init__(self, backend, max_rate=50, burst=2, clock=timer):
+        """初始化命令层
+
+        Args:
+            backend: 实际发送命令的后端
+            max_rate: 每个舵机每秒最多命令数(0 表示不限制),
+                      舵机PWM周期为20毫秒, 超过50次/秒的命令没有意义
+            burst: 令牌桶容量
+            clock: 时钟函数
+        """
+        self.backend = backend
+        self.max_rate = max_rate
+        self.burst = burst
+        self.clock = clock
+        self._lock = threading.RLock()
+        """ 每个线程的 transaction 嵌套层数(depth)和暂存的命令(staged) """
+        self._local = threading.local()
+        self._pending = {}  # 因限流推迟的命令
+        self._timer = None
+        self.last_pulse = {}  # 引脚 -> 最后发送的脉冲宽度
+        self._tokens = {}  # 引脚 -> (令牌数, 更新时刻)
+        self.sent = 0  # 实际发送的命令数
+        self.batches = 0  # 实际发送的批次数
+        self.suppressed = 0  # 省略的无变化命令数
+        self.deferred = 0  # 因限流推迟的命令数
+
+    def set_pulsewidth(self, pin, pulse_width):
+        """写入命令, transaction 中时暂存到结束时发送
+
+        Args:
+            pin: GPIO引脚
+            pulse_width: 脉冲宽度(微秒)
+        """
+        self.set_pulsewidths({pin: pulse_width})
+
+    def set_pulsewidths(self, pulses):
+        """写入多个命令, 本线程在 transaction 中时暂存
+
+        Args:
+            pulses: dict, 引脚 -> 脉冲宽度(微秒)
+        """
+        local = self._local
+        if getattr(local, 'depth', 0):
+            local.staged.update(pulses)
+            return
+        with self._lock:
+            self._send(pulses)
+
+    @contextmanager
+    def transaction(self):
+        """合并一个控制周期内所有关节的写入
+
+        Example:
+            with backend.transaction():
+                lower.move_by(...)
+                upper.move_by(...)
+        """
+        local = self._local
+        if not getattr(local, 'depth', 0):
+            local.depth = 0
+            local.staged = {}
+        local.depth += 1
+        try:
+            yield self
+        finally:
+            local.depth -= 1
+            if not local.depth and local.staged:
+                staged, local.staged = local.staged, {}
+                with self._lock:
+                    self._send(staged)
+
+    def _send(self, pulses):
+        """省略无变化的命令, 推迟过于频繁的命令, 其余一次发送"""
+        now = self.clock()
+        batch = {}
+        for pin, pulse_width in pulses.items():
+            if self.last_pulse.get(pin) == pulse_width:
+                self._pending.pop(pin, None)  # 推迟的命令已经没有必要
+                self.suppressed += 1
+            elif self.max_rate and not self._take_token(pin, now):
+                self._pending[pin] = pulse_width
+                self.deferred += 1
+            else:
+                self._pending.pop(pin, None)
+                batch[pin] = pulse_width
+        if batch:
+            self._write(batch)
+        if self._pending and self._timer is None:
+            self._schedule(now)
+
+    def _write(self, batch):
+        """把一批命令发送到后端"""
+        self.last_pulse.update(batch)
+        self.sent += len(batch)
+        self.batches += 1
+        with STAGE_SECONDS.time("servo_write"):
+            self.backend.set_pulsewidths(batch)
+
+    def _refill(self, pin, now):
+        """补充令牌并返回当前令牌数"""
+        tokens, last = self._tokens.get(pin, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.max_rate)
+        self._tokens[pin] = (tokens, now)
+        return tokens
+
+    def _take_token(self, pin, now):
+        """有令牌时取走一个
+
+        Returns:
+            bool: 是否取到令牌
+        """
+        tokens = self._refill(pin, now)
+        if tokens < 1:
+            return False
+        self._tokens[pin] = (tokens - 1, now)
+        return True
+
+    def _schedule(self, now):
+        """在最早可以发送推迟命令的时刻启动定时器"""
+        delay = min((1 - self._refill(pin, now)) / self.max_rate
+                    for pin in self._pending)
+        self._timer = threading.Timer(max(delay, 0), self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self, force=False):
+        """发送到时间的推迟命令
+
+        Args:
+            force: 是否不限制频率, 立即发送所有推迟的命令(关闭前)
+        """
+        with self._lock:
+            if force and self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            if self._pending:
+                pending, self._pending = self._pending, {}
+                if force:
+                    self._write(pending)
+                else:
+                    self._send(pending)
+
+    def stats(self):
+        """获取命令统计
+
+        Returns:
+            dict: 发送、批次、省略和推迟的命令数
+        """
+        with self._lock:
+            return {
+                "sent": self.sent,
+                "batches": self.batches,
+                "suppressed": self.suppressed,
+                "deferred": self.deferred
+            }
+
+    def close(self):
+        """立即发送推迟的命令, 然后关闭后端"""
+        self.flush(force=True)
+        self.backend.close()
+
+
+def read_trace(path):
+    """读取记录文件
+
+    Args:
+        path: 记录文件路径
+
+    Yields:
+        tuple: (时间戳, 引脚, 脉冲宽度)
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    for offset in range(0, len(data) - TRACE_RECORD.size + 1,
+                        TRACE_RECORD.size):
+        yield TRACE_RECORD.unpack_from(data, offset)
+
+
+def create_backend(name, trace_file='servo_trace.bin', slew_rate=6000,
+                   latency=0.002, forward='simulated'):
+    """按名称创建后端
+
+    Args:
+        name: "pigpio", "simulated" 或 "recorder"
+        trace_file: 记录后端的文件路径
+        slew_rate: 模拟器舵机转速(微秒/秒)
+        latency: 模拟器命令延迟(秒)
+        forward: 记录后端转发命令的后端, "simulated" 或 "pigpio"
+
+    Returns:
+        舵机后端
+    """
+    if name == 'pigpio':
+        return PigpioBackend()
+    if name == 'simulated':
+        return SimulatedBackend(slew_rate, latency)
+    if name == 'recorder':
+        return RecorderBackend(
+            trace_file, create_backend(forward, slew_rate=slew_rate,
+                                       latency=latency))
+    raise ValueError("unknown servo backend: {}".format(name))
@@ -0,0 +1,396 @@
+# !/usr/bin/env python
+# coding: utf-8
+"""配置
+
+config.ini 和 color.ini 只在这里读取: 值用 ast.literal_eval 解析(不执行代码),
+按 SCHEMA 校验类型和范围, 所有模块共享同一个只读的 Settings 对象。
+
+运行时可以重新加载(POST /config/reload, 或文件修改后自动检测)。
+重新加载只解析和校验, 新配置由采集/跟踪线程在两帧之间调用 apply_pending()
+生效, 各组件的 apply_settings() 只重新计算受影响的部分(边界窗口、
+跟踪窗口、颜色范围等)。不能在运行中改变的项(帧大小、设备、舵机后端等)
+保持原值, 在结果中列为需要重启。
+"""
+import ast
+import configparser
+import os
+import threading
+from logging import getLogger
+from timeit import default_timer as timer
+
+logger = getLogger(__name__)
+
+CONFIG_FILE = 'config.ini'
+COLOR_FILE = 'color.ini'
+
+
+class SettingsError(ValueError):
+    """配置文件的格式或取值错误"""
+
+
+def _literal(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        raise ValueError("not a literal: {!r}".format(value))
+
+
+def _text(value):
+    """原样保存的字符串(格式名, 路径等)"""
+    return value
+
+
+def _bool(value):
+    value = _literal(value)
+    if not isinstance(value, bool):
+        raise ValueError("expected True or False")
+    return value
+
+
+def _number(low=None, high=None, integer=False):
+    """数值, 可以指定范围 [low, high]"""
+    def convert(value):
+        value = _literal(value)
+        types = (int, ) if integer else (int, float)
+        if isinstance(value, bool) or not isinstance(value, types):
+            raise ValueError("expected {}".format(
+                "an integer" if integer else "a number"))
+        if low is not None and value < low or \
+                high is not None and value > high:
+            raise ValueError("out of range [{}, {}]".format(low, high))
+        return value
+    return convert
+
+
+def _numbers(count, low=None, high=None, integer=False, ordered=False):
+    """count 个数值的元组, ordered 时要求不递减"""
+    item = _number(low, high, integer)
+
+    def convert(value):
+        value = _literal(value)
+        if not isinstance(value, tuple) or len(value) != count:
+            raise ValueError("expected {} values".format(count))
+        value = tuple(item(repr(v)) for v in value)
+        if ordered and list(value) != sorted(value):
+            raise ValueError("expected (min, max)")
+        return value
+    return convert
+
+
+def _device(value):
+    """设备号或设备路径/URL"""
+    try:
+        return _number(0, integer=True)(value)
+    except ValueError:
+        return value
+
+
+def _flipcode(value):
+    value = _literal(value)
+    if value not in (0, 1, -1, "reset"):
+        raise ValueError("expected 0, 1, -1 or 'reset'")
+    return value
+
+
+""" 各项的转换函数 """
+SCHEMA = {
+    'camera': {
+        'frame_prop': _numbers(3, 1, integer=True),
+        'device': _device,
+        'fourcc': _text,
+        'buffer_size': _number(0, integer=True),
+        'passthrough': _bool,
+        'frame_margin': _number(0, 0.45),
+        'flipcode': _flipcode,
+    },
+    'mearm': {
+        'base_by': _numbers(2, 0, ordered=True),
+        'upper_by': _numbers(2, 0, ordered=True),
+        'lower_by': _numbers(2, 0, ordered=True),
+        'backend': _text,
+        'trace_file': _text,
+        'trace_forward': _text,
+        'sim_slew_rate': _number(0),
+        'sim_latency': _number(0),
+        'max_rate': _number(0),
+        'motion_control': _bool,
+        'control_rate': _number(1),
+        'max_velocity': _number(0),
+        'max_accel': _number(0),
+        'ik': _bool,
+        'camera_fov': _numbers(2, 1, 179),
+        'ik_gain': _number(0, 1),
+        'ik_deadband': _number(0, 0.5),
+        'ik_reach_gain': _number(),
+        'ik_step': _number(1, integer=True),
+        'ik_cache': _text,
+    },
+    'tracking': {
+        'track_area': _numbers(2, 1, integer=True),
+        'min_area': _number(0),
+        'back_arm_ratio': _numbers(2, 0, ordered=True),
+        'forward_arm_ratio': _numbers(2, 0, ordered=True),
+        'hist_alpha': _number(0, 1),
+        'hist_min_confidence': _number(0, 1),
+        'hist_seed_fill': _number(0, 1),
+        'search_region': _bool,
+        'search_expand': _number(0),
+        'search_motion_gain': _number(0),
+        'color_lut': _bool,
+        'color_lut_bits': _number(1, 8, integer=True),
+        'color_lut_cache': _text,
+        'predict': _bool,
+        'predict_alpha': _number(0, 1),
+        'predict_beta': _number(0, 1),
+        'predict_latency': _number(0),
+    },
+    'stream': {
+        'adaptive': _bool,
+        'target_send': _number(0),
+        'target_encode': _number(0),
+        'max_skip': _number(0, integer=True),
+        'server_overlay': _bool,
+    },
+    'recorder': {
+        'enabled': _bool,
+        'file': _text,
+        'seconds': _number(0),
+        'snapshot_dir': _text,
+    },
+}
+
+""" 可以在运行中生效的项(颜色范围也可以), 其他项需要重启 """
+RELOADABLE = {
+    'camera.frame_margin',
+    'mearm.base_by', 'mearm.upper_by', 'mearm.lower_by',
+    'mearm.max_velocity', 'mearm.max_accel',
+    'mearm.camera_fov', 'mearm.ik_gain', 'mearm.ik_deadband',
+    'mearm.ik_reach_gain', 'mearm.ik_step',
+    'tracking.track_area', 'tracking.min_area',
+    'tracking.back_arm_ratio', 'tracking.forward_arm_ratio',
+    'tracking.hist_alpha', 'tracking.hist_min_confidence',
+    'tracking.hist_seed_fill',
+    'tracking.search_region', 'tracking.search_expand',
+    'tracking.search_motion_gain',
+    'tracking.predict', 'tracking.predict_alpha', 'tracking.predict_beta',
+    'tracking.predict_latency',
+    'stream.adaptive', 'stream.target_send', 'stream.target_encode',
+    'stream.max_skip', 'stream.server_overlay',
+}
+
+
+class Section(object):
+    """配置的一节, 各项为只读属性"""
+    def __init__(self, name, values):
+        self.__dict__['_name'] = name
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("settings are read-only")
+
+    def __repr__(self):
+        return "Section({!r})".format(self._name)
+
+
+class Settings(object):
+    """校验后的配置(只读)
+
+    Example:
+        config = settings.current()
+        config.camera.frame_margin
+        config.colors["yellow"]  # (HSV下限, HSV上限)
+    """
+    def __init__(self, values, colors, generation=0):
+        """初始化
+
+        Args:
+            values: "节.项" -> 值
+            colors: 颜色名称 -> (HSV下限, HSV上限), 保持 color.ini 中的顺序
+            generation: 版本号, 每次生效时递增
+        """
+        self.values = dict(values)
+        self.colors = dict(colors)
+        self.color_names = list(colors)
+        self.generation = generation
+        for section in SCHEMA:
+            setattr(self, section, Section(section, {
+                key.split('.', 1)[1]: value
+                for key, value in values.items()
+                if key.split('.', 1)[0] == section
+            }))
+
+    def diff(self, other):
+        """与另一个配置不同的项
+
+        Args:
+            other: Settings
+
+        Returns:
+            set: "节.项", 颜色为 "color.名称"
+        """
+        keys = {key for key in set(self.values) | set(other.values)
+                if self.values.get(key) != other.values.get(key)}
+        keys |= {"color." + name
+                 for name in set(self.colors) | set(other.colors)
+                 if self.colors.get(name) != other.colors.get(name)}
+        return keys
+
+    def as_dict(self):
+        """转换为可以直接输出为JSON的dict"""
+        result = {section: dict(vars(getattr(self, section)))
+                  for section in SCHEMA}
+        for section in result.values():
+            section.pop('_name')
+        result["colors"] = {name: {"lower": bounds[0], "upper": bounds[1]}
+                            for name, bounds in self.colors.items()}
+        result["generation"] = self.generation
+        return result
+
+
+def load(config_file=CONFIG_FILE, color_file=COLOR_FILE, generation=0):
+    """读取并校验配置文件
+
+    Args:
+        config_file: config.ini 的路径
+        color_file: color.ini 的路径
+        generation: 版本号
+
+    Returns:
+        Settings
+
+    Raises:
+        SettingsError: 文件缺少项或取值错误(列出所有错误)
+    """
+    errors = []
+    parser = configparser.ConfigParser()
+    if not parser.read(config_file):
+        raise SettingsError("cannot read {}".format(config_file))
+    values = {}
+    for section, items in SCHEMA.items():
+        for key, convert in items.items():
+            name = "{}.{}".format(section, key)
+            if not parser.has_option(section, key):
+                errors.append("{}: missing".format(name))
+                continue
+            try:
+                values[name] = convert(parser.get(section, key))
+            except ValueError as e:
+                errors.append("{}: {}".format(name, e))
+
+    colors = {}
+    parser = configparser.ConfigParser()
+    if not parser.read(color_file):
+        errors.append("cannot read {}".format(color_file))
+    bounds = _numbers(3, 0, 255, integer=True)
+    for name in parser.sections():
+        try:
+            colors[name] = (bounds("({},)".format(parser[name]['lower'])),
+                            bounds("({},)".format(parser[name]['upper'])))
+        except (KeyError, ValueError) as e:
+            errors.append("color.{}: {}".format(name, e))
+
+    if errors:
+        raise SettingsError("; ".join(errors))
+    return Settings(values, colors, generation)
+
+
+_lock = threading.Lock()
+_current = load()  # 当前生效的配置
+_pending = None  # 已校验、等待在两帧之间生效的配置
+_mtimes = None  # 配置文件的修改时间
+_checked = 0  # 上次检查文件修改的时刻
+
+
+def current():
+    """获取当前生效的配置
+
+    Returns:
+        Settings
+    """
+    return _current
+
+
+def _file_mtimes():
+    try:
+        return tuple(os.path.getmtime(path)
+                     for path in (CONFIG_FILE, COLOR_FILE))
+    except OSError:
+        return None
+
+
+def reload():
+    """重新读取并校验配置文件, 等待在两帧之间生效
+
+    Returns:
+        dict: changed(将生效的项), restart(需要重启才生效的项)
+
+    Raises:
+        SettingsError: 配置错误(当前配置不变)
+    """
+    global _pending, _mtimes
+    with _lock:
+        _mtimes = _file_mtimes()
+        new = load(generation=_current.generation + 1)
+        changed = new.diff(_current)
+        """ 删除的颜色可能正在跟踪, 与不能在运行中改变的项一样保持原值 """
+        removed = [name for name in _current.color_names
+                   if name not in new.colors]
+        restart = {key for key in changed
+                   if not key.startswith("color.") and key not in RELOADABLE}
+        restart |= {"color." + name for name in removed}
+        values = dict(new.values)
+        for key in restart:
+            if key in values:
+                values[key] = _current.values[key]
+        colors = dict(new.colors)
+        for name in removed:
+            colors[name] = _current.colors[name]
+        live = sorted(changed - restart)
+        _pending = Settings(values, colors, new.generation) \
+            if live else None
+    if restart:
+        logger.warning("restart required for {}".format(sorted(restart)))
+    logger.info("settings reloaded, changed: {}".format(live))
+    return {"changed": live, "restart": sorted(restart)}
+
+
+def check_files(interval=1.0):
+    """配置文件修改后重新加载(最多每 interval 秒检查一次)
+
+    Returns:
+        bool: 是否重新加载
+    """
+    global _checked, _mtimes
+    now = timer()
+    if now - _checked < interval:
+        return False
+    _checked = now
+    mtimes = _file_mtimes()
+    if _mtimes is None:
+        _mtimes = mtimes
+        return False
+    if mtimes is None or mtimes == _mtimes:
+        return False
+    try:
+        reload()
+    except SettingsError as e:
+        _mtimes = mtimes  # 文件再次修改前不重试
+        logger.error("invalid settings, keeping current: {}".format(e))
+        return False
+    return True
+
+
+def apply_pending():
+    """使等待中的配置生效(在两帧之间调用)
+
+    Returns:
+        tuple: (新配置, 改变的项), 没有等待中的配置时为None
+    """
+    global _current, _pending
+    with _lock:
+        if _pending is None:
+            return None
+        new, _pending = _pending, None
+        changed = new.diff(_current)
+        _current = new
+    return new, changed
@@ -1,7 +1,115 @@
 $(function () {
-    var tracking_cmd = ['streamonly', 'test', 'tracking'];
+    var tracking_cmd = ['streamonly', 'test', 'tracking', 'reseed'];
     var flip_cmd = ['flip-x', 'flip-y', 'flip-xy', 'flip-reset'];
     var url = "";
+    // passthrough frames are not flipped by the server (cv2.flip codes)
+    var flip_transform = { "0": "scaleY(-1)", "1": "scaleX(-1)", "-1": "scale(-1, -1)" };
+    function apply_flip(flip_code, client_flip) {
+        var transform = "none";
+        if (client_flip && String(flip_code) in flip_transform) {
+            transform = flip_transform[String(flip_code)];
+        }
+        $('#video').css('transform', transform);
+    }
+    apply_flip($('#video').data('flip-code'), $('#video').data('client-flip'));
+    // the probability map is only produced while /debug_feed has a subscriber
+    function toggle_debug() {
+        var debug = $('#debug');
+        if (debug.hasClass('d-none')) {
+            debug.attr('src', '/debug_feed').removeClass('d-none').addClass('d-block');
+        } else {
+            debug.removeAttr('src').removeClass('d-block').addClass('d-none');
+        }
+    }
+    // track boxes and text are drawn from /telemetry instead of into the frames
+    var mode_color = { "test": "rgb(0,128,0)", "tracking": "rgb(255,0,0)" };
+    var overlay_config = null;
+    var events = null;
+    function place_overlay() {
+        var video = $('#video')[0];
+        var canvas = $('#overlay')[0];
+        var style = window.getComputedStyle(video);
+        var pad_left = parseFloat(style.paddingLeft);
+        var pad_top = parseFloat(style.paddingTop);
+        $(canvas).css({
+            left: video.offsetLeft + video.clientLeft + pad_left,
+            top: video.offsetTop + video.clientTop + pad_top,
+            width: video.clientWidth - pad_left - parseFloat(style.paddingRight),
+            height: video.clientHeight - pad_top - parseFloat(style.paddingBottom)
+        });
+        // canvas pixels are frame pixels, css scales them to the image
+        if (overlay_config && canvas.width != overlay_config.frame[0]) {
+            canvas.width = overlay_config.frame[0];
+            canvas.height = overlay_config.frame[1];
+        }
+    }
+    function draw_overlay(data) {
+        var canvas = $('#overlay')[0];
+        var ctx = canvas.getContext('2d');
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+        if (!overlay_config) {
+            return;
+        }
+        var frame = overlay_config.frame;
+        ctx.font = "8px sans-serif";
+        ctx.lineWidth = 1;
+        if (data.track_window) {
+            var color = mode_color[data.mode];
+            var m = overlay_config.margin_window;
+            var w = overlay_config.init_window;
+            ctx.strokeStyle = color;
+            ctx.strokeRect(m[0] + 0.5, m[1] + 0.5, m[2] - m[0], m[3] - m[1]);
+            ctx.strokeStyle = "rgb(255,255,128)";
+            ctx.strokeRect(w[0] + 0.5, w[1] + 0.5, w[2], w[3]);
+            data.boxes.forEach(function (box) {
+                ctx.beginPath();
+                box.points.forEach(function (p, i) {
+                    if (i) {
+                        ctx.lineTo(p[0], p[1]);
+                    } else {
+                        ctx.moveTo(p[0], p[1]);
+                    }
+                });
+                ctx.closePath();
+                ctx.lineWidth = box.width;
+                ctx.strokeStyle = box.color;
+                ctx.stroke();
+            });
+            ctx.fillStyle = "white";
+            ctx.fillText(overlay_config.params, 10, 10);
+            ctx.fillText("track win:" + data.track_window.join(",") + " area:" +
+                data.track_area_ratio + " move:" + data.move_ratio.join(","), 10, 20);
+            ctx.fillText("servo l/u/b/g:" + [data.servo.lower, data.servo.upper,
+                data.servo.base, data.servo.grip].join("/"), 10, 30);
+            ctx.fillStyle = color;
+            ctx.fillText("mode:" + data.mode, 10, frame[1] - 10);
+        }
+        ctx.fillStyle = "white";
+        ctx.fillRect(frame[0] - 50, 0, 50, 17);
+        ctx.fillStyle = "black";
+        ctx.fillText("FPS: " + data.fps, frame[0] - 47, 10);
+    }
+    // the server only produces telemetry while someone is subscribed
+    function show_overlay(show) {
+        if (show && !events) {
+            events = new EventSource('/telemetry');
+            events.addEventListener('config', function (e) {
+                overlay_config = JSON.parse(e.data);
+                place_overlay();
+            });
+            events.onmessage = function (e) {
+                place_overlay();
+                draw_overlay(JSON.parse(e.data));
+            };
+        } else if (!show && events) {
+            events.close();
+            events = null;
+            var canvas = $('#overlay')[0];
+            canvas.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
+        }
+    }
+    show_overlay(true);
+    $(window).on('resize', place_overlay);
     $('.btn').on('click', function () {
         var command = JSON.stringify({ "command": $('#' + $(this).attr('id')).val() });
         if (JSON.parse(command).command == "") {
@@ -15,6 +123,12 @@ $(function () {
             url = '/tracking';
             post(url, command);
         }
+        if (JSON.parse(command).command == "debug") {
+            toggle_debug();
+        }
+        if (JSON.parse(command).command == "overlay") {
+            show_overlay(!events);
+        }
     });
     function post(url, command) {
         $.ajax({
@@ -27,6 +141,7 @@ $(function () {
             var sent_cmd = JSON.parse(command).command;
             var mearmpi_res = JSON.parse(data.ResultSet).result;
             var flip_code = JSON.parse(data.ResultSet).flip_code;
+            apply_flip(flip_code, JSON.parse(data.ResultSet).client_flip);
             $("#res").text(sent_cmd + ":" + mearmpi_res + " / flip: " + flip_code);
         }).fail(function (jqXHR, textStatus, errorThrown) {
             $("#res").text(textStatus + ":" + jqXHR.status + " " + errorThrown);
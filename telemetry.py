@@ -0,0 +1,58 @@
+# !/usr/bin/env python
+# coding: utf-8
+"""/telemetry 的 Server-Sent Events 格式
+
+每帧一个无名事件, data 为 VideoCamera.publish_telemetry() 广播的JSON:
+seq, mode, flip_code, fps, servo, track_window, track_area_ratio,
+move_ratio, boxes。
+边界窗口、初始窗口、参数文本等静态内容在连接时和内容改变时
+以 config 事件发送一次。
+"""
+import json
+
+CONTENT_TYPE = 'text/event-stream'
+
+
+def event(data, name=None):
+    """格式化一个事件
+
+    Args:
+        data: 数据(单行文本)
+        name: 事件名称, None 为默认的 message 事件
+
+    Returns:
+        bytes
+    """
+    if name is None:
+        return "data: {}\n\n".format(data).encode()
+    return "event: {}\ndata: {}\n\n".format(name, data).encode()
+
+
+class EventFormatter(object):
+    """单个客户端的事件格式化, 记录已发送的静态配置"""
+    def __init__(self, tracking):
+        """初始化
+
+        Args:
+            tracking: tracking.Tracking
+        """
+        self.tracking = tracking
+        self._config = None  # 已发送的 overlay_config
+
+    def format(self, message=None):
+        """格式化一帧的遥测数据, 静态配置改变时先发送 config 事件
+
+        Args:
+            message: 遥测数据的JSON文本, None 时只检查静态配置
+
+        Returns:
+            bytes
+        """
+        chunk = b''
+        config = self.tracking.overlay_config
+        if config is not self._config:
+            self._config = config
+            chunk += event(json.dumps(config), 'config')
+        if message is not None:
+            chunk += event(message)
+        return chunk
@@ -0,0 +1,20 @@
+# coding: utf-8
+"""测试在仓库根目录下运行: 模块在根目录, settings 在导入时读取 config.ini"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+class FakeClock(object):
+    """手动推进的时钟"""
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
@@ -0,0 +1,86 @@
+# coding: utf-8
+import time
+
+import gripper
+
+STEP = 0.05  # 各状态的时间(秒)
+INTERVAL = 0.4
+
+
+class FakeArm(object):
+    def __init__(self):
+        self.grip_angles = []
+
+    def move_to_grip(self, angle):
+        self.grip_angles.append(angle)
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.005)
+    return condition()
+
+
+def make_worker():
+    arm = FakeArm()
+    worker = gripper.GripWorker(arm, interval=INTERVAL, close_time=STEP,
+                                hold_time=STEP, open_time=STEP)
+    states = []
+    enter = worker._enter
+
+    def record(state, deadline):
+        states.append(state)
+        enter(state, deadline)
+
+    worker._enter = record
+    worker.last_grip -= INTERVAL  # 不等待启动后的间隔
+    worker.start()
+    return worker, arm, states
+
+
+def test_grip_cycle_is_driven_by_queue_timeouts():
+    worker, arm, states = make_worker()
+    try:
+        worker.request()
+        assert wait_for(lambda: states[-1:] == [gripper.IDLE])
+        assert states == [gripper.CLOSING, gripper.CLOSED, gripper.OPENING,
+                          gripper.IDLE]
+        assert arm.grip_angles == [worker.close_angle, worker.open_angle]
+        assert worker.grips == 1
+    finally:
+        worker.stop()
+
+
+def test_requests_during_action_and_interval_are_ignored():
+    worker, arm, states = make_worker()
+    try:
+        worker.request()
+        assert wait_for(lambda: worker.state != gripper.IDLE)
+        """ 每帧都请求: 动作中不放入队列 """
+        for _ in range(20):
+            worker.request()
+        assert worker.queue.empty()
+        assert wait_for(lambda: states[-1:] == [gripper.IDLE])
+        """ 间隔内仍然忽略 """
+        worker.request()
+        assert worker.queue.empty()
+        assert worker.grips == 1
+        assert worker.dropped == 0
+        assert worker.ignored == 21
+        """ 间隔过后再次夹持 """
+        time.sleep(INTERVAL)
+        worker.request()
+        assert wait_for(lambda: worker.grips == 2)
+    finally:
+        worker.stop()
+
+
+def test_test_mode_does_not_move_the_servo():
+    worker, arm, states = make_worker()
+    try:
+        worker.request(is_test=True)
+        assert wait_for(lambda: states[-1:] == [gripper.IDLE])
+        assert arm.grip_angles == []
+    finally:
+        worker.stop()
@@ -0,0 +1,53 @@
+# coding: utf-8
+import pytest
+
+import ikmap
+import mearm
+
+FRAME = (320, 240)
+CENTRE = (150, 110, 20, 20)  # 中心在死区内的跟踪窗口
+BACK = (0.3, 0.9)
+FORWARD = (1.2, 3.0)
+
+
+def make_table(**kwargs):
+    params = dict(fov=(62.2, 48.8), gain=0.6, deadband=0.05, reach_gain=6,
+                  step=4, cache_dir='', back_ratio=BACK,
+                  forward_ratio=FORWARD)
+    params.update(kwargs)
+    return ikmap.IKTable(FRAME, **params)
+
+
+def test_joint_limits_follow_servo_configs():
+    arm = mearm.MeArm()
+    limits = ikmap.joint_limits(arm)
+    assert limits[2] == (arm.base.minAngle + mearm.safe_angle,
+                         arm.base.maxAngle - mearm.safe_angle)
+    assert ikmap.joint_limits() == limits
+
+
+@pytest.mark.parametrize("ratio", [0.2, 1.0, 1.1, 3.5])
+def test_no_reach_outside_back_and_forward_ranges(ratio):
+    table = make_table()
+    assert table.lookup(CENTRE, ratio, (60, 60, 0)) is None
+
+
+@pytest.mark.parametrize("ratio, sign", [(0.5, -1), (2.0, 1)])
+def test_reach_inside_back_and_forward_ranges(ratio, sign):
+    table = make_table()
+    lower, upper, base = table.lookup(CENTRE, ratio, (60, 60, 0))
+    assert (lower - 60) * sign > 0
+    assert (upper, base) == (60, 0)
+
+
+def test_targets_are_absolute_and_within_servo_limits():
+    table = make_table(gain=1.0)
+    limits = ikmap.joint_limits()
+    """ 目标在帧的左上角, 机械臂已在范围边上 """
+    position = (limits[0][0], limits[1][1], limits[2][0])
+    target = table.lookup((0, 0, 10, 10), 2.0, position)
+    for angle, (low, high) in zip(target, limits):
+        assert low <= angle <= high
+    """ 离开边界的方向不受限制 """
+    target = table.lookup((300, 0, 10, 10), 1.0, (60, 60, 0))
+    assert target[2] > 0 and target[1] > 60 and target[0] < 60
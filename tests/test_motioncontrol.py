@@ -0,0 +1,121 @@
+# coding: utf-8
+import pytest
+
+import mearm
+import motioncontrol
+import servobackend
+from conftest import FakeClock
+
+DT = 0.02
+MAX_VELOCITY = 90
+MAX_ACCEL = 360
+
+
+class FakeServo(object):
+    def __init__(self, current=67.5, min_angle=0, max_angle=135):
+        self.minAngle = min_angle
+        self.maxAngle = max_angle
+        self.currentAngle = current
+
+
+def run_joint(joint, steps=1000):
+    """运行到停止, 返回每个周期的 (位置, 速度)"""
+    trace = [(joint.position, joint.velocity)]
+    for _ in range(steps):
+        if not joint.step(DT, MAX_VELOCITY, MAX_ACCEL):
+            break
+        trace.append((joint.position, joint.velocity))
+    else:
+        pytest.fail("joint did not settle")
+    return trace
+
+
+@pytest.mark.parametrize("start, setpoint", [
+    (30, 100),  # 长距离: 加速, 匀速, 减速
+    (100, 30),
+    (60, 64),  # 短距离: 达不到最大速度
+])
+def test_joint_step_trapezoid_limits(start, setpoint):
+    joint = motioncontrol.Joint(FakeServo(start))
+    joint.setpoint = setpoint
+    trace = run_joint(joint)
+    direction = 1 if setpoint > start else -1
+    for (p0, v0), (p1, v1) in zip(trace, trace[1:]):
+        assert abs(v1) <= MAX_VELOCITY + 1e-9
+        if p1 != setpoint:
+            assert abs(v1 - v0) <= MAX_ACCEL * DT + 1e-9
+        """ 单调地接近设定值, 不越过 """
+        assert (p1 - p0) * direction >= 0
+        assert (setpoint - p1) * direction >= 0
+    assert joint.position == setpoint
+    assert joint.velocity == 0
+
+
+def test_joint_step_reaches_max_velocity_on_long_moves():
+    joint = motioncontrol.Joint(FakeServo(30))
+    joint.setpoint = 105
+    velocities = [v for _, v in run_joint(joint)]
+    assert max(velocities) == pytest.approx(MAX_VELOCITY)
+    """ 加速阶段: 每个周期最多增加 max_accel * dt """
+    assert velocities[1] == pytest.approx(MAX_ACCEL * DT)
+
+
+def test_joint_setpoint_is_clamped_to_safe_range():
+    joint = motioncontrol.Joint(FakeServo(67.5))
+    assert joint.clamp(200) == 135 - mearm.safe_angle
+    assert joint.clamp(-10) == mearm.safe_angle
+
+
+def test_joint_at_rest_does_not_move():
+    joint = motioncontrol.Joint(FakeServo(50))
+    assert joint.step(DT, MAX_VELOCITY, MAX_ACCEL) is False
+    assert joint.position == 50
+
+
+def make_controller():
+    clock = FakeClock()
+    backend = servobackend.SimulatedBackend(clock=clock)
+    arm = mearm.MeArm(backend)
+    arm.move_to_centres()
+    controller = motioncontrol.MotionController(
+        arm, rate=1 / DT, max_velocity=MAX_VELOCITY, max_accel=MAX_ACCEL,
+        clock=clock)
+    return controller, clock
+
+
+def test_positions_at_returns_position_when_frame_was_taken():
+    controller, clock = make_controller()
+    start = controller.positions_at(clock())
+    controller.set_target(base=40)
+    history = []
+    for _ in range(10):
+        clock.advance(DT)
+        assert controller.tick(DT)
+        history.append((clock(), controller.positions_at(clock())))
+    """ 每个周期之间的时刻返回该周期之前最后写入的位置 """
+    for (t0, positions0), (t1, _) in zip(history, history[1:]):
+        assert controller.positions_at((t0 + t1) / 2) == positions0
+    assert history[-1][1][2] > history[0][1][2] > start[2]
+    """ 下臂和上臂没有移动 """
+    assert all(p[:2] == start[:2] for _, p in history)
+
+
+def test_positions_at_before_history_returns_current_position():
+    controller, clock = make_controller()
+    controller.set_target(lower=80)
+    clock.advance(DT)
+    controller.tick(DT)
+    current = tuple(controller.joints[name].position
+                    for name in motioncontrol.JOINTS)
+    assert controller.positions_at(clock() - 10) == current
+
+
+def test_tick_writes_servos_until_setpoint():
+    controller, clock = make_controller()
+    controller.set_target(upper=90)
+    for _ in range(500):
+        clock.advance(DT)
+        if not controller.tick(DT):
+            break
+    assert controller.arm.upper.currentAngle == pytest.approx(90)
+    assert controller.positions_at(clock())[1] == pytest.approx(90)
@@ -0,0 +1,65 @@
+# coding: utf-8
+import cv2
+import numpy as np
+
+import mearm
+import overlay
+import servobackend
+import tracking
+
+FRAME_PROP = (320, 240, 30)
+
+
+def draw(layer, color):
+    cv2.rectangle(layer, (20, 30), (200, 150), color, 1)
+    cv2.rectangle(layer, (270, 0), (320, 17), (255, 255, 255), -1)
+    cv2.putText(layer, "mode:test", (10, 200), cv2.FONT_HERSHEY_SIMPLEX,
+                0.4, color, 1, cv2.LINE_AA)
+
+
+def random_frame(seed):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 256, (FRAME_PROP[1], FRAME_PROP[0], 3), np.uint8)
+
+
+def test_composite_matches_direct_drawing():
+    """合成结果与直接在帧上绘制相同(抗锯齿边缘误差在 +-1 以内)"""
+    layer = overlay.StaticOverlay()
+    for seed in range(3):
+        expected = random_frame(seed)
+        draw(expected, (0, 128, 0))
+        frame = layer.apply(random_frame(seed), "test", draw, (0, 128, 0))
+        diff = cv2.absdiff(frame, expected)
+        assert diff.max() <= 1
+    assert layer.renders == 1
+
+
+def test_redraws_only_when_key_or_size_changes():
+    layer = overlay.StaticOverlay()
+    layer.apply(random_frame(0), "test", draw, (0, 128, 0))
+    layer.apply(random_frame(1), "test", draw, (0, 128, 0))
+    assert layer.renders == 1
+    layer.apply(random_frame(2), "tracking", draw, (0, 0, 255))
+    assert layer.renders == 2
+    layer.apply(np.zeros((120, 160, 3), np.uint8), "tracking", draw,
+                (0, 0, 255))
+    assert layer.renders == 3
+
+
+def test_server_overlay_uses_cached_layer():
+    """server_overlay = True 时静态部分由静态层合成, 每帧不重新绘制"""
+    mearm.set_backend(servobackend.CoalescingBackend(
+        servobackend.SimulatedBackend(latency=0)))
+    frame = np.zeros((FRAME_PROP[1], FRAME_PROP[0], 3), np.uint8)
+    tracker = tracking.Tracking(True, frame, FRAME_PROP, 'camshift', 'yellow',
+                                False, True, FRAME_PROP)
+    tracker.server_overlay = True
+    try:
+        for _ in range(3):
+            frame = tracker.get_track_frame(True, random_frame(0), False, True)
+        assert tracker.overlay.renders == 1
+        xmin, ymin, _, _ = tracker.margin_window
+        assert tuple(frame[int(round(ymin)) + 5, int(round(xmin))]) == \
+            (0, 128, 0)
+    finally:
+        tracker.myMeArmMove.close()
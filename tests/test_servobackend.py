@@ -0,0 +1,107 @@
+# coding: utf-8
+import threading
+import time
+
+import servobackend
+from conftest import FakeClock
+
+
+class Recorder(object):
+    """记录每次批量写入的后端"""
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+
+    def set_pulsewidths(self, pulses):
+        self.batches.append(dict(pulses))
+
+    def close(self):
+        self.closed = True
+
+
+def make_backend(max_rate=50, burst=2):
+    clock = FakeClock()
+    simulated = servobackend.SimulatedBackend(latency=0, clock=clock)
+    backend = servobackend.CoalescingBackend(simulated, max_rate, burst,
+                                             clock=clock)
+    return backend, simulated, clock
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_unchanged_writes_are_suppressed():
+    backend, simulated, clock = make_backend()
+    backend.set_pulsewidth(4, 1500)
+    clock.advance(1)
+    backend.set_pulsewidth(4, 1500)
+    backend.set_pulsewidths({4: 1500, 17: 1600})
+    assert simulated.commands_per_pin == {4: 1, 17: 1}
+    assert backend.suppressed == 2
+    assert backend.sent == 2
+
+
+def test_token_bucket_defers_and_timer_flushes():
+    backend, simulated, clock = make_backend(max_rate=10, burst=1)
+    backend.set_pulsewidth(4, 1000)
+    backend.set_pulsewidth(4, 1100)  # 没有令牌: 推迟
+    backend.set_pulsewidth(4, 1200)  # 只保留最新值
+    assert simulated.commands_per_pin[4] == 1
+    assert backend.deferred == 2
+    assert backend.last_pulse[4] == 1000
+    """ 定时器在有令牌的时刻发送 """
+    clock.advance(0.15)
+    assert wait_for(lambda: backend.last_pulse[4] == 1200)
+    assert simulated.commands_per_pin[4] == 2
+    clock.advance(1)
+    assert simulated.position(4) == 1200
+    backend.close()
+
+
+def test_close_forces_deferred_writes_out():
+    target = Recorder()
+    clock = FakeClock()
+    backend = servobackend.CoalescingBackend(target, 1, 1, clock=clock)
+    backend.set_pulsewidth(4, 1000)
+    backend.set_pulsewidth(4, 1300)  # 推迟(定时器约1秒后才会发送)
+    backend.close()
+    assert target.batches == [{4: 1000}, {4: 1300}]
+    assert target.closed
+
+
+def test_transaction_merges_writes_into_one_batch():
+    target = Recorder()
+    backend = servobackend.CoalescingBackend(target, 0)
+    with backend.transaction():
+        backend.set_pulsewidth(4, 1000)
+        with backend.transaction():
+            backend.set_pulsewidth(17, 1500)
+        assert target.batches == []
+    assert target.batches == [{4: 1000, 17: 1500}]
+
+
+def test_transaction_does_not_stage_other_threads():
+    target = Recorder()
+    backend = servobackend.CoalescingBackend(target, 0)
+    opened = threading.Event()
+    written = threading.Event()
+
+    def controller():
+        with backend.transaction():
+            backend.set_pulsewidth(4, 1000)
+            opened.set()
+            written.wait(2)
+
+    thread = threading.Thread(target=controller)
+    thread.start()
+    assert opened.wait(2)
+    """ 夹持器线程的写入不等控制线程的 transaction 结束 """
+    backend.set_pulsewidth(10, 2000)
+    assert target.batches == [{10: 2000}]
+    written.set()
+    thread.join()
+    assert target.batches == [{10: 2000}, {4: 1000}]
@@ -0,0 +1,147 @@
+# coding: utf-8
+import os
+import re
+import shutil
+
+import numpy as np
+import pytest
+
+import mearm
+import servobackend
+import settings
+import tracking
+from conftest import ROOT
+
+FRAME_PROP = (320, 240, 16)
+
+
+def set_option(path, section, key, value):
+    """改写配置文件中一节的一项"""
+    with open(path) as f:
+        lines = f.read().split('\n')
+    current = None
+    for i, line in enumerate(lines):
+        match = re.match(r'\[(.+)\]', line)
+        if match:
+            current = match.group(1)
+        elif current == section and re.match(key + r'\s*=', line):
+            lines[i] = "{} = {}".format(key, value)
+            break
+    else:
+        raise KeyError(key)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    """在临时目录中的配置文件副本上重新加载, 结束后恢复当前配置"""
+    for name in (settings.CONFIG_FILE, settings.COLOR_FILE):
+        shutil.copy(os.path.join(ROOT, name), str(tmp_path))
+    monkeypatch.chdir(str(tmp_path))
+    saved = settings._current, settings._pending, settings._mtimes
+    yield tmp_path
+    settings._current, settings._pending, settings._mtimes = saved
+
+
+@pytest.mark.parametrize("section, key, value, message", [
+    ('camera', 'frame_margin', '0.6', 'camera.frame_margin'),
+    ('camera', 'frame_prop', '(320, 240)', 'camera.frame_prop'),
+    ('tracking', 'min_area', '__import__("os")', 'not a literal'),
+    ('tracking', 'predict', '1', 'expected True or False'),
+])
+def test_invalid_value_raises_settings_error(config_dir, section, key, value,
+                                             message):
+    set_option(settings.CONFIG_FILE, section, key, value)
+    with pytest.raises(settings.SettingsError, match=re.escape(message)):
+        settings.load()
+    """ 重新加载失败时当前配置不变 """
+    current = settings.current()
+    with pytest.raises(settings.SettingsError):
+        settings.reload()
+    assert settings.current() is current
+    assert settings._pending is None
+
+
+def test_config_reload_endpoint_returns_400_on_invalid_settings(config_dir):
+    import app
+    client = app.app.test_client()
+    set_option(settings.CONFIG_FILE, 'tracking', 'hist_alpha', '2')
+    response = client.post('/config/reload')
+    assert response.status_code == 400
+    assert 'tracking.hist_alpha' in response.get_json()['error']
+
+    set_option(settings.CONFIG_FILE, 'tracking', 'hist_alpha', '0.1')
+    response = client.post('/config/reload')
+    assert response.status_code == 200
+    assert response.get_json() == {"changed": ["tracking.hist_alpha"],
+                                   "restart": []}
+    """ 摄像头没有打开时立即生效 """
+    assert settings.current().tracking.hist_alpha == 0.1
+
+
+def test_keys_outside_reloadable_need_restart(config_dir):
+    before = settings.current()
+    set_option(settings.CONFIG_FILE, 'camera', 'frame_prop', '(640, 480, 30)')
+    set_option(settings.CONFIG_FILE, 'mearm', 'backend', 'simulated')
+    set_option(settings.CONFIG_FILE, 'tracking', 'min_area', '900')
+    result = settings.reload()
+    assert result == {"changed": ["tracking.min_area"],
+                      "restart": ["camera.frame_prop", "mearm.backend"]}
+    config, changed = settings.apply_pending()
+    assert changed == {"tracking.min_area"}
+    assert config.tracking.min_area == 900
+    """ 需要重启的项保持原值 """
+    assert config.camera.frame_prop == before.camera.frame_prop
+    assert config.mearm.backend == before.mearm.backend
+    assert config.generation == before.generation + 1
+
+
+def test_only_restart_keys_changed_leaves_nothing_pending(config_dir):
+    set_option(settings.CONFIG_FILE, 'camera', 'frame_prop', '(640, 480, 30)')
+    result = settings.reload()
+    assert result == {"changed": [], "restart": ["camera.frame_prop"]}
+    assert settings.apply_pending() is None
+
+
+@pytest.fixture
+def tracker():
+    mearm.set_backend(servobackend.CoalescingBackend(
+        servobackend.SimulatedBackend(latency=0)))
+    frame = np.zeros((FRAME_PROP[1], FRAME_PROP[0], 3), np.uint8)
+    tracker = tracking.Tracking(True, frame, FRAME_PROP, 'camshift', 'yellow',
+                                False, True, FRAME_PROP)
+    tracker.myMeArmMove  # 创建机械臂控制实例
+    yield tracker
+    tracker.myMeArmMove.close()
+
+
+def test_apply_pending_reaches_instance_settings(config_dir, tracker):
+    """模块级的默认值只在导入时读取, 重新加载后必须由 apply_settings
+    更新各实例"""
+    margin_window = tracker.margin_window
+    set_option(settings.CONFIG_FILE, 'camera', 'frame_margin', '0.2')
+    set_option(settings.CONFIG_FILE, 'tracking', 'hist_alpha', '0.2')
+    set_option(settings.CONFIG_FILE, 'tracking', 'search_expand', '1.5')
+    set_option(settings.CONFIG_FILE, 'tracking', 'predict_alpha', '0.5')
+    set_option(settings.CONFIG_FILE, 'mearm', 'max_velocity', '45')
+    set_option(settings.CONFIG_FILE, 'mearm', 'ik_gain', '0.3')
+    set_option(settings.COLOR_FILE, 'yellow', 'lower', '22, 110, 110')
+    settings.reload()
+    config, changed = settings.apply_pending()
+    tracker.apply_settings(config, changed)
+
+    camshift = tracker.tracking
+    assert tracker.config is config
+    assert tracker.margin_window != margin_window
+    assert camshift.margin_window == tracker.margin_window
+    assert camshift.color_model.alpha == 0.2
+    assert camshift.search_region.expand == 1.5
+    assert camshift.predictor.alpha == 0.5
+    assert camshift.lower_color == (22, 110, 110)
+    arm = tracker.myMeArmMove
+    assert arm.config is config
+    if arm.controller is not None:
+        assert arm.controller.max_velocity == 45
+    if arm.ik is not None:
+        assert arm.ik.gain == 0.3
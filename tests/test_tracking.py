@@ -0,0 +1,48 @@
+# coding: utf-8
+import cv2
+import numpy as np
+import pytest
+
+import mearm
+import servobackend
+import tracking
+
+FRAME_PROP = (320, 240, 30)
+CAPTURE_TIME = 50.0  # 采集时刻, 与跟踪时的 timer() 无关
+
+
+def blob_frame(x):
+    frame = np.zeros((FRAME_PROP[1], FRAME_PROP[0], 3), np.uint8)
+    cv2.circle(frame, (x, 120), 30, (0, 255, 255), -1)
+    return frame
+
+
+@pytest.mark.parametrize("algorithm, color", [
+    ("camshift", "yellow"),
+    ("meanshift", "yellow"),
+    ("camshift", ["yellow", "blue"]),
+])
+def test_predictor_uses_capture_time(algorithm, color):
+    """位置预测按采集该帧的时刻更新和外推, 而不是跟踪开始的时刻"""
+    mearm.set_backend(servobackend.CoalescingBackend(
+        servobackend.SimulatedBackend(latency=0)))
+    tracker = tracking.Tracking(True, blob_frame(100), FRAME_PROP, algorithm,
+                                color, False, True, FRAME_PROP)
+    predictor = tracker.tracking.predictor
+    predict_times = []
+    predict_window = predictor.predict_window
+
+    def record(t):
+        predict_times.append(t)
+        return predict_window(t)
+    predictor.predict_window = record
+    try:
+        for i in range(4):
+            tracker.track(True, blob_frame(100 + 5 * i), False, True,
+                          frame_time=CAPTURE_TIME + i)
+        assert tracker.tracking.color_model.locked
+        assert predictor.time == CAPTURE_TIME + 3
+        """ 搜索从采集时刻的预测窗口开始 """
+        assert CAPTURE_TIME + 3 in predict_times
+    finally:
+        tracker.myMeArmMove.close()
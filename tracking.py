@@ -3,7 +3,6 @@ https://github.com/ECI-Robotics/opencv_remote_streaming_processing/
 """
 # !/usr/bin/env python
 # coding: utf-8
-import configparser
 import math
 from timeit import default_timer as timer
 
@@ -12,19 +11,20 @@ import cv2
 import camshift
 import meanshift
 import mearmlib
+import multitrack
+import overlay
+import settings
+from metrics import STAGE_SECONDS
 
-""" 加载配置文件 """
-config = configparser.ConfigParser()
-config.read('config.ini')
-frame_prop = eval(config.get('camera', 'frame_prop'))  # 帧属性
-frame_margin = eval(config.get('camera', 'frame_margin'))  # 帧边界
-track_area = eval(config.get('tracking', 'track_area'))  # 跟踪区域
+""" 加载配置 """
+config = settings.current()
+frame_prop = config.camera.frame_prop  # 帧属性
 
 
 class Tracking(object):
     """目标跟踪类"""
     def __init__(self, ret, frame, video_prop, algorithm, target_color,
-                 stream_only, is_test):
+                 stream_only, is_test, frame_prop=frame_prop, get_arm=None):
         """初始化跟踪器
 
         Args:
@@ -32,58 +32,131 @@ class Tracking(object):
             frame: 视频帧
             video_prop: 视频属性
             algorithm: 跟踪算法
-            target_color: 目标颜色
+            target_color: 目标颜色, 为列表时同时跟踪多个颜色(顺序即优先级)
             stream_only: 是否仅流模式
             is_test: 是否测试模式
+            frame_prop: 帧属性 (宽度, 高度, FPS), 默认使用config.ini的设置
+            get_arm: 获取机械臂控制实例的函数 (is_test, frame_prop),
+                     默认新建 mearmlib.MearmMove
         """
+        self.frame_prop = frame_prop  # 帧属性
+        self.config = settings.current()  # 当前配置(重新加载时替换)
         self.init_track_window = self._set_track_window()  # 初始跟踪窗口
         self.track_window = self.init_track_window  # 当前跟踪窗口
         self.track_window0 = self.track_window  # 上一帧跟踪窗口
         self.margin_window = self._set_margin_window()  # 边界窗口
-        """ 创建机械臂控制实例 """
-        self.myMeArmMove = mearmlib.MearmMove(is_test)
+        self.overlay = overlay.StaticOverlay()  # 静态叠加层
+        """ 机械臂控制实例在第一次跟踪时获取(仅流模式下不初始化舵机) """
+        self._get_arm = get_arm or mearmlib.MearmMove
+        self._arm_is_test = is_test
+        self.arm = None
         """ 创建OpenCV跟踪器实例 """
-        if algorithm == "meanshift":
-            self.tracking = meanshift.MeanShift(frame_prop, self.margin_window,
+        if isinstance(target_color, (list, tuple)):
+            self.tracking = multitrack.MultiTracker(self.frame_prop,
+                                                    self.margin_window,
+                                                    self.track_window,
+                                                    target_color, algorithm)
+        elif algorithm == "meanshift":
+            self.tracking = meanshift.MeanShift(self.frame_prop,
+                                              self.margin_window,
                                               self.track_window,
                                               target_color)
         else:
-            self.tracking = camshift.CamShift(frame_prop, self.margin_window,
+            self.tracking = camshift.CamShift(self.frame_prop,
+                                            self.margin_window,
                                             self.track_window, target_color)
+        """ 不在帧上绘制时由页面按 /telemetry 在画布上绘制 """
+        self.server_overlay = self.config.stream.server_overlay
+        self.tracking.draw = self.server_overlay
+        self.move_ratio = (0, 0)  # 最近一帧的移动比例
+        self.recorder = None  # recorder.FlightRecorder, 不记录时为None
         """ 设置帧上显示的文本 """
-        self.params = "{} * {} ({}) resize:{} {} {} {}".format(
-            round(video_prop[0]),
-            round(video_prop[1]),
-            round(video_prop[2]), frame_prop, frame_margin, algorithm,
-            target_color)
+        self.capture_text = "{} * {} ({})".format(
+            round(video_prop[0]), round(video_prop[1]), round(video_prop[2]))
+        if len(video_prop) > 3:
+            """ 摄像头实际使用的格式和驱动缓冲区数量 """
+            self.capture_text += " {} buf:{}".format(video_prop[3],
+                                                     video_prop[4])
+        self.algorithm = algorithm
+        self.target_color = target_color
         self.track_data = "跟踪窗口:{}({}) {}".format(0, 0, 0)
+        self._set_overlay_config()
         """ 计算FPS """
         self.accum_time = 0  # 累计时间
         self.curr_fps = 0  # 当前FPS
         self.fps = "FPS: ??"  # FPS显示文本
+        self.fps_value = 0  # 最近一秒的帧数
         self.prev_time = timer()  # 上一帧时间
-        """ 初始化视频捕获 """
-        self.video = cv2.VideoCapture(0, cv2.CAP_V4L)
 
-    def __del__(self):
-        """释放视频资源"""
-        self.video.release()
+    @property
+    def myMeArmMove(self):
+        """机械臂控制实例, 第一次使用时获取"""
+        if self.arm is None:
+            self.arm = self._get_arm(self._arm_is_test, self.frame_prop)
+        return self.arm
 
-    def _get_video_prop(self):
-        """获取视频属性"""
-        return self.video.get(cv2.CAP_PROP_FRAME_WIDTH), self.video.get(
-            cv2.CAP_PROP_FRAME_HEIGHT), self.video.get(cv2.CAP_PROP_FPS)
+    def reseed(self):
+        """在下一帧从当前跟踪窗口重新计算目标颜色模型
+
+        同时跟踪多个颜色时重新计算所有目标(不只是当前选中的目标)。
+        """
+        if isinstance(self.tracking, multitrack.MultiTracker):
+            self.tracking.reseed()
+        else:
+            self.tracking.color_model.reseed()
+
+    def apply_settings(self, config, changed):
+        """应用重新加载的配置(在两帧之间调用)
+
+        重新计算边界窗口、初始跟踪窗口和参数文本,
+        并把配置交给跟踪器和机械臂控制。
+
+        Args:
+            config: settings.Settings
+            changed: 改变的项
+        """
+        self.config = config
+        init_track_window = self._set_track_window()
+        if self.track_window == self.init_track_window:
+            self.track_window = init_track_window
+        self.init_track_window = init_track_window
+        self.margin_window = self._set_margin_window()
+        self.tracking.apply_settings(config, changed, self.margin_window,
+                                     self.init_track_window)
+        self.server_overlay = config.stream.server_overlay
+        self.tracking.draw = self.server_overlay
+        if self.arm is not None:
+            self.arm.apply_settings(config, changed)
+        self._set_overlay_config()
+
+    def _set_overlay_config(self):
+        """设置参数文本和页面绘制静态内容用的配置
+
+        内容改变时替换为新的dict(telemetry.EventFormatter 按对象判断是否重发)。
+        """
+        self.params = "{} resize:{} {} {} {}".format(
+            self.capture_text, self.frame_prop,
+            self.config.camera.frame_margin, self.algorithm,
+            self.target_color)
+        self.overlay_config = {
+            "frame": list(self.frame_prop[:2]),
+            "margin_window": [round(v) for v in self.margin_window],
+            "init_window": list(self.init_track_window),
+            "params": self.params
+        }
 
     def _set_margin_window(self):
         """设置边界窗口"""
-        frame_width, frame_height = frame_prop[:-1]
+        frame_width, frame_height = self.frame_prop[:-1]
+        frame_margin = self.config.camera.frame_margin
         xmargin = frame_width * frame_margin
         ymargin = frame_height * frame_margin
         return xmargin, ymargin, frame_width - xmargin, frame_height - ymargin
 
     def _set_track_window(self):
         """设置跟踪窗口"""
-        frame_width, frame_height = frame_prop[:-1]
+        frame_width, frame_height = self.frame_prop[:-1]
+        track_area = self.config.tracking.track_area
         xtrack = frame_width / 2 - (track_area[0] / 2)
         ytrack = frame_height / 2 - (track_area[1] / 2)
         return int(xtrack), int(ytrack), track_area[0], track_area[1]
@@ -101,8 +174,8 @@ class Tracking(object):
         x, y, w, h = track_window
         x0, y0, w0, h0 = track_window0
         diff = (x0 - x, y0 - y, w0 - w, h0 - h)
-        move_ratio = (round(diff[0] / frame_prop[0], 5),
-                     round(diff[1] / frame_prop[1], 5))
+        move_ratio = (round(diff[0] / self.frame_prop[0], 5),
+                     round(diff[1] / self.frame_prop[1], 5))
         return move_ratio
 
     def _calc_track_area_ratio(self, track_window, track_area):
@@ -119,7 +192,8 @@ class Tracking(object):
         track_window_area = track_window[2] * track_window[3]
         return round(math.sqrt(track_area) / math.sqrt(track_window_area), 2)
 
-    def get_track_frame(self, ret, frame, stream_only, is_test):
+    def get_track_frame(self, ret, frame, stream_only, is_test,
+                        frame_time=None):
         """获取跟踪后的视频帧
 
         Args:
@@ -127,61 +201,195 @@ class Tracking(object):
             frame: 输入帧
             stream_only: 是否仅流模式
             is_test: 是否测试模式
+            frame_time: 采集该帧的时刻(秒), 默认为当前时刻
 
         Returns:
             处理后的视频帧
         """
-        prob = None
+        return self.track_frame(ret, frame, stream_only, is_test,
+                                frame_time=frame_time)[0]
+
+    def track_frame(self, ret, frame, stream_only, is_test, debug=False,
+                    telemetry=False, frame_time=None):
+        """执行跟踪并返回处理后的帧、概率图和遥测数据
+
+        Args:
+            ret: 帧读取状态
+            frame: 输入帧
+            stream_only: 是否仅流模式
+            is_test: 是否测试模式
+            debug: 是否输出概率图
+            telemetry: 是否生成遥测数据
+            frame_time: 采集该帧的时刻(秒), 默认为当前时刻
+
+        Returns:
+            tuple: (处理后的视频帧, 概率图, 遥测数据),
+                   不输出的项为None(仅流模式下没有概率图)
+        """
+        frame, prob, track_window, track_area_ratio = self.track(
+            ret, frame, stream_only, is_test, debug, frame_time)
+        frame = self.annotate(frame, track_window, track_area_ratio, is_test)
+        data = None
+        if telemetry:
+            data = self.telemetry(track_window, track_area_ratio, is_test)
+        return frame, prob, data
+
+    def track(self, ret, frame, stream_only, is_test, debug=False,
+              frame_time=None):
+        """执行目标跟踪并控制机械臂(不绘制参数文本)
+
+        位置预测和机械臂的位置查询都使用采集该帧的时刻, 而不是跟踪
+        开始的时刻, 帧在流水线中排队的时间也计入延迟补偿。
+
+        Args:
+            ret: 帧读取状态
+            frame: 输入帧
+            stream_only: 是否仅流模式
+            is_test: 是否测试模式
+            debug: 是否输出概率图(单通道, 只在 /debug_feed 有客户端时需要)
+            frame_time: 采集该帧的时刻(秒), 默认为当前时刻
+
+        Returns:
+            tuple: (视频帧, 概率图, 跟踪窗口, 跟踪区域比例),
+                   仅流模式下后三项为None, 不输出概率图时概率图为None
+        """
+        if stream_only:
+            return frame, None, None, None
+
+        self.tracking.debug = debug
+        """ 跟踪器会在帧上绘制, 先把原始帧复制到飞行记录器 """
+        slot = None
+        if self.recorder is not None:
+            slot = self.recorder.begin(frame)
+        track_start = timer()
+        if frame_time is None:
+            frame_time = track_start
+        prob, frame, track_window, track_window0 = self.tracking.object_tracking(
+            ret, frame, frame_time)
+        track_area_ratio = self._calc_track_area_ratio(
+            track_window, self.config.tracking.track_area)
+        move_ratio = self._calc_move_ratio(track_window, track_window0)
+        self.move_ratio = move_ratio
+        """ 机械臂按延迟补偿后的预测位置动作 """
+        motion_window = track_window
+        if self.tracking.color_model.locked:
+            motion_window = self.tracking.predictor.predict_ahead(
+                self.config.tracking.predict_latency) or track_window
+        motion_start = timer()
+        with STAGE_SECONDS.time("motion"):
+            self.myMeArmMove.motion(motion_window, track_area_ratio,
+                                    move_ratio, self.margin_window, is_test,
+                                    frame_time)
+        if slot is not None:
+            arm = self.myMeArmMove
+            self.recorder.commit(
+                slot, frame_time, is_test, self.tracking.color_model.locked,
+                track_window, track_area_ratio, move_ratio, arm.last_command,
+                [getattr(arm.my_mearm, name).currentAngle
+                 for name in ("lower", "upper", "base", "grip")],
+                motion_start - track_start, timer() - motion_start)
+        return frame, prob, track_window, track_area_ratio
+
+    def telemetry(self, track_window, track_area_ratio, is_test):
+        """当前帧的遥测数据(页面在画布上绘制跟踪框和文本)
+
+        在跟踪之后立即调用, 移动比例和舵机角度是该帧的值。
+
+        Args:
+            track_window: 跟踪窗口(仅流模式下为None)
+            track_area_ratio: 跟踪区域比例
+            is_test: 是否测试模式
+
+        Returns:
+            dict: 可以直接转换为JSON
+        """
+        if track_window is None:
+            mode = "streamonly"
+        else:
+            mode = "test" if is_test else "tracking"
+        servo = {}
+        for name in ("lower", "upper", "base", "grip"):
+            angle = None
+            if self.arm is not None:
+                angle = getattr(self.arm.my_mearm, name).currentAngle
+            servo[name] = None if angle is None else round(angle, 1)
+        data = {
+            "mode": mode,
+            "fps": self.fps_value,
+            "servo": servo,
+            "track_window": None,
+            "track_area_ratio": None,
+            "move_ratio": None,
+            "boxes": []
+        }
+        if track_window is not None:
+            data["track_window"] = [int(v) for v in track_window]
+            data["track_area_ratio"] = float(track_area_ratio)
+            data["move_ratio"] = [float(v) for v in self.move_ratio]
+            data["boxes"] = [{
+                "points": pts.tolist(),
+                "color": "rgb({},{},{})".format(color[2], color[1],
+                                                color[0]),
+                "width": thickness
+            } for pts, color, thickness in self.tracking.boxes()]
+        return data
+
+    def annotate(self, frame, track_window, track_area_ratio, is_test):
+        """在帧上绘制边界窗口、参数文本和FPS
+
+        不在帧上绘制(server_overlay = False)时只计算FPS。
+
+        Args:
+            frame: 视频帧
+            track_window: 跟踪窗口(仅流模式下为None)
+            track_area_ratio: 跟踪区域比例
+            is_test: 是否测试模式
+
+        Returns:
+            绘制后的视频帧
+        """
+        with STAGE_SECONDS.time("annotate"):
+            return self._annotate(frame, track_window, track_area_ratio,
+                                  is_test)
+
+    def _annotate(self, frame, track_window, track_area_ratio, is_test):
+        self._update_fps()
+        if not self.server_overlay:
+            return frame
 
         if is_test:
             mode = ("test", (0, 128, 0))
         else:
             mode = ("tracking", (0, 0, 255))
 
-        if not stream_only:
-            prob, frame, track_window, track_window0 = self.tracking.object_tracking(
-                ret, frame)
-            track_area_ratio = self._calc_track_area_ratio(track_window,
-                                                         track_area)
-            move_ratio = self._calc_move_ratio(track_window, track_window0)
-            self.myMeArmMove.motion(track_window, track_area_ratio, move_ratio,
-                                  self.margin_window, is_test)
-            """ 在帧上绘制边界窗口 """
-            xmin, ymin, xmax, ymax = self.margin_window
-            frame = cv2.rectangle(frame, (round(xmin), round(ymin)),
-                                (round(xmax), round(ymax)), mode[1], 1)
-            """ 在帧上绘制初始窗口 """
-            init_xmin = self.init_track_window[0]
-            init_ymin = self.init_track_window[1]
-            init_xmax = self.init_track_window[0] + self.init_track_window[2]
-            init_ymax = self.init_track_window[1] + self.init_track_window[3]
-            frame = cv2.rectangle(frame, (round(init_xmin), round(init_ymin)),
-                                  (round(init_xmax), round(init_ymax)),
-                                  (128, 255, 255), 1)
+        """ 静态层(边界窗口, 初始窗口, 参数文本)只在模式或配置改变时绘制 """
+        tracking = track_window is not None
+        key = (mode, tracking, self.margin_window, self.init_track_window,
+               self.params)
+        frame = self.overlay.apply(frame, key, self._draw_static, mode,
+                                   tracking)
+
+        if tracking:
+            track_area = self.config.tracking.track_area
             self.track_data = "track win:{} area:({}/{} {})".format(
                 track_window, track_area[0] * track_area[1],
                 track_window[2] * track_window[3], track_area_ratio)
-            frame = cv2.putText(
-                frame,
-                self.params, (10, 10),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.25, (255, 255, 255),
-                thickness=1)
             frame = cv2.putText(
                 frame,
                 self.track_data, (10, 20),
                 cv2.FONT_HERSHEY_SIMPLEX,
                 0.3, (255, 255, 255),
                 thickness=1)
-            frame = cv2.putText(
-                frame,
-                "mode:" + mode[0], (10, frame_prop[1] - 10),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.3,
-                mode[1],
-                thickness=1)
 
-        # 计算FPS
+        # 在右上角绘制FPS(背景在静态层中)
+        frame_width = self.frame_prop[0]
+        cv2.putText(frame, self.fps, (frame_width - 50 + 3, 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 0), 1)
+
+        return frame
+
+    def _update_fps(self):
+        """计算FPS"""
         curr_time = timer()
         exec_time = curr_time - self.prev_time
         self.prev_time = curr_time
@@ -189,16 +397,46 @@ class Tracking(object):
         self.curr_fps = self.curr_fps + 1
         if self.accum_time > 1:
             self.accum_time = self.accum_time - 1
+            self.fps_value = self.curr_fps
             self.fps = "FPS: " + str(self.curr_fps)
             self.curr_fps = 0
 
-        # 在左上角绘制FPS
-        cv2.rectangle(frame, (frame_prop[0] - 50, 0), (frame_prop[0], 17),
-                     (255, 255, 255), -1)
-        cv2.putText(frame, self.fps, (frame_prop[0] - 50 + 3, 10),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 0), 1)
+    def _draw_static(self, layer, mode, tracking):
+        """绘制静态层
 
-        if prob is not None:
-            frame = cv2.vconcat([frame, prob])
+        Args:
+            layer: 空白图像
+            mode: (模式名称, 颜色)
+            tracking: 是否跟踪中(仅流模式下只绘制FPS背景)
+        """
+        if tracking:
+            """ 在帧上绘制边界窗口 """
+            xmin, ymin, xmax, ymax = self.margin_window
+            cv2.rectangle(layer, (round(xmin), round(ymin)),
+                          (round(xmax), round(ymax)), mode[1], 1)
+            """ 在帧上绘制初始窗口 """
+            init_xmin = self.init_track_window[0]
+            init_ymin = self.init_track_window[1]
+            init_xmax = self.init_track_window[0] + self.init_track_window[2]
+            init_ymax = self.init_track_window[1] + self.init_track_window[3]
+            cv2.rectangle(layer, (round(init_xmin), round(init_ymin)),
+                          (round(init_xmax), round(init_ymax)),
+                          (128, 255, 255), 1)
+            cv2.putText(
+                layer,
+                self.params, (10, 10),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.25, (255, 255, 255),
+                thickness=1)
+            cv2.putText(
+                layer,
+                "mode:" + mode[0], (10, self.frame_prop[1] - 10),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.3,
+                mode[1],
+                thickness=1)
 
-        return frame
+        """ FPS的背景 """
+        frame_width = self.frame_prop[0]
+        cv2.rectangle(layer, (frame_width - 50, 0), (frame_width, 17),
+                      (255, 255, 255), -1)